@@ -4,3 +4,12 @@ from django.apps import AppConfig
 class ForensicsConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'forensics'
+
+    def ready(self):
+        # schema upgrades and search index backfills run here, not inside a request
+        from .views import prepare_project_databases
+        prepare_project_databases()
+        # load the face models in the background, so face searches do not wait for them
+        from util import face_service
+        if face_service.autostart:
+            face_service.start()
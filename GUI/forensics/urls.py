@@ -10,8 +10,13 @@ urlpatterns = [
     path('project/<str:project_name>/browse/', views.browse_project, name='browse_project'),
     path('project/<str:project_name>/browse/<path:subpath>/', views.browse_project, name='browse_project'),
     path('project/<str:project_name>/timeline/', views.timeline_view, name='timeline_view'),
+    path('api/project/<str:project_name>/timeline/', views.timeline_api, name='timeline_api'),
+    path('project/<str:project_name>/timeline/search/', views.timeline_search_view, name='timeline_search'),
+    path('api/project/<str:project_name>/timeline/search/', views.timeline_search_api, name='timeline_search_api'),
     path('project/<str:project_name>/modules/', views.modules_view, name='modules_view'),
     path('compare/<str:project_name1>/<str:project_name2>/<str:type>/', views.compare_view, name='compare_view'),
+    path('face_search/', views.face_search_view, name='face_search'),
+    path('api/face_search/', views.face_search_api, name='face_search_api'),
     
     # add modules url like below and then write your view in views.py and then write your html files like telgram.html
     path('project/<str:project_name>/org.telegram.messenger/', views.telegram_view, name='telegram_view'),
@@ -1,7 +1,7 @@
 # forensics/views.py
 from django.shortcuts import render, redirect
 from django.conf import settings
-from django.http import FileResponse, Http404,  HttpResponseBadRequest
+from django.http import FileResponse, Http404,  HttpResponseBadRequest, JsonResponse
 from forensics.forms import ProjectForm, ApplicationForm, ProjectSelectForm
 import mimetypes
 import os
@@ -9,7 +9,8 @@ import sys
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '../..',)))
 from addresses import get_app_modules, set_current_project_desc, get_current_project_desc
 import main
-from util.image_utils import compare_projects_identities
+from util.image_utils import compare_projects_identities, match_project_identities, embed_query
+from databse import blob_store, face_index, index_db, timeline_db
 from .logic import parse_sqlite, parse_pcap
 import subprocess
 import csv
@@ -17,8 +18,15 @@ import datetime
 import pytz
 import json
 from django.utils.html import escape
+from django.utils.safestring import mark_safe
 import datetime, json
 import re
+import tempfile
+import sqlite3
+import hmac
+import secrets
+from django.middleware.csrf import CsrfViewMiddleware
+from django.views.decorators.csrf import csrf_exempt
 
 imgs = ["jpg", "png","jpeg"]
 
@@ -48,7 +56,7 @@ def list_projects():
     try:
         projects = [
             name for name in os.listdir(PROJECT_ROOT_DIR)
-            if os.path.isdir(os.path.join(PROJECT_ROOT_DIR, name))
+            if os.path.isdir(os.path.join(PROJECT_ROOT_DIR, name)) and not name.startswith('.')
         ]
         return [(name, name) for name in sorted(projects)]
     except Exception:
@@ -129,41 +137,252 @@ def add_application(request, project_name):
 
 #########################################################################################################################################3
 
+def prepare_project_databases():
+    """
+    Create or upgrade the index.db of every project (schema, search index
+    backfill) and import the combined/timeline.csv of projects processed
+    before the timeline table existed. Runs once when the server starts
+    (ForensicsConfig.ready), so requests only open the databases.
+    """
+    if not os.path.isdir(settings.PROJECTS_DIR):
+        return
+    for project_name in sorted(os.listdir(settings.PROJECTS_DIR)):
+        project_path = os.path.join(settings.PROJECTS_DIR, project_name)
+        db_path = os.path.join(project_path, "processed_data", "index.db")
+        timeline_path = os.path.join(project_path, "processed_data", "timeline", "combined", "timeline.csv")
+        if not os.path.exists(db_path) and not os.path.exists(timeline_path):
+            continue
+        conn = index_db.connect(db_path)
+        if not timeline_db.has_events(conn) and os.path.exists(timeline_path):
+            print("importing the timeline of", project_name)
+            timeline_db.import_csv(conn, timeline_path)
+        conn.close()
+
+
+def open_timeline(project_name):
+    """
+    Connection to the project index.db holding its timeline, or None when the
+    project has no timeline yet. The database is only opened here: it is
+    created by the pipeline and upgraded by prepare_project_databases.
+    """
+    db_path = os.path.join(settings.PROJECTS_DIR, project_name, "processed_data", "index.db")
+    if not os.path.exists(db_path):
+        return None
+    conn = index_db.open_existing(db_path)
+    try:
+        found = timeline_db.has_events(conn)
+    except sqlite3.OperationalError:
+        # made before the timeline table existed; upgraded at the next server start
+        found = False
+    if not found:
+        conn.close()
+        return None
+    return conn
+
+
+def timeline_event(event):
+    """Timeline row as the templates expect it, with the timestamp as a UTC datetime."""
+    try:
+        dt = datetime.datetime.fromtimestamp(event['timestamp'], tz=pytz.UTC)
+    except (ValueError, TypeError, OverflowError, OSError):
+        dt = None
+    return {
+        'id': event.get('id'),
+        'timestamp': dt,
+        'type': event['type'],
+        'event': event['event'],
+        'details': event['details'],
+        'source': event['source'],
+        'content': '',
+    }
+
+
+TIMELINE_PAGE_SIZE = 100
+TIMELINE_MAX_PAGE_SIZE = 1000
+
+
+def parse_timeline_time(value, end=False):
+    """
+    Unix time of a start/end parameter: a unix timestamp or an ISO date or
+    datetime, taken as UTC like the timeline display. A bare end date
+    includes that whole day.
+    """
+    if not value:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    dt = datetime.datetime.fromisoformat(value)
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=pytz.UTC)
+    if end and len(value) == 10:
+        dt += datetime.timedelta(days=1)
+    return dt.timestamp()
+
+
+def timeline_cursor(key):
+    if key is None:
+        return None
+    return "{0}:{1}".format("null" if key[0] is None else repr(key[0]), key[1])
+
+
+def parse_timeline_cursor(value):
+    if not value:
+        return None
+    timestamp, _, event_id = value.rpartition(":")
+    return (None if timestamp == "null" else float(timestamp), int(event_id))
+
+
+def timeline_page(request, conn):
+    """
+    One page of the timeline for the filter parameters of request (type,
+    event, source, start, end, q, limit, after). Returns (events, next cursor,
+    filters). Raises ValueError for malformed parameters.
+    """
+    filters = {
+        'types': request.GET.getlist('type'),
+        'events': request.GET.getlist('event'),
+        'sources': request.GET.getlist('source'),
+        'start': request.GET.get('start', ''),
+        'end': request.GET.get('end', ''),
+        'q': request.GET.get('q', '').strip(),
+    }
+    limit = min(int(request.GET.get('limit') or TIMELINE_PAGE_SIZE), TIMELINE_MAX_PAGE_SIZE)
+    if limit < 1:
+        raise ValueError("limit must be positive")
+    events, after = timeline_db.page(
+        conn, limit, parse_timeline_cursor(request.GET.get('after')),
+        start=parse_timeline_time(filters['start']),
+        end=parse_timeline_time(filters['end'], end=True),
+        types=[t for t in filters['types'] if t] or None,
+        sources=[s for s in filters['sources'] if s] or None,
+        events=[e for e in filters['events'] if e] or None,
+        contains=filters['q'] or None)
+    return [timeline_event(event) for event in events], timeline_cursor(after), filters
+
+
 def timeline_view(request, project_name):
-    """Display timeline of forensic events"""
-    project_path = os.path.join(settings.PROJECTS_DIR, project_name)
-    timeline_path = os.path.join(project_path, "processed_data", "timeline", "combined", "timeline.csv")
-    
-    if not os.path.exists(timeline_path):
+    """Display the first page of the filtered timeline; further pages come from timeline_api."""
+    conn = open_timeline(project_name)
+    if conn is None:
         raise Http404("Timeline data not processed yet")
+    try:
+        timeline_data, next_cursor, filters = timeline_page(request, conn)
+    except ValueError:
+        return HttpResponseBadRequest("Invalid timeline filter")
+    finally:
+        conn.close()
 
-    timeline_data = []
-    with open(timeline_path, 'r') as f:
-        reader = csv.DictReader(f)
-        for row in reader:
-            # Convert timestamp to datetime object
-            try:
-                dt = datetime.datetime.fromtimestamp(float(row['timestamp']), tz=pytz.UTC)
-            except (ValueError, TypeError):
-                dt = None
-                
-            timeline_data.append({
-                'timestamp': dt,
-                'type': row['type'],
-                'event': row['event'],
-                'details': row['details'],
-                'content': row.get('content', '')
-            })
+    return render(request, 'timeline.html', {
+        'project_name': project_name,
+        'timeline_data': timeline_data,
+        'next_cursor': next_cursor,
+        'filters': filters,
+        'event_types': ['calendar', 'contact', 'call', 'sms', 'media', 'Location', 'applications'],
+    })
 
-    # Sort by timestamp descending
-    timeline_data.sort(key=lambda x: x['timestamp'] or datetime.min, reverse=True)
 
-    return render(request, 'timeline.html', {
+def timeline_api(request, project_name):
+    """
+    GET one page of timeline events as JSON, newest first. Filters: type,
+    event and source (repeatable), start and end (unix time or ISO date),
+    q (text the details or event contain), limit; pass the returned 'next'
+    as 'after' to get the following page.
+    """
+    conn = open_timeline(project_name)
+    if conn is None:
+        return JsonResponse({'error': 'Timeline data not processed yet'}, status=404)
+    try:
+        timeline_data, next_cursor, _ = timeline_page(request, conn)
+    except ValueError as e:
+        return JsonResponse({'error': str(e)}, status=400)
+    finally:
+        conn.close()
+    events = [{
+        'id': event['id'],
+        'timestamp': event['timestamp'].timestamp() if event['timestamp'] else None,
+        'time': event['timestamp'].strftime("%Y-%m-%d %H:%M:%S") if event['timestamp'] else None,
+        'type': event['type'],
+        'event': event['event'],
+        'details': event['details'],
+        'source': event['source'],
+    } for event in timeline_data]
+    return JsonResponse({'events': events, 'next': next_cursor})
+
+
+
+
+def search_highlight(text):
+    """Escape highlighted search text, turning the timeline_db.HIGHLIGHT markers into <mark> tags."""
+    if not text:
+        return ''
+    start, end = timeline_db.HIGHLIGHT
+    return mark_safe(escape(text).replace(start, '<mark>').replace(end, '</mark>'))
+
+
+def timeline_search(conn, text, limit):
+    """timeline_db.search hits as template events with highlights, grouped by source."""
+    groups = []
+    for source, events in timeline_db.search(conn, text, limit):
+        hits = []
+        for event in events:
+            hit = timeline_event(event)
+            hit['event_highlight'] = search_highlight(event['event_highlight'])
+            hit['details_highlight'] = search_highlight(event['details_highlight'])
+            hits.append(hit)
+        groups.append({'source': source, 'events': hits})
+    return groups
+
+
+def timeline_search_view(request, project_name):
+    """Full-text search over the timeline: words, "phrases" and prefix* terms, hits grouped by source."""
+    conn = open_timeline(project_name)
+    if conn is None:
+        raise Http404("Timeline data not processed yet")
+    q = request.GET.get('q', '').strip()
+    start = datetime.datetime.now()
+    try:
+        groups = timeline_search(conn, q, TIMELINE_PAGE_SIZE * 2) if q else []
+    finally:
+        conn.close()
+    return render(request, 'timeline_search.html', {
         'project_name': project_name,
-        'timeline_data': timeline_data
+        'q': q,
+        'groups': groups,
+        'hits': sum(len(group['events']) for group in groups),
+        'took_ms': (datetime.datetime.now() - start).total_seconds() * 1000,
     })
 
 
+def timeline_search_api(request, project_name):
+    """GET q (and optionally limit), get the matching timeline events grouped by source as JSON; highlights are HTML."""
+    conn = open_timeline(project_name)
+    if conn is None:
+        return JsonResponse({'error': 'Timeline data not processed yet'}, status=404)
+    q = request.GET.get('q', '').strip()
+    try:
+        limit = min(int(request.GET.get('limit') or TIMELINE_PAGE_SIZE), TIMELINE_MAX_PAGE_SIZE)
+        groups = timeline_search(conn, q, limit) if q else []
+    except ValueError:
+        return JsonResponse({'error': 'limit must be a number'}, status=400)
+    finally:
+        conn.close()
+    return JsonResponse({'query': q, 'groups': [{
+        'source': group['source'],
+        'events': [{
+            'id': event['id'],
+            'timestamp': event['timestamp'].timestamp() if event['timestamp'] else None,
+            'time': event['timestamp'].strftime("%Y-%m-%d %H:%M:%S") if event['timestamp'] else None,
+            'type': event['type'],
+            'event': event['event'],
+            'details': event['details'],
+            'event_highlight': str(event['event_highlight']),
+            'details_highlight': str(event['details_highlight']),
+        } for event in group['events']],
+    } for group in groups]})
+
+
 
 
 ##############################################################################################################
@@ -185,63 +404,143 @@ def compare_view(request, project_name1, project_name2, type):
             'timeline_data2': timeline_data2
         })
     elif (type == "persons"):
-        matched_identities = compare_projects_identities(p1_identity_path, p2_identity_path, thresh=0.5)
+        try:
+            thresh = float(request.GET.get('thresh', 0.5))
+        except ValueError:
+            return HttpResponseBadRequest("thresh must be a number")
+        db1 = os.path.join(project1_path, "processed_data", "index.db")
+        db2 = os.path.join(project2_path, "processed_data", "index.db")
+        matches = None
+        if os.path.exists(db1) and os.path.exists(db2):
+            matches = match_project_identities(db1, db2, thresh=thresh)
 
         matched_data = []
-        for id1_path, id2_path in matched_identities:
-            files1 = [os.path.join(id1_path, f) for f in os.listdir(id1_path) if f.lower().rsplit('.', 1)[-1] in imgs]
-            first_file = files1[0]
-
-            files2 = [os.path.join(id2_path, f) for f in os.listdir(id2_path) if f.lower().rsplit('.', 1)[-1] in imgs]
-            second_file = files2[0]
-
-            url1 = settings.MEDIA_URL + os.path.relpath(first_file, settings.MEDIA_ROOT)
-            url2 = settings.MEDIA_URL + os.path.relpath(second_file, settings.MEDIA_ROOT)
+        if matches is not None:
+            for match in matches:
+                sample1 = os.path.join(project1_path, "processed_data", "faces", os.path.basename(match['sample1']))
+                sample2 = os.path.join(project2_path, "processed_data", "faces", os.path.basename(match['sample2']))
+                matched_data.append({
+                    'id1_name': "identity" + str(match['identity1']),
+                    'id2_name': "identity" + str(match['identity2']),
+                    'id1_imgs_zipped': settings.MEDIA_URL + os.path.relpath(sample1, settings.MEDIA_ROOT),
+                    'id2_imgs_zipped': settings.MEDIA_URL + os.path.relpath(sample2, settings.MEDIA_ROOT),
+                    'distance': match['distance'],
+                    'size1': match['size1'],
+                    'size2': match['size2'],
+                })
+        else:
+            # projects never clustered, or clustered before identity centroids were stored
+            matched_identities = compare_projects_identities(p1_identity_path, p2_identity_path, thresh=thresh)
+            for id1_path, id2_path in matched_identities:
+                files1 = [os.path.join(id1_path, f) for f in os.listdir(id1_path) if f.lower().rsplit('.', 1)[-1] in imgs]
+                first_file = files1[0]
 
-            print("first: ", first_file, "second: ", second_file)
-            id1_name = os.path.basename(id1_path)
-            id2_name = os.path.basename(id2_path)
+                files2 = [os.path.join(id2_path, f) for f in os.listdir(id2_path) if f.lower().rsplit('.', 1)[-1] in imgs]
+                second_file = files2[0]
 
+                url1 = settings.MEDIA_URL + os.path.relpath(first_file, settings.MEDIA_ROOT)
+                url2 = settings.MEDIA_URL + os.path.relpath(second_file, settings.MEDIA_ROOT)
 
-            matched_data.append({
-                'id1_name': id1_name,
-                'id2_name': id2_name,
-                'id1_imgs_zipped': url1,
-                'id2_imgs_zipped': url2,
-            })
+                matched_data.append({
+                    'id1_name': os.path.basename(id1_path),
+                    'id2_name': os.path.basename(id2_path),
+                    'id1_imgs_zipped': url1,
+                    'id2_imgs_zipped': url2,
+                })
 
         return render(request, 'compare_persons.html', {
             'project_name1': project_name1,
             'project_name2': project_name2,
             'matched_data': matched_data,
+            'thresh': thresh,
         })
         
     else:
         raise Http404("Comparison type not supported")
 
+def search_uploaded_face(request):
+    """Embed the face in the uploaded 'face' image and search every project. Returns (results, error)."""
+    upload = request.FILES.get('face')
+    if upload is None:
+        return None, "no image uploaded"
+    try:
+        k = min(int(request.POST.get('k', 20)), 200)
+    except ValueError:
+        return None, "k must be a number"
+    suffix = os.path.splitext(upload.name)[-1] or ".jpg"
+    with tempfile.NamedTemporaryFile(suffix=suffix) as tmp:
+        for chunk in upload.chunks():
+            tmp.write(chunk)
+        tmp.flush()
+        # uses the face service started with the server when it answers, the models in process otherwise
+        vector = embed_query(tmp.name)
+    if vector is None:
+        return None, "no face found in the image"
+    results = face_index.search(vector, k=k)
+    for result in results:
+        face = os.path.join(settings.PROJECTS_DIR, result['project'], "processed_data", "faces", result['name'])
+        result['url'] = settings.MEDIA_URL + os.path.relpath(face, settings.MEDIA_ROOT)
+    return results, None
+
+
+def face_search_view(request):
+    """Upload one face and list the closest faces across all projects."""
+    context = {'results': None, 'error': None}
+    if request.method == 'POST':
+        context['results'], context['error'] = search_uploaded_face(request)
+    return render(request, 'face_search.html', context)
+
+
+def api_key():
+    """Key for the JSON APIs, from $AFF_API_KEY or projects/.api_key (created on first use)."""
+    key = os.environ.get("AFF_API_KEY")
+    if key:
+        return key
+    path = os.path.join(settings.PROJECTS_DIR, ".api_key")
+    if not os.path.exists(path):
+        os.makedirs(settings.PROJECTS_DIR, exist_ok=True)
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+        with os.fdopen(fd, "w") as f:
+            f.write(secrets.token_hex(32))
+    with open(path) as f:
+        return f.read().strip()
+
+
+def api_authorized(request):
+    """True for a browser session holding a valid CSRF token, or a client sending the API key."""
+    sent = request.headers.get('X-API-Key') or request.headers.get('Authorization', '').removeprefix('Token ')
+    if sent:
+        return hmac.compare_digest(sent.encode("utf-8"), api_key().encode("utf-8"))
+    return CsrfViewMiddleware(lambda request: None).process_view(request, None, (), {}) is None
+
+
+@csrf_exempt
+def face_search_api(request):
+    """
+    POST a 'face' image (and optionally k), get the closest indexed faces as JSON.
+
+    Browser forms send the usual CSRF token; other clients send the API key
+    ($AFF_API_KEY, or the contents of projects/.api_key) as an
+    "Authorization: Token <key>" or "X-API-Key: <key>" header instead:
+
+        curl -H "X-API-Key: $(cat projects/.api_key)" -F face=@probe.jpg .../api/face_search/
+    """
+    if request.method != 'POST':
+        return HttpResponseBadRequest("POST an image as 'face'")
+    if not api_authorized(request):
+        return JsonResponse({'error': 'missing or invalid CSRF token or API key'}, status=403)
+    results, error = search_uploaded_face(request)
+    if error:
+        return JsonResponse({'error': error}, status=400)
+    return JsonResponse({'results': results})
+
 def read_timeline(project_name):
     """Helper to read timeline data for a project."""
-    project_path = os.path.join(settings.PROJECTS_DIR, project_name)
-    timeline_path = os.path.join(project_path, "processed_data", "timeline", "combined", "timeline.csv")
-    if not os.path.exists(timeline_path):
+    conn = open_timeline(project_name)
+    if conn is None:
         return []
-    timeline_data = []
-    with open(timeline_path, 'r') as f:
-        reader = csv.DictReader(f)
-        for row in reader:
-            try:
-                dt = datetime.datetime.fromtimestamp(float(row['timestamp']), tz=pytz.UTC)
-            except (ValueError, TypeError):
-                dt = None
-            timeline_data.append({
-                'timestamp': dt,
-                'type': row['type'],
-                'event': row['event'],
-                'details': row['details'],
-                'content': row.get('content', '')
-            })
-    # Sort by timestamp descending
-    timeline_data.sort(key=lambda x: x['timestamp'] or datetime.datetime.min, reverse=True)
+    timeline_data = [timeline_event(event) for event in timeline_db.query(conn)]
+    conn.close()
     return timeline_data
 
 
@@ -387,8 +686,12 @@ def browse_project(request, project_name, subpath=""):
         return handle_file(request, project_name, subpath, full_path)
 
     # Directory view
+    names = sorted(os.listdir(full_path))
+    # files whose bytes other projects hold too (see databse/blob_store.py)
+    shared = blob_store.shared_blobs([os.path.join(full_path, item) for item in names],
+                                     os.path.join(base_path, "processed_data", "index.db"), project_name)
     items = []
-    for item in sorted(os.listdir(full_path)):
+    for item in names:
         item_path = os.path.join(full_path, item)
         rel_url = os.path.join(subpath, item) if subpath else item
         is_image = item.lower().endswith(('.png', '.jpg', '.jpeg', '.gif', '.bmp'))
@@ -406,6 +709,7 @@ def browse_project(request, project_name, subpath=""):
             "url": rel_url,
             "preview": preview,
             "file_url": get_file_url(project_name, rel_url) if is_image else "",
+            "shared_with": shared.get(item_path, (None, []))[1],
         })
 
     breadcrumbs = get_breadcrumbs(subpath)
@@ -53,6 +53,20 @@ def get_address(needed_address):
             return base_address + "/processed_data/apps"
         case "project_process_timeline":
             return base_address + "/processed_data/timeline"
+        case "project_index_db":
+            return base_address + "/processed_data/index.db"
+        case "project_face_embeddings":
+            return base_address + "/processed_data/face_embeddings.f32"
+
+        # shared between projects
+        case "projects_dir":
+            return "projects"
+        case "blob_store":
+            return "projects/.blobs"
+        case "face_index":
+            return "projects/.face_index"
+        case "face_service":
+            return "projects/.face_service.sock"
 
 def get_current_project_name():
     return global_project_name
@@ -0,0 +1,104 @@
+"""
+Per-project manifest of processed inputs and per-stage checkpoints.
+
+stage_inputs records, for every stage, which inputs (path, size, mtime, sha256)
+it has already processed, so a rerun or a re-acquisition of the same device
+only processes new or changed files and a stage that died half way resumes
+where it stopped. checkpoints records whether a whole stage finished and the
+fingerprint of the inputs it finished on.
+"""
+import os
+import sys
+import time
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..',)))
+from util.file_utils import scan_files
+
+
+def load_done(conn, stage):
+    """{path: (size, mtime, sha256)} of the inputs stage has already processed."""
+    rows = conn.execute("SELECT path, size, mtime, sha256 FROM stage_inputs WHERE stage = ?", (stage,))
+    return {path: (size, mtime, sha256) for path, size, mtime, sha256 in rows}
+
+
+def is_done(done, path, size, mtime, sha256=None):
+    """True when path was processed with the same size, mtime and (if known) hash."""
+    previous = done.get(path)
+    if previous is None or previous[0] != size or previous[1] != mtime:
+        return False
+    return sha256 is None or previous[2] is None or previous[2] == sha256
+
+
+def mark_done(conn, stage, rows):
+    """Record (path, size, mtime, sha256) rows as processed by stage."""
+    now = time.time()
+    with conn:
+        conn.executemany("INSERT OR REPLACE INTO stage_inputs(stage, path, size, mtime, sha256, processed_at) VALUES (?, ?, ?, ?, ?, ?)",
+                         [(stage, path, size, mtime, sha256, now) for path, size, mtime, sha256 in rows])
+
+
+def forget(conn, stage, paths):
+    """Drop the records of inputs of stage that no longer exist."""
+    with conn:
+        conn.executemany("DELETE FROM stage_inputs WHERE stage = ? AND path = ?", [(stage, path) for path in paths])
+
+
+def stage_complete(conn, stage, fingerprint=None):
+    """True when stage finished before, on the same fingerprint if one is given."""
+    row = conn.execute("SELECT status, fingerprint FROM checkpoints WHERE stage = ?", (stage,)).fetchone()
+    if row is None or row[0] != "done":
+        return False
+    return fingerprint is None or row[1] == fingerprint
+
+
+def begin_stage(conn, stage):
+    with conn:
+        conn.execute("""
+        INSERT INTO checkpoints(stage, status, started_at) VALUES (?, 'running', ?)
+        ON CONFLICT(stage) DO UPDATE SET status = 'running', started_at = excluded.started_at
+        """, (stage, time.time()))
+
+
+def finish_stage(conn, stage, processed, skipped, fingerprint=None):
+    with conn:
+        conn.execute("""
+        UPDATE checkpoints SET status = 'done', fingerprint = ?, finished_at = ?, processed = ?, skipped = ?
+        WHERE stage = ?
+        """, (fingerprint, time.time(), processed, skipped, stage))
+    print("{stage}: {p} processed, {s} skipped".format(stage=stage, p=processed, s=skipped))
+    return {"processed": processed, "skipped": skipped}
+
+
+def skip_stage(stage):
+    """Report a stage whose inputs did not change since it last finished."""
+    print("{stage}: unchanged, skipped".format(stage=stage))
+    return {"processed": 0, "skipped": 1}
+
+
+def finished_at(conn, stage):
+    row = conn.execute("SELECT finished_at FROM checkpoints WHERE stage = ? AND status = 'done'", (stage,)).fetchone()
+    return row[0] if row else None
+
+
+def invalidate(conn, stage):
+    """Force stage to run again on the next pass."""
+    with conn:
+        conn.execute("UPDATE checkpoints SET status = 'stale' WHERE stage = ?", (stage,))
+
+
+def inventory_fingerprint(conn, root):
+    """Cheap fingerprint of the inventoried files under root."""
+    root = root.rstrip("/")
+    row = conn.execute("SELECT count(*), total(size), max(mtime), total(mtime) FROM files WHERE path > ? AND path < ?",
+                       (root + "/", root + "0")).fetchone()
+    return "{0}:{1}:{2}:{3}".format(*row)
+
+
+def tree_fingerprint(root):
+    """Fingerprint of a directory tree from a stat walk, for inputs outside the inventory."""
+    count, size, latest = 0, 0, 0.0
+    for entry in scan_files(root):
+        st = entry.stat(follow_symlinks=False)
+        count += 1
+        size += st.st_size
+        latest = max(latest, st.st_mtime)
+    return "{0}:{1}:{2}".format(count, size, latest)
@@ -0,0 +1,133 @@
+import os
+import threading
+
+HEADER_SIZE = 4096
+EXTENSIONS_FILE = os.path.join(os.path.dirname(__file__), "extensions.txt")
+
+# (offset, magic bytes, type, generic)
+# generic signatures are containers shared by several types (zip, ole, riff...),
+# so a known extension wins over them.
+SIGNATURES = [
+    # image
+    (0, b"\xFF\xD8\xFF", "image", False),
+    (0, b"\x89PNG\r\n\x1a\n", "image", False),
+    (0, b"GIF87a", "image", False),
+    (0, b"GIF89a", "image", False),
+    (0, b"II*\x00", "image", False),
+    (0, b"MM\x00*", "image", False),
+    (0, b"BM", "image", True),
+    (0, b"8BPS", "image", False),
+    (8, b"WEBP", "image", False),
+    (4, b"ftypheic", "image", False),
+    (4, b"ftypheix", "image", False),
+    (4, b"ftypmif1", "image", False),
+    (4, b"ftypavif", "image", False),
+    # video
+    (4, b"ftyp", "video", False),
+    (0, b"\x1A\x45\xDF\xA3", "video", False),
+    (8, b"AVI ", "video", False),
+    (0, b"FLV\x01", "video", False),
+    (0, b"\x00\x00\x01\xBA", "video", False),
+    # audio
+    (4, b"ftypM4A ", "audio", False),
+    (0, b"ID3", "audio", False),
+    (0, b"\xFF\xFB", "audio", False),
+    (0, b"\xFF\xF3", "audio", False),
+    (0, b"\xFF\xF2", "audio", False),
+    (0, b"fLaC", "audio", False),
+    (0, b"OggS", "audio", False),
+    (0, b"#!AMR", "audio", False),
+    (8, b"WAVE", "audio", False),
+    # archive
+    (0, b"PK\x03\x04", "archive", True),
+    (0, b"\x1F\x8B", "archive", False),
+    (0, b"7z\xBC\xAF\x27\x1C", "archive", False),
+    (0, b"Rar!\x1A\x07", "archive", False),
+    (0, b"BZh", "archive", False),
+    (0, b"\xFD7zXZ\x00", "archive", False),
+    (257, b"ustar", "archive", False),
+    (0, b"RIFF", "archive", True),
+    # app / exec
+    (0, b"dex\n", "app", False),
+    (0, b"\x7FELF", "exec", False),
+    # db
+    (0, b"SQLite format 3\x00", "db", False),
+    (0, b"\x37\x7F\x06\x82", "db", False),
+    (0, b"\x37\x7F\x06\x83", "db", False),
+    (0, b"\xD9\xD5\x05\xF9\x20\xA1\x63\xD7", "db", False),
+    # text / documents
+    (0, b"%PDF", "text", False),
+    (0, b"\xD0\xCF\x11\xE0\xA1\xB1\x1A\xE1", "text", True),
+    (0, b"{\\rtf", "text", False),
+    # font
+    (0, b"OTTO", "font", False),
+    (0, b"wOFF", "font", False),
+    (0, b"wOF2", "font", False),
+]
+
+
+def _compile(signatures):
+    """Index signatures by offset and first byte, longest magic first."""
+    table = {}
+    for offset, magic, file_type, generic in signatures:
+        table.setdefault(offset, {}).setdefault(magic[0], []).append((magic, file_type, generic))
+    for by_byte in table.values():
+        for candidates in by_byte.values():
+            candidates.sort(key=lambda c: len(c[0]), reverse=True)
+    return sorted(table.items())
+
+
+_table = _compile(SIGNATURES)
+_extensions = None
+_extensions_lock = threading.Lock()
+
+
+def load_extensions(path=EXTENSIONS_FILE):
+    """Parse extensions.txt once per process into an {extension: type} map."""
+    global _extensions
+    with _extensions_lock:
+        if _extensions is None:
+            extensions = {}
+            with open(path) as file:
+                for line in file:
+                    tmp = line.strip().split(":")
+                    for x in tmp[1].split(' '):
+                        extensions[x] = tmp[0]
+            _extensions = extensions
+    return _extensions
+
+
+def sniff(header):
+    """Return (type, generic) for the first matching signature in header, or None."""
+    fallback = None
+    for offset, by_byte in _table:
+        if len(header) <= offset:
+            break
+        for magic, file_type, generic in by_byte.get(header[offset], ()):
+            if header.startswith(magic, offset):
+                if not generic:
+                    return file_type, generic
+                if fallback is None:
+                    fallback = (file_type, generic)
+                break
+    return fallback
+
+
+def read_header(path, size=HEADER_SIZE):
+    try:
+        with open(path, "rb") as f:
+            return f.read(size)
+    except OSError:
+        return b""
+
+
+def classify(path, header):
+    """Return (type, source) from the header signature, falling back to the extension map."""
+    _, file_extension = os.path.splitext(path)
+    ext_type = load_extensions().get(file_extension[1:].lower())
+    match = sniff(header)
+    if match is None or (match[1] and ext_type is not None):
+        if ext_type is None:
+            return "others", "none"
+        return ext_type, "extension"
+    return match[0], "signature"
@@ -0,0 +1,163 @@
+"""
+Single-pass file inventory of the extracted tree.
+
+Every file is stat'ed and opened once: the first block gives its type, the
+whole read gives its SHA-256, and images get EXIF/GPS/time parsed from the
+same open file. Files hashed during acquisition are not hashed again: their
+SHA-256 comes from the project manifest.json (see extract/integrity.py) when
+its size and mtime still match. Rows of files that a pass no longer finds
+(gone after a re-acquisition) are deleted. Results go to the files table of the project index.db and
+later stages (extension_org, timeline media, media locations) query that
+table instead of walking and re-opening the tree.
+"""
+import os
+import sys
+import json
+import time
+import hashlib
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..',)))
+from util.file_utils import scan_files, bounded_map, batched
+from databse import index_db
+from . import file_type
+from .process_media_location import read_image_metadata, get_video_gps_and_unix_time
+
+HASH_CHUNK = 1024 * 1024
+
+COLUMNS = ("path", "size", "mtime", "ctime", "type", "type_source", "sha256",
+           "exif_datetime", "capture_time", "latitude", "longitude")
+
+# inventory tuning: number of reader threads, files per batch, batches in flight
+inventory_workers = min(32, (os.cpu_count() or 1) * 4)
+inventory_batch_size = 32
+inventory_queue_depth = 64
+
+
+def inventory_file(path, st, sha256=None):
+    """Build the inventory row of one file from a single open; a known sha256 is not computed again."""
+    meta = {}
+    with open(path, "rb") as f:
+        header = f.read(file_type.HEADER_SIZE)
+        detected, source = file_type.classify(path, header)
+        if sha256 is None:
+            h = hashlib.sha256(header)
+            for chunk in iter(lambda: f.read(HASH_CHUNK), b""):
+                h.update(chunk)
+            sha256 = h.hexdigest()
+        if detected == "image":
+            meta = read_image_metadata(f)
+    if detected == "video":
+        lat, lon, unix_ts = get_video_gps_and_unix_time(Path(path))
+        meta = {"latitude": lat, "longitude": lon, "capture_time": unix_ts}
+    return (path, st.st_size, st.st_mtime, st.st_ctime, detected, source, sha256,
+            meta.get("exif_datetime"), meta.get("capture_time"), meta.get("latitude"), meta.get("longitude"))
+
+
+def manifest_hashes(manifest_path):
+    """{normalised path: (size, mtime, sha256)} of the regular files in an acquisition manifest."""
+    if manifest_path is None or not os.path.exists(manifest_path):
+        return {}
+    base = os.path.dirname(manifest_path)
+    with open(manifest_path) as f:
+        files = json.load(f)["files"]
+    return {os.path.normpath(os.path.join(base, entry["path"])): (entry["size"], entry["mtime"], entry["sha256"])
+            for entry in files if "sha256" in entry}
+
+
+def _known_files(conn, paths):
+    """{path: (size, mtime)} of completely inventoried paths."""
+    paths = list(paths)
+    known = {}
+    for i in range(0, len(paths), 500):
+        chunk = paths[i:i + 500]
+        query = "SELECT path, size, mtime FROM files WHERE sha256 IS NOT NULL AND path IN ({q})".format(q=",".join("?" * len(chunk)))
+        for path, size, mtime in conn.execute(query, chunk):
+            known[path] = (size, mtime)
+    return known
+
+
+def _inventory_batch(entries, known, hashes):
+    rows = []
+    reused = 0
+    for entry in entries:
+        try:
+            st = entry.stat(follow_symlinks=False)
+            if known.get(entry.path) == (st.st_size, st.st_mtime):
+                reused += 1
+                continue
+            acquired = hashes.get(os.path.normpath(entry.path))
+            sha256 = acquired[2] if acquired is not None and acquired[:2] == (st.st_size, st.st_mtime) else None
+            rows.append(inventory_file(entry.path, st, sha256))
+        except OSError as e:
+            print(f"Error inventorying {entry.path}: {e}")
+    return rows, reused
+
+
+def _prune(conn, root, seen):
+    """Delete the rows of the files under root that are not in seen. Returns their paths."""
+    root = root.rstrip("/")
+    rows = conn.execute("SELECT path FROM files WHERE path > ? AND path < ?", (root + "/", root + "0"))
+    gone = [path for (path,) in rows if path not in seen]
+    with conn:
+        conn.executemany("DELETE FROM files WHERE path = ?", [(path,) for path in gone])
+    return gone
+
+
+def build_inventory(root, workers=inventory_workers, batch_size=inventory_batch_size,
+                    queue_depth=inventory_queue_depth, db_path=None, manifest_path=None):
+    """
+    Inventory every file under root. Files whose size and mtime match their
+    existing row are not read again, and those matching their manifest_path
+    entry are not hashed again. Rows of files no longer under root are
+    deleted. Returns a report dict.
+    """
+    hashes = manifest_hashes(manifest_path)
+    conn = index_db.connect(db_path)
+    placeholders = ", ".join("?" * len(COLUMNS))
+    insert = "INSERT OR REPLACE INTO files({cols}) VALUES ({q})".format(cols=", ".join(COLUMNS), q=placeholders)
+    new = 0
+    reused = 0
+    seen = set()
+    start = time.time()
+
+    def prepared():
+        for batch in batched(scan_files(root), batch_size):
+            seen.update(e.path for e in batch)
+            yield batch, _known_files(conn, (e.path for e in batch))
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for future in bounded_map(pool, lambda item: _inventory_batch(*item, hashes), prepared(), queue_depth):
+            try:
+                rows, batch_reused = future.result()
+            except Exception as e:
+                print(f"Error inventorying files: {e}")
+                continue
+            if rows:
+                with conn:
+                    conn.executemany(insert, rows)
+            new += len(rows)
+            reused += batch_reused
+    removed = _prune(conn, root, seen)
+    conn.close()
+
+    elapsed = max(time.time() - start, 1e-9)
+    print("inventory: {n} files read, {r} unchanged, {d} removed, {sec:.1f}s ({fps:.1f} files/s)".format(
+        n=new, r=reused, d=len(removed), sec=elapsed, fps=(new + reused) / elapsed))
+    return {"files": new + reused, "read": new, "unchanged": reused, "removed": len(removed), "seconds": elapsed}
+
+
+def iter_files(conn, root, types=None, order_by=None):
+    """Yield inventory rows (dicts keyed by COLUMNS) of the files under root."""
+    root = root.rstrip("/")
+    query = "SELECT {cols} FROM files WHERE path > ? AND path < ?".format(cols=", ".join(COLUMNS))
+    params = [root + "/", root + "0"]
+    if types:
+        query += " AND type IN ({q})".format(q=", ".join("?" * len(types)))
+        params.extend(types)
+    if order_by is not None:
+        if order_by not in COLUMNS:
+            raise ValueError(f"Unknown inventory column: {order_by}")
+        query += " ORDER BY " + order_by
+    for row in conn.execute(query, params):
+        yield dict(zip(COLUMNS, row))
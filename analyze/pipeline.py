@@ -0,0 +1,128 @@
+"""
+Dependency-graph scheduler for the analysis stages.
+
+A stage declares the data it reads (inputs) and writes (outputs); it depends
+on every stage that outputs one of its inputs. Stages whose dependencies have
+finished run concurrently on a thread (or process) pool, a failed stage skips
+only the stages downstream of it, and a per-stage wall-clock report with the
+critical path is printed at the end.
+"""
+import time
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+
+def stage(name, func, inputs=(), outputs=(), args=()):
+    return {"name": name, "func": func, "args": tuple(args), "inputs": list(inputs), "outputs": list(outputs)}
+
+
+def dependencies(stages):
+    """{stage name: set of stage names it waits for}. Raises ValueError on a cycle."""
+    producers = {}
+    for s in stages:
+        for output in s["outputs"]:
+            producers.setdefault(output, []).append(s["name"])
+    deps = {}
+    for s in stages:
+        deps[s["name"]] = {p for i in s["inputs"] for p in producers.get(i, []) if p != s["name"]}
+
+    # Kahn's algorithm, only to reject cycles
+    remaining = {name: set(d) for name, d in deps.items()}
+    ready = [name for name, d in remaining.items() if not d]
+    seen = 0
+    while ready:
+        name = ready.pop()
+        seen += 1
+        for other, d in remaining.items():
+            if name in d:
+                d.discard(name)
+                if not d:
+                    ready.append(other)
+    if seen != len(deps):
+        raise ValueError("Pipeline stages form a cycle: " + ", ".join(n for n, d in remaining.items() if d))
+    return deps
+
+
+def _timed(func, args):
+    start = time.time()
+    result = func(*args)
+    return result, start, time.time()
+
+
+def critical_path(deps, report):
+    """Longest chain of finished stages by wall-clock time: (stage names, seconds)."""
+    length = {}
+    previous = {}
+
+    def visit(name):
+        if name in length:
+            return length[name]
+        best, best_dep = 0.0, None
+        for dep in deps[name]:
+            if report.get(dep, {}).get("status") == "done" and visit(dep) > best:
+                best, best_dep = visit(dep), dep
+        length[name] = best + report[name]["seconds"]
+        previous[name] = best_dep
+        return length[name]
+
+    finished = [n for n in deps if report.get(n, {}).get("status") == "done"]
+    if not finished:
+        return [], 0.0
+    end = max(finished, key=visit)
+    path = []
+    node = end
+    while node is not None:
+        path.append(node)
+        node = previous[node]
+    return path[::-1], length[end]
+
+
+def run(stages, workers=4, processes=False):
+    """
+    Run stages as soon as their dependencies are done. Returns
+    {"stages": {name: {"status", "result", "start", "seconds"}}, "critical_path": [...], "wall": seconds}.
+    """
+    deps = dependencies(stages)
+    by_name = {s["name"]: s for s in stages}
+    waiting = {name: set(d) for name, d in deps.items()}
+    report = {}
+    running = {}
+    t0 = time.time()
+
+    def skip_downstream(failed):
+        for name, d in list(waiting.items()):
+            if failed in deps[name]:
+                del waiting[name]
+                report[name] = {"status": "skipped", "result": None, "start": None, "seconds": 0.0}
+                print(f"pipeline: skipping {name}, {failed} did not finish")
+                skip_downstream(name)
+
+    executor_class = ProcessPoolExecutor if processes else ThreadPoolExecutor
+    with executor_class(max_workers=workers) as pool:
+        while waiting or running:
+            for name in [n for n, d in waiting.items() if not d]:
+                del waiting[name]
+                s = by_name[name]
+                running[pool.submit(_timed, s["func"], s["args"])] = name
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                name = running.pop(future)
+                try:
+                    result, start, end = future.result()
+                    report[name] = {"status": "done", "result": result, "start": start - t0, "seconds": end - start}
+                    for d in waiting.values():
+                        d.discard(name)
+                except Exception as e:
+                    print(f"pipeline: stage {name} failed: {e}")
+                    report[name] = {"status": "failed", "result": None, "start": None, "seconds": 0.0}
+                    skip_downstream(name)
+
+    wall = time.time() - t0
+    path, path_seconds = critical_path(deps, report)
+    print("pipeline report ({wall:.1f}s wall, workers={w})".format(wall=wall, w=workers))
+    for s in stages:
+        r = report[s["name"]]
+        start = "-" if r["start"] is None else "{0:.1f}".format(r["start"])
+        print("  {name:<32} {status:<8} start {start:>7}s  took {sec:.1f}s".format(
+            name=s["name"], status=r["status"], start=start, sec=r["seconds"]))
+    print("  critical path: {path} ({sec:.1f}s)".format(path=" -> ".join(path), sec=path_seconds))
+    return {"stages": report, "critical_path": path, "wall": wall}
@@ -1,61 +1,163 @@
 import os, sys
 from subprocess import call
 import shutil
+import time
+from concurrent.futures import ThreadPoolExecutor
 import cv2
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..',)))
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'util')))
-from addresses import get_address, is_app_modules
-from util import image_utils
+from addresses import get_address, is_app_modules, get_current_project_name
+from util import image_utils, image_hash, face_service, video_faces
+from util.file_utils import bounded_map
+from databse import blob_store, index_db, face_index, timeline_db
+from extract import integrity
 from .timeline_process import process_timeline
+from . import file_type, inventory, checkpoint, pipeline
 from .modules import *
 import importlib
-from .process_media_location import append_locations_to_csv
+from .process_media_location import append_locations_to_timeline
 
 
 ext_list=["archive", "app", "audio", "book", "code", "exec", "font", "image", "sheet", "slide", "text", "video", "web", "db", "others"]
 ext=dict()
 known_apps=[]
 
+# extension organisation tuning: number of copy workers, files in flight, "copy", "link" or "blob"
+org_workers = min(32, (os.cpu_count() or 1) * 4)
+org_queue_depth = 256
+org_mode = "blob"
 
-def start_process(address, out, whole, app_name):
-    
-    project_address = get_address("project_dir")
-
-    # organise by extension
-    create_extensions()
-    extension_org(address, out)
-
-    #face analysis
-    img_address = get_address("project_process_extension_image")
-    save_address = get_address("project_process_face")
-    process_images(img_address, save_address)
+# number of pipeline stages allowed to run at the same time
+pipeline_workers = 4
 
-    # apps data analysis
-    app_address = get_address("project_extract_app")
-    app_save_address = get_address("project_process_apps")
-    for app in app_name:
-        app_address = app_address + "/" + app
-        app_save_address = app_save_address + "/" + app
-        if (whole):
-            process_app_data(app, app_address, app_save_address)
+# stages that finished on an earlier inventory and must run again when it changes
+inventory_dependents = ["timeline", "locations"]
 
+# skip face detection on near-duplicate images (see util/image_hash.py)
+dedup_images = True
+# sample keyframes of videos for faces too (see util/video_faces.py)
+video_faces_enabled = True
 
 
-    # timeline analysis
-    process_timeline(project_address)
-    
-    # get image-video locations
+def start_process(address, out, whole, app_name, workers=pipeline_workers):
+    """
+    Run every analysis stage on the extracted data as a dependency graph (see
+    pipeline.py): face analysis, the app modules and the timeline only wait for
+    the data they read, so they run side by side. Each stage records what it
+    processed in the project index.db (see checkpoint.py), so a rerun or a
+    re-acquisition only processes new or changed inputs and resumes a stage
+    that stopped half way. Returns {stage: {"processed": n, "skipped": m}}.
+    """
+    project_address = get_address("project_dir")
+    img_address = get_address("project_process_extension_image")
+    save_address = get_address("project_process_face")
     video_address = get_address("project_process_extension_video")
-    media_location_file = get_address("project_process_timeline")
-    media_location_file = media_location_file + "/combined/timeline.csv"
+    media_location_file = get_address("project_process_timeline") + "/combined/timeline.csv"
+    create_extensions()
 
-    append_locations_to_csv(img_address, video_address, media_location_file)
+    stages = [
+        # one inventory pass (type, hash, EXIF/GPS) over the extracted tree
+        pipeline.stage("inventory", inventory_stage, ["extract"], ["inventory"], args=(address,)),
+        # organise by extension
+        pipeline.stage("extension", extension_stage, ["inventory"], ["extension"], args=(address, out)),
+        #face analysis
+        pipeline.stage("faces", process_images, ["extension"], ["faces"], args=(img_address, save_address, video_address)),
+    ]
+    # apps data analysis
+    if (whole):
+        for app in app_name:
+            app_address = get_address("project_extract_app") + "/" + app
+            app_save_address = get_address("project_process_apps") + "/" + app
+            stages.append(pipeline.stage("app:" + app, app_stage, ["extract"], ["apps"],
+                                         args=(app, app_address, app_save_address)))
+    # timeline analysis, then image-video locations appended to it
+    stages.append(pipeline.stage("timeline", timeline_stage, ["inventory", "apps"], ["timeline"],
+                                 args=(project_address, address)))
+    stages.append(pipeline.stage("locations", locations_stage, ["inventory", "timeline"], ["locations"],
+                                 args=(img_address, video_address, media_location_file)))
+
+    result = pipeline.run(stages, workers)
+    return {name: r["result"] for name, r in result["stages"].items()}
 
 ###################################################################################
 
 
-def process_images(img_address, save_address):
-    face_analyze(img_address, save_address)
+def inventory_stage(address):
+    conn = index_db.connect()
+    checkpoint.begin_stage(conn, "inventory")
+    inv = inventory.build_inventory(address, manifest_path=os.path.join(get_address("project_dir"), integrity.MANIFEST))
+    if inv["read"] or inv["removed"]:
+        for stage in inventory_dependents:
+            checkpoint.invalidate(conn, stage)
+    report = checkpoint.finish_stage(conn, "inventory", inv["read"], inv["unchanged"],
+                                     checkpoint.inventory_fingerprint(conn, address))
+    conn.close()
+    return report
+
+def extension_stage(address, out):
+    conn = index_db.connect()
+    checkpoint.begin_stage(conn, "extension")
+    org = extension_org(address, out)
+    report = checkpoint.finish_stage(conn, "extension", org["files"], org["skipped"])
+    conn.close()
+    return report
+
+def app_stage(app, app_address, app_save_address):
+    stage = "app:" + app
+    fingerprint = checkpoint.tree_fingerprint(app_address)
+    conn = index_db.connect()
+    if checkpoint.stage_complete(conn, stage, fingerprint):
+        conn.close()
+        return checkpoint.skip_stage(stage)
+    checkpoint.begin_stage(conn, stage)
+    process_app_data(app, app_address, app_save_address)
+    report = checkpoint.finish_stage(conn, stage, 1, 0, fingerprint)
+    conn.close()
+    return report
+
+def timeline_stage(project_address, address):
+    """Rebuild the timeline when the inventory or an app module output changed."""
+    conn = index_db.connect()
+    apps = conn.execute("""
+    SELECT group_concat(stamp) FROM (
+        SELECT stage || '@' || finished_at AS stamp FROM checkpoints
+        WHERE stage LIKE 'app:%' AND status = 'done' ORDER BY stage
+    )
+    """).fetchone()[0]
+    fingerprint = "{0}|{1}".format(checkpoint.inventory_fingerprint(conn, address), apps)
+    if checkpoint.stage_complete(conn, "timeline", fingerprint):
+        conn.close()
+        return checkpoint.skip_stage("timeline")
+    checkpoint.begin_stage(conn, "timeline")
+    sources = process_timeline(project_address)
+    failed = [source for source, r in sources.items() if r["error"]]
+    # a timeline missing a failed source is rebuilt on the next run
+    report = checkpoint.finish_stage(conn, "timeline", len(sources) - len(failed), 0,
+                                     None if failed else fingerprint)
+    conn.close()
+    return report
+
+def locations_stage(img_address, video_address, media_location_file):
+    """Append media locations once per timeline build."""
+    conn = index_db.connect()
+    fingerprint = str(checkpoint.finished_at(conn, "timeline"))
+    if checkpoint.stage_complete(conn, "locations", fingerprint):
+        conn.close()
+        return checkpoint.skip_stage("locations")
+    checkpoint.begin_stage(conn, "locations")
+    db_path = get_address("project_index_db")
+    count = append_locations_to_timeline(img_address, video_address, db_path)
+    # keep the exported combined csv in step with the store
+    timeline_conn = index_db.connect(db_path)
+    timeline_db.export_csv(timeline_conn, media_location_file)
+    timeline_conn.close()
+    report = checkpoint.finish_stage(conn, "locations", count, 0, fingerprint)
+    conn.close()
+    return report
+
+
+def process_images(img_address, save_address, video_address=None):
+    return face_analyze(img_address, save_address, video_address)
 
 def process_app_data(app_name, app_address, save_address):
     if is_app_modules(app_name):
@@ -71,11 +173,7 @@ def process_app_data(app_name, app_address, save_address):
 
 ###################################################################################
 def create_extensions():
-    with open("analyze/extensions.txt") as file:
-        for line in file:
-            tmp=line.split(":")
-            for x in tmp[1].split(' '):
-                ext.update({x:tmp[0]})       
+    ext.update(file_type.load_extensions())
 
 def copy_file(src, dest):
     try:
@@ -87,32 +185,208 @@ def copy_file(src, dest):
         print(f"Error copying file: {e}")
 
 
-def extension_org(address,out):
+def place_file(src, dest, mode="copy", sha256=None):
+    """
+    Put src at dest. mode "link" hard-links when src and dest share a filesystem
+    and falls back to a copy otherwise; mode "copy" always copies; mode "blob"
+    stores src in the shared blob store and links dest to the blob (sha256 is
+    the already known hash of src, if any).
+    Returns the sha256 in "blob" mode, otherwise None.
+    """
+    if mode == "blob":
+        sha256, blob = blob_store.put_file(src, sha256)
+        place_file(blob, dest, "link")
+        return sha256
+    if mode == "link":
+        try:
+            os.link(src, dest)
+            return None
+        except FileExistsError:
+            return None
+        except OSError:
+            pass
+    copy_file(src, dest)
+    return None
+
+
+def _place_row(row, out, mode):
+    dest = os.path.join(out, "extension", row["type"], row["path"].replace('/', '_'))
+    return row, place_file(row["path"], dest, mode, row["sha256"])
+
+
+def _flush_placed(conn, placed, catalog):
+    if catalog:
+        blob_store.record(catalog)
+    if placed:
+        checkpoint.mark_done(conn, "extension", placed)
+
+
+def extension_org(address, out, workers=org_workers, queue_depth=org_queue_depth, mode=org_mode):
+    """
+    Copy (or hard-link, or store as a shared blob) every inventoried file under
+    address into out/extension/<type> using a pool of workers. Files, sizes,
+    mtimes and types come from the project inventory (see inventory.py), so the
+    tree is not walked or stat'ed again. At most queue_depth files are in
+    flight at once, the mtime inventory is written to ts.txt by this thread
+    only, and a throughput report is printed and returned. Files already
+    organised with the same size, mtime and hash are skipped.
+    """
     for item in ext_list:
         dir = os.path.join(out, "extension", item)
         if not os.path.exists(dir):
             print(f"Directory '{dir}' does not exist. Creating it now.")
             os.makedirs(dir)
 
-    for root, dirs, files in os.walk(address):
-        for file in files:
-            full_name=os.path.join(root, file)
-            _, file_extension = os.path.splitext(full_name)
-            file_type = ext.get(file_extension[1:])
-            with open("{output}/extension/ts.txt".format(output=out), "a") as ts:
-                if (file_type is not None):
-                    dest=os.path.join(out, "extension", file_type, full_name.replace('/', '_'))
-                    copy_file(full_name, dest)
-                    ts.write("{name} {mtime}\n".format(name=full_name, mtime=os.path.getmtime(full_name)))
-                    
-                else:
-                    dest=os.path.join(out, "extension", "others", full_name.replace('/', '_'))
-                    copy_file(full_name, dest)
-                    ts.write("{name} {mtime}\n".format(name=full_name, mtime=os.path.getmtime(full_name)))
-
-
-def face_analyze(img_address, face_address):
-    image_utils.start_face_process(img_address, face_address)
+    files = 0
+    skipped = 0
+    total_bytes = 0
+    catalog = []
+    placed = []
+    conn = index_db.connect()
+    done = checkpoint.load_done(conn, "extension")
+    start = time.time()
+
+    present = set()
+
+    def pending_rows():
+        nonlocal skipped
+        for row in inventory.iter_files(conn, address):
+            present.add(row["path"])
+            if checkpoint.is_done(done, row["path"], row["size"], row["mtime"], row["sha256"]):
+                skipped += 1
+                continue
+            yield row
+
+    with open("{output}/extension/ts.txt".format(output=out), "a", buffering=1024 * 1024) as ts, \
+            ThreadPoolExecutor(max_workers=workers) as pool:
+        work = lambda row: _place_row(row, out, mode)
+        for future in bounded_map(pool, work, pending_rows(), queue_depth):
+            try:
+                row, sha256 = future.result()
+            except Exception as e:
+                print(f"Error organising file: {e}")
+                continue
+            ts.write("{name} {mtime}\n".format(name=row["path"], mtime=row["mtime"]))
+            files += 1
+            total_bytes += row["size"]
+            placed.append((row["path"], row["size"], row["mtime"], row["sha256"]))
+            if sha256 is not None:
+                catalog.append((row["path"], sha256, row["size"], row["mtime"]))
+            if len(placed) >= 1000:
+                _flush_placed(conn, placed, catalog)
+                placed, catalog = [], []
+    _flush_placed(conn, placed, catalog)
+    # files gone from the inventory (a re-acquisition without them) lose their organised copy
+    gone = [path for path in done if path not in present]
+    for path in gone:
+        for item in ext_list:
+            dest = os.path.join(out, "extension", item, path.replace('/', '_'))
+            if os.path.lexists(dest):
+                os.remove(dest)
+    checkpoint.forget(conn, "extension", gone)
+    conn.close()
+
+    elapsed = max(time.time() - start, 1e-9)
+    report = {
+        "files": files,
+        "skipped": skipped,
+        "bytes": total_bytes,
+        "seconds": elapsed,
+        "files_per_sec": files / elapsed,
+        "mb_per_sec": total_bytes / (1024 * 1024) / elapsed,
+    }
+    print("extension_org: {files} files ({skipped} unchanged skipped, {gone} removed), {mb:.1f} MB in {sec:.1f}s ({fps:.1f} files/s, {mbps:.1f} MB/s, workers={w}, queue={q}, mode={m})".format(
+        files=files, skipped=skipped, gone=len(gone), mb=total_bytes / (1024 * 1024), sec=elapsed, fps=report["files_per_sec"],
+        mbps=report["mb_per_sec"], w=workers, q=queue_depth, m=mode))
+    return report
+
+
+def face_analyze(img_address, face_address, video_address=None):
+    """
+    Crop faces from the images (and keyframes of the videos) not processed
+    yet, then regroup identities if any new input was processed or the
+    grouping never finished.
+    """
+    conn = index_db.connect()
+    done = checkpoint.load_done(conn, "faces")
+    stats = {}
+    todo = []
+    paths = []
+    skipped = 0
+    for entry in os.scandir(img_address):
+        if not entry.is_file():
+            continue
+        paths.append(entry.path)
+        st = entry.stat()
+        if checkpoint.is_done(done, entry.path, st.st_size, st.st_mtime):
+            skipped += 1
+            continue
+        stats[entry.name] = (entry.path, st.st_size, st.st_mtime, None)
+        todo.append(entry.name)
+    # images removed by the extension stage lose their crops
+    present = set(paths)
+    gone = [path for path in done if path not in present]
+    if gone:
+        image_utils.remove_crops(face_address, [os.path.basename(path) for path in gone])
+        checkpoint.forget(conn, "faces", gone)
+
+    # near-duplicates only go through detection once, through their highest-resolution copy
+    run = todo
+    linked = {}
+    if todo and dedup_images:
+        representative = image_hash.near_duplicates(conn, paths)
+        run = []
+        for name in todo:
+            rep = os.path.basename(representative[os.path.join(img_address, name)])
+            if rep == name:
+                run.append(name)
+                continue
+            if rep in stats:
+                linked.setdefault(rep, []).append(name)
+            else:
+                # its representative was processed in an earlier run
+                checkpoint.mark_done(conn, "faces", [stats[name]])
+
+    def on_done(name):
+        checkpoint.mark_done(conn, "faces", [stats[name]] + [stats[member] for member in linked.get(name, [])])
+
+    if run and face_service.autostart:
+        face_service.ensure_running()
+    checkpoint.begin_stage(conn, "faces")
+    image_utils.face_extract(img_address, face_address, files=run, on_done=on_done)
+    report = checkpoint.finish_stage(conn, "faces", len(todo), skipped)
+
+    videos = []
+    if video_faces_enabled and video_address and os.path.isdir(video_address):
+        done = checkpoint.load_done(conn, "video_faces")
+        video_stats = {}
+        video_skipped = 0
+        for entry in os.scandir(video_address):
+            if not entry.is_file():
+                continue
+            st = entry.stat()
+            if checkpoint.is_done(done, entry.path, st.st_size, st.st_mtime):
+                video_skipped += 1
+                continue
+            video_stats[entry.name] = (entry.path, st.st_size, st.st_mtime, None)
+            videos.append(entry.name)
+        checkpoint.begin_stage(conn, "video_faces")
+        video_faces.video_face_extract(video_address, face_address, conn, files=videos,
+                                       on_done=lambda name: checkpoint.mark_done(conn, "video_faces", [video_stats[name]]))
+        checkpoint.finish_stage(conn, "video_faces", len(videos), video_skipped)
+
+    if todo or videos or gone or not checkpoint.stage_complete(conn, "identities"):
+        identity_address = face_address + "/identities"
+        checkpoint.begin_stage(conn, "identities")
+        shutil.rmtree(identity_address, ignore_errors=True)
+        image_utils.find_same_identities(face_address, identity_address, thresh=0.5, same_num=2)
+        checkpoint.finish_stage(conn, "identities", 1, 0)
+        try:
+            face_index.add_project()
+        except Exception as e:
+            print("adding faces to the global index failed: ", e)
+    conn.close()
+    return report
 
 def process_media_location(img_address, video_address, media_location_file):
     extract_gps_and_metadata(img_address, video_address, media_location_file)
@@ -4,12 +4,16 @@ import json
 import re
 import subprocess
 import shutil
+import sqlite3
+import sys
 from pathlib import Path
 from datetime import datetime, timezone
 
 from PIL import Image
 from PIL.ExifTags import TAGS, GPSTAGS
 import exifread
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..',)))
+from databse import index_db, timeline_db
 
 # ---------- small helpers ----------
 def _float_from_ratio(r):
@@ -132,42 +136,71 @@ def parse_datetime_to_unix(dt_str):
     return None
 
 # ---------- image gps/time ----------
-def get_image_gps_and_unix_time(image_path: Path):
+def read_image_metadata(fileobj):
+    """
+    Parse GPS position and capture time from an open image file object, trying
+    PIL first and exifread on the same object second.
+    Returns a dict with latitude, longitude, capture_time (unix, UTC) and
+    exif_datetime (raw DateTimeOriginal string); missing values are None.
+    """
+    meta = {'latitude': None, 'longitude': None, 'capture_time': None, 'exif_datetime': None}
     try:
-        img = Image.open(image_path)
-        exif = img.getexif()
-        if exif:
-            decoded = {}
-            for tag_id, value in exif.items():
-                decoded[TAGS.get(tag_id, tag_id)] = value
-            gps_ifd = decoded.get('GPSInfo')
-            lat, lon = parse_gps_from_pil_gpsinfo(gps_ifd)
-            dt_raw = None
-            for k in ('DateTimeOriginal', 'DateTime', 'DateTimeDigitized'):
-                if k in decoded and decoded[k]:
-                    dt_raw = decoded[k]
-                    break
-            unix_ts = parse_datetime_to_unix(dt_raw)
-            if lat is not None and lon is not None:
-                return lat, lon, unix_ts
+        fileobj.seek(0)
+        with Image.open(fileobj) as img:
+            exif = img.getexif()
+            if exif:
+                decoded = {}
+                for tag_id, value in exif.items():
+                    decoded[TAGS.get(tag_id, tag_id)] = value
+                try:
+                    for tag_id, value in exif.get_ifd(0x8769).items():
+                        decoded[TAGS.get(tag_id, tag_id)] = value
+                    gps_ifd = exif.get_ifd(0x8825) or decoded.get('GPSInfo')
+                except Exception:
+                    gps_ifd = decoded.get('GPSInfo')
+                lat, lon = parse_gps_from_pil_gpsinfo(gps_ifd)
+                dt_raw = None
+                for k in ('DateTimeOriginal', 'DateTime', 'DateTimeDigitized'):
+                    if k in decoded and decoded[k]:
+                        dt_raw = decoded[k]
+                        break
+                meta['capture_time'] = parse_datetime_to_unix(dt_raw)
+                if decoded.get('DateTimeOriginal'):
+                    meta['exif_datetime'] = str(decoded['DateTimeOriginal'])
+                if lat is not None and lon is not None:
+                    meta['latitude'], meta['longitude'] = lat, lon
+                    return meta
     except Exception:
         pass
 
     try:
-        with open(image_path, 'rb') as f:
-            tags = exifread.process_file(f, details=False)
-            lat, lon = parse_gps_from_exifread_tags(tags)
-            dt_raw = None
-            for k in ('EXIF DateTimeOriginal', 'Image DateTime', 'EXIF DateTimeDigitized'):
-                if k in tags:
-                    dt_raw = str(tags[k])
-                    break
-            unix_ts = parse_datetime_to_unix(dt_raw)
-            if lat is not None and lon is not None:
-                return lat, lon, unix_ts
+        fileobj.seek(0)
+        tags = exifread.process_file(fileobj, details=False)
+        lat, lon = parse_gps_from_exifread_tags(tags)
+        dt_raw = None
+        for k in ('EXIF DateTimeOriginal', 'Image DateTime', 'EXIF DateTimeDigitized'):
+            if k in tags:
+                dt_raw = str(tags[k])
+                break
+        if meta['capture_time'] is None:
+            meta['capture_time'] = parse_datetime_to_unix(dt_raw)
+        if meta['exif_datetime'] is None and 'EXIF DateTimeOriginal' in tags:
+            meta['exif_datetime'] = str(tags['EXIF DateTimeOriginal'])
+        if lat is not None and lon is not None:
+            meta['latitude'], meta['longitude'] = lat, lon
     except Exception:
         pass
 
+    return meta
+
+def get_image_gps_and_unix_time(image_path: Path):
+    try:
+        with open(image_path, 'rb') as f:
+            meta = read_image_metadata(f)
+    except Exception:
+        return None, None, None
+    if meta['latitude'] is not None and meta['longitude'] is not None:
+        return meta['latitude'], meta['longitude'], meta['capture_time']
     return None, None, None
 
 # ---------- ffprobe / exiftool helpers ----------
@@ -257,14 +290,44 @@ def file_mtime_unix(path: Path):
     return int(path.stat().st_mtime)
 
 # ---------- main: append to existing csv ----------
-def append_locations_to_csv(img_dir, vid_dir, existing_csv_path):
+def locations_from_inventory(db_path):
+    """Location rows for inventoried images and videos that carry a GPS position."""
+    conn = sqlite3.connect(db_path)
+    rows = []
+    query = """
+    SELECT type, latitude, longitude, capture_time, mtime FROM files
+    WHERE type IN ('image', 'video') AND latitude IS NOT NULL AND longitude IS NOT NULL
+    """
+    for file_type, lat, lon, unix_ts, mtime in conn.execute(query):
+        if unix_ts is None:
+            unix_ts = int(mtime)
+        rows.append({
+            'timestamp': int(unix_ts),
+            'type': 'Location',
+            'event': 'image_captured' if file_type == 'image' else 'video_captured',
+            'details': f"{lat},{lon}"
+        })
+    conn.close()
+    return rows
+
+def collect_locations(img_dir, vid_dir, db_path=None):
+    """
+    Timeline rows for image/video GPS locations. With db_path the rows come
+    from the project file inventory (see analyze/inventory.py) and no media file is
+    opened again; otherwise img_dir and vid_dir are scanned.
+    """
     img_exts = {'.jpg', '.jpeg', '.png', '.tiff', '.heic', '.webp'}
     vid_exts = {'.mp4', '.mov', '.avi', '.mkv', '.3gp', '.mts', '.mpg', '.mpeg'}
 
     rows_to_append = []
 
+    # inventory
+    if db_path is not None and os.path.exists(db_path):
+        rows_to_append = locations_from_inventory(db_path)
+        img_dir = vid_dir = None
+
     # images
-    if os.path.isdir(img_dir):
+    if img_dir and os.path.isdir(img_dir):
         for file in Path(img_dir).iterdir():
             if file.is_file() and file.suffix.lower() in img_exts:
                 lat, lon, unix_ts = get_image_gps_and_unix_time(file)
@@ -280,7 +343,7 @@ def append_locations_to_csv(img_dir, vid_dir, existing_csv_path):
                     })
 
     # videos
-    if os.path.isdir(vid_dir):
+    if vid_dir and os.path.isdir(vid_dir):
         for file in Path(vid_dir).iterdir():
             if file.is_file() and file.suffix.lower() in vid_exts:
                 lat, lon, unix_ts = get_video_gps_and_unix_time(file)
@@ -295,6 +358,20 @@ def append_locations_to_csv(img_dir, vid_dir, existing_csv_path):
                         'details': details
                     })
 
+    return rows_to_append
+
+def append_locations_to_timeline(img_dir, vid_dir, db_path):
+    """Store the image/video locations as the 'locations' source of the project timeline table."""
+    rows = collect_locations(img_dir, vid_dir, db_path)
+    conn = index_db.connect(db_path)
+    count = timeline_db.replace_source(conn, "locations", rows)
+    conn.close()
+    return count
+
+def append_locations_to_csv(img_dir, vid_dir, existing_csv_path, db_path=None):
+    """Append image/video GPS locations to a timeline csv (see collect_locations)."""
+    rows_to_append = collect_locations(img_dir, vid_dir, db_path)
+
     # ensure CSV exists & header present; append rows
     csv_path = Path(existing_csv_path)
     write_header = not csv_path.exists()
@@ -5,47 +5,141 @@ import pytz
 from PIL import Image
 from scapy.all import rdpcap
 import csv
+import sys
+import time
+import heapq
+import queue
+import threading
+from .inventory import iter_files
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..',)))
+from databse import index_db, timeline_db
+
+# events each source thread hands over at once, and batches it may run ahead of the merge
+source_chunk = 512
+source_queue_chunks = 8
 
 def process_timeline(project_path):
     base_path = os.path.join(project_path, "processed_data", "timeline")
     os.makedirs(base_path, exist_ok=True)
+    db_path = os.path.join(project_path, "processed_data", "index.db")
     
-    # Process different data sources
-    contacts_timeline = process_contacts(os.path.join(project_path, "extract", "other", "important_databases", "contacts2.db"))
-    calendar_timeline = process_calendar(os.path.join(project_path, "extract", "other", "important_databases", "calendar.db"))
-    sms_timeline = process_sms(os.path.join(project_path, "extract", "other", "important_databases", "mmssms.db"))
-    calllog_timeline = process_calllogs(os.path.join(project_path, "extract", "other", "important_databases", "calllog.db"))
-    media_timeline = process_media(os.path.join(project_path, "extract", "media", "sdcard"))
-    apps_timeline = process_apps(os.path.join(project_path, "processed_data", "apps"))
-    
-    # Combine all timelines
-    combined = contacts_timeline + calllog_timeline + media_timeline  + calendar_timeline + sms_timeline + apps_timeline
-    combined.sort(key=lambda x: x["timestamp"])
-    
-    # Save individual timelines
-    save_timeline(contacts_timeline, os.path.join(base_path, "contacts"))
-    save_timeline(calendar_timeline, os.path.join(base_path, "calendar"))
-    save_timeline(calllog_timeline, os.path.join(base_path, "calllogs"))
-    save_timeline(sms_timeline, os.path.join(base_path, "sms"))
-    save_timeline(media_timeline, os.path.join(base_path, "media"))
-    save_timeline(apps_timeline, os.path.join(base_path, "apps"))
-    save_timeline(combined, os.path.join(base_path, "combined"))
+    # Every source is a generator of events in time order
+    sources = {
+        "contacts": process_contacts(os.path.join(project_path, "extract", "other", "important_databases", "contacts2.db")),
+        "calendar": process_calendar(os.path.join(project_path, "extract", "other", "important_databases", "calendar.db")),
+        "sms": process_sms(os.path.join(project_path, "extract", "other", "important_databases", "mmssms.db")),
+        "calllogs": process_calllogs(os.path.join(project_path, "extract", "other", "important_databases", "calllog.db")),
+        "media": process_media(os.path.join(project_path, "extract", "media", "sdcard"), db_path),
+        "apps": process_apps(os.path.join(project_path, "processed_data", "apps")),
+    }
+
+    # Read every source (and write its own csv) in its own thread, and stream their
+    # k-way merge into the project timeline table and the combined csv
+    start = time.time()
+    report = {}
+    stop = threading.Event()
+    threads = []
+    sources = {source: concurrent_source(source, save_timeline(timeline, os.path.join(base_path, source)),
+                                         report, stop, threads)
+               for source, timeline in sources.items()}
+    conn = None
+    try:
+        # opened after the readers started, so failing to open it must stop them too
+        conn = index_db.connect(db_path)
+        conn.execute("DELETE FROM timeline WHERE source = 'combined'")
+        conn.commit()
+        count = timeline_db.replace_merged(conn, sources, os.path.join(base_path, "combined", "timeline.csv"))
+    finally:
+        if conn is not None:
+            conn.close()
+        # if the merge failed, the readers must not stay blocked on their queues
+        stop.set()
+        for thread in threads:
+            thread.join()
+    for source, r in report.items():
+        status = f"failed: {r['error']}" if r["error"] else "done"
+        print(f"Timeline source {source}: {r['events']} events in {r['seconds']:.1f}s "
+              f"({r['waiting']:.1f}s waiting for the merge), {status}")
+    print(f"Timeline: {count} events in {time.time() - start:.1f}s")
+    return report
+
+def _put(out, item, stop):
+    """Put item on out unless stop is set first. Returns whether it was put."""
+    while not stop.is_set():
+        try:
+            out.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            pass
+    return False
+
+def _read_source(name, events, out, report, stop):
+    start = time.time()
+    waiting = 0.0
+    count = 0
+    error = None
+    chunk = []
+    try:
+        for event in events:
+            chunk.append(event)
+            if len(chunk) >= source_chunk:
+                t = time.time()
+                if not _put(out, chunk, stop):
+                    break
+                waiting += time.time() - t
+                count += len(chunk)
+                chunk = []
+    except Exception as e:
+        # a failing source ends early with what it read; the others still make the timeline
+        error = repr(e)
+        print(f"Error in timeline source {name}: {e}")
+    finally:
+        # closes the source's files and database connections when it stopped early
+        events.close()
+        if _put(out, chunk, stop):
+            count += len(chunk)
+        report[name] = {"events": count, "seconds": time.time() - start, "waiting": waiting, "error": error}
+        _put(out, None, stop)
+
+def _drain(out):
+    while True:
+        chunk = out.get()
+        if chunk is None:
+            return
+        yield from chunk
+
+def concurrent_source(name, events, report, stop, threads):
+    """
+    Start reading the events generator in a thread of its own (appended to
+    threads) and return an iterator over its events, in the same order.
+    report[name] gets the source's event count, wall time, time spent blocked
+    on the merge and error (None if it finished). Setting stop makes the
+    thread close the generator and end.
+    """
+    out = queue.Queue(maxsize=source_queue_chunks)
+    thread = threading.Thread(target=_read_source, args=(name, events, out, report, stop), daemon=True,
+                              name=f"timeline-{name}")
+    thread.start()
+    threads.append(thread)
+    return _drain(out)
 
 def save_timeline(timeline, output_dir):
+    """Yield the events of timeline while writing them to output_dir/timeline.csv."""
     os.makedirs(output_dir, exist_ok=True)
     csv_path = os.path.join(output_dir, "timeline.csv")
     
-    with open(csv_path, "w") as f:
-        f.write("timestamp,type,event,details\n")
+    with open(csv_path, "w", newline="", encoding="utf-8") as f:
+        writer = csv.writer(f)
+        writer.writerow(["timestamp", "type", "event", "details"])
         for event in timeline:
-            f.write(f"{event['timestamp']},{event['type']},{event['event']},\"{event['details']}\"\n")
+            writer.writerow([event['timestamp'], event['type'], event['event'], event['details']])
+            yield event
 
 
 def process_calendar(db_path):
-    timeline = []
     if not os.path.exists(db_path):
         print(f"Calendar DB not found at {db_path}")
-        return timeline
+        return
     try:
         conn = sqlite3.connect(db_path)
         cursor = conn.cursor()
@@ -61,10 +155,10 @@ SELECT
     datetime(e.dtend / 1000, 'unixepoch', 'localtime') AS end_time
 FROM Events AS e
 JOIN Calendars AS c ON e.calendar_id = c._id
-ORDER BY e.dtstart DESC;
+ORDER BY e.dtstart ASC;
         """
         cursor.execute(query)
-        for row in cursor.fetchall():
+        for row in cursor:
             event_id, calendar_name, title, description, location, start_time_str, end_time_str = row
             
             try:
@@ -74,24 +168,23 @@ ORDER BY e.dtstart DESC;
 
             details = f"Calendar: {calendar_name}, Title: {title or 'N/A'}, Description: {description or 'N/A'}, Location: {location or 'N/A'}"
 
-            timeline.append({
+            yield {
                 "timestamp": start_ts,
                 "type": "calendar",
                 "event": "Calendar event",
                 "details": details
-            })
+            }
 
         conn.close()
     except Exception as e:
         print(f"Error processing calendar events: {e}")
-    return timeline
+        raise
 
 
 def process_contacts(db_path):
-    timeline = []
     if not os.path.exists(db_path):
         print(f"Contacts DB not found at {db_path}")
-        return timeline
+        return
     try:
         conn = sqlite3.connect(db_path)
         cursor = conn.cursor()
@@ -110,10 +203,10 @@ JOIN data AS dn
        SELECT _id FROM mimetypes WHERE mimetype = 'vnd.android.cursor.item/name'
      )
 GROUP BY c._id
-ORDER BY c.contact_last_updated_timestamp DESC;
+ORDER BY c.contact_last_updated_timestamp ASC;
         """
         cursor.execute(query)
-        for row in cursor.fetchall():
+        for row in cursor:
             contact_id, name, last_updated_str = row
             # Parse datetime string to timestamp
             try:
@@ -122,22 +215,21 @@ ORDER BY c.contact_last_updated_timestamp DESC;
             except Exception:
                 last_updated_ts = None
 
-            timeline.append({
+            yield {
                 "timestamp": last_updated_ts,
                 "type": "contact",
                 "event": "Contact updated",
                 "details": f"ID: {contact_id}, Name: {name}"
-            })
+            }
         conn.close()
     except Exception as e:
         print(f"Error processing contacts: {e}")
-    return timeline
+        raise
 
 def process_calllogs(db_path):
-    timeline = []
     if not os.path.exists(db_path):
         print(f"Calllog DB not found at {db_path}")
-        return timeline
+        return
     try:
         conn = sqlite3.connect(db_path)
         cursor = conn.cursor()
@@ -155,10 +247,10 @@ def process_calllogs(db_path):
           duration,
           datetime(date/1000,'unixepoch','localtime') AS call_time
         FROM calls
-        ORDER BY date DESC;
+        ORDER BY date ASC;
         """
         cursor.execute(query)
-        for row in cursor.fetchall():
+        for row in cursor:
             call_id, number, call_type, duration, call_time_str = row
             try:
                 call_time_dt = datetime.strptime(call_time_str, '%Y-%m-%d %H:%M:%S')
@@ -166,19 +258,74 @@ def process_calllogs(db_path):
             except Exception:
                 call_time_ts = None
 
-            timeline.append({
+            yield {
                 "timestamp": call_time_ts,
                 "type": "call",
                 "event": f"{call_type} call",
                 "details": f"Number: {number}, Duration: {duration} sec"
-            })
+            }
         conn.close()
     except Exception as e:
         print(f"Error processing call logs: {e}")
-    return timeline
+        raise
+
+def _exif_time(row):
+    if row["exif_datetime"]:
+        try:
+            return datetime.strptime(row["exif_datetime"], '%Y:%m:%d %H:%M:%S').timestamp()
+        except Exception:
+            pass
+    return None
+
+def _media_event(row, media_path, exif_time):
+    return {
+        "timestamp": exif_time or row["mtime"],
+        "type": "media",
+        "event": "File created",
+        "details": f"Path: {os.path.relpath(row['path'], media_path)}",
+        "source": "EXIF" if exif_time else "Filesystem"
+    }
+
+def _media_by_exif(conn, media_path):
+    # 'YYYY:MM:DD HH:MM:SS' strings sort in time order
+    for row in iter_files(conn, media_path, order_by="exif_datetime"):
+        exif_time = _exif_time(row)
+        if exif_time:
+            yield _media_event(row, media_path, exif_time)
 
-def process_media(media_path):
-    timeline = []
+def _media_by_mtime(conn, media_path):
+    for row in iter_files(conn, media_path, order_by="mtime"):
+        if not _exif_time(row):
+            yield _media_event(row, media_path, None)
+
+def process_media_inventory(media_path, db_path):
+    """
+    Media events from the project file inventory in time order, without
+    touching the files: files dated by EXIF and files dated by mtime are read
+    through their own ordered query and merged.
+    """
+    conn = sqlite3.connect(db_path)
+    try:
+        yield from heapq.merge(_media_by_exif(conn, media_path), _media_by_mtime(conn, media_path),
+                               key=timeline_db.sort_key)
+    except sqlite3.Error as e:
+        print(f"Error reading file inventory: {e}")
+        raise
+    finally:
+        conn.close()
+
+def process_media(media_path, db_path=None):
+    if db_path is not None and os.path.exists(db_path):
+        timeline = process_media_inventory(media_path, db_path)
+        first = next(timeline, None)
+        if first is not None:
+            yield first
+            yield from timeline
+            return
+    # no inventory: walk the files, sorting their events on disk
+    yield from timeline_db.sorted_events(_walk_media(media_path))
+
+def _walk_media(media_path):
     for root, _, files in os.walk(media_path):
         for file in files:
             file_path = os.path.join(root, file)
@@ -200,22 +347,19 @@ def process_media(media_path):
                 except Exception as e:
                     pass
                 
-            timeline.append({
+            yield {
                 "timestamp": exif_time or fs_times["modified"],
                 "type": "media",
                 "event": "File created",
                 "details": f"Path: {os.path.relpath(file_path, media_path)}",
                 "source": "EXIF" if exif_time else "Filesystem"
-            })
-    
-    return timeline
+            }
 
 
 def process_sms(db_path):
-    timeline = []
     if not os.path.exists(db_path):
         print(f"SMS DB not found at {db_path}")
-        return timeline
+        return
     try:
         conn = sqlite3.connect(db_path)
         cursor = conn.cursor()
@@ -229,10 +373,10 @@ SELECT
     body,
     type
 FROM sms
-ORDER BY date DESC;
+ORDER BY date ASC;
         """
         cursor.execute(query)
-        for row in cursor.fetchall():
+        for row in cursor:
             msg_id, address, date_ms, date_sent_ms, body, msg_type = row
 
             # Convert timestamps
@@ -262,17 +406,17 @@ ORDER BY date DESC;
 
             details = f"{direction} SMS | {contact}, Body: {body or '[empty]'}{extra_info}"
 
-            timeline.append({
+            yield {
                 "timestamp": timestamp,
                 "type": "sms",
                 "event": direction,
                 "details": details
-            })
+            }
 
         conn.close()
     except Exception as e:
         print(f"Error processing SMS messages: {e}")
-    return timeline
+        raise
 
 ##############################################
 
@@ -282,8 +426,12 @@ def process_apps(project_path):
     - type => 'applications'
     - event => '<parent-directory-name>-event'
     - details => include filename, relative path, and key=value pairs from the row (excluding timestamp)
+    App CSVs are not written in time order, so their events are sorted on disk.
     """
-    timeline = []
+    return timeline_db.sorted_events(_app_events(project_path))
+
+def _app_events(project_path):
+    failed = []
 
     # Walk only one level deep: each app directory directly under apps_root
     for app_dir in sorted(os.listdir(project_path)):
@@ -321,16 +469,19 @@ def process_apps(project_path):
                             
                         
                         print("ts: ", ts, " event: ", event_name, " details: ", details)
-                        timeline.append({
+                        yield {
                             "timestamp": ts,
                             "type": "applications",
                             "event": event_name,
                             "details": details
-                        })
+                        }
             except Exception as e:
                 # keep processing other files
                 print(f"Error reading app CSV {file_path}: {e}")
+                failed.append(rel_path)
                 continue
 
-    return timeline
+    if failed:
+        # the readable files are in the timeline; report the source as failed so the stage reruns
+        raise RuntimeError(f"unreadable app CSVs: {', '.join(failed)}")
 
@@ -0,0 +1,149 @@
+"""
+SHA-256 content-addressed store shared by every project.
+
+projects/.blobs/objects/<aa>/<bb>/<sha256>  holds each distinct file once (read only).
+projects/.blobs/index.db                    maps sha256 -> projects that contain it.
+projects/<name>/processed_data/index.db     blob_catalog maps original path -> sha256.
+
+Files are ingested by the extension stage (analyze/process.py, org_mode
+"blob"), whose workers hash each file while copying it into the store. The
+GUI file browser asks shared_blobs which other projects hold the same bytes.
+"""
+import os
+import sys
+import hashlib
+import shutil
+import sqlite3
+import threading
+from urllib.request import pathname2url
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..',)))
+from addresses import get_address, get_current_project_name
+from databse import index_db
+
+CHUNK_SIZE = 1024 * 1024
+
+
+def hash_file(path):
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        while True:
+            chunk = f.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def blob_path(sha256):
+    return os.path.join(get_address("blob_store"), "objects", sha256[:2], sha256[2:4], sha256)
+
+
+def _copy_hashed(src, dest):
+    """Copy src to dest (data and times) and return the sha256 of the bytes copied."""
+    h = hashlib.sha256()
+    with open(src, "rb") as fin, open(dest, "wb") as fout:
+        for chunk in iter(lambda: fin.read(CHUNK_SIZE), b""):
+            h.update(chunk)
+            fout.write(chunk)
+    shutil.copystat(src, dest)
+    return h.hexdigest()
+
+
+def put_file(path, sha256=None):
+    """
+    Store path under its hash unless identical bytes are already stored.
+    The file is hashed while it is copied; when sha256 (e.g. from the
+    inventory) is given and the bytes no longer match it, nothing is stored
+    and ValueError is raised. Returns (sha256, blob path).
+    """
+    if sha256 is not None and os.path.exists(blob_path(sha256)):
+        # already stored: only read the file to confirm it still has those bytes
+        actual = hash_file(path)
+    else:
+        tmp_dir = os.path.join(get_address("blob_store"), "tmp")
+        os.makedirs(tmp_dir, exist_ok=True)
+        tmp = os.path.join(tmp_dir, "{pid}.{tid}.tmp".format(pid=os.getpid(), tid=threading.get_ident()))
+        try:
+            actual = _copy_hashed(path, tmp)
+            dest = blob_path(actual)
+            if (sha256 is None or actual == sha256) and not os.path.exists(dest):
+                os.chmod(tmp, 0o444)
+                os.makedirs(os.path.dirname(dest), exist_ok=True)
+                os.replace(tmp, dest)
+        finally:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+    if sha256 is not None and actual != sha256:
+        raise ValueError("{path} changed since it was hashed: expected sha256 {e}, read {a}".format(
+            path=path, e=sha256, a=actual))
+    return actual, blob_path(actual)
+
+
+def _global_connect():
+    address = get_address("blob_store")
+    os.makedirs(address, exist_ok=True)
+    conn = sqlite3.connect(os.path.join(address, "index.db"), timeout=60)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS blob_projects (
+        sha256 TEXT NOT NULL,
+        project TEXT NOT NULL,
+        PRIMARY KEY (sha256, project)
+    ) WITHOUT ROWID
+    """)
+    return conn
+
+
+def record(entries, project=None):
+    """
+    Write (path, sha256, size, mtime) rows to the project catalog and register
+    the project against each blob in the shared index.
+    """
+    if project is None:
+        project = get_current_project_name()
+    entries = list(entries)
+    conn = index_db.connect()
+    with conn:
+        conn.executemany("INSERT OR REPLACE INTO blob_catalog(path, sha256, size, mtime) VALUES (?, ?, ?, ?)", entries)
+    conn.close()
+
+    conn = _global_connect()
+    with conn:
+        conn.executemany("INSERT OR IGNORE INTO blob_projects(sha256, project) VALUES (?, ?)",
+                         {(e[1], project) for e in entries})
+    conn.close()
+
+
+def _select_in(conn, query, values):
+    """Rows of query (with one IN ({q}) placeholder) over values, 500 at a time."""
+    values = list(values)
+    for i in range(0, len(values), 500):
+        chunk = values[i:i + 500]
+        yield from conn.execute(query.format(q=",".join("?" * len(chunk))), chunk)
+
+
+def shared_blobs(paths, db_path, project):
+    """
+    {path: (sha256, [other projects])} of the paths among paths catalogued in
+    the project index at db_path, each with the other projects that hold the
+    same blob (one primary key lookup per blob). Opens the databases without
+    creating them, so it is cheap enough for GUI requests.
+    """
+    global_path = os.path.join(get_address("blob_store"), "index.db")
+    if not os.path.exists(db_path) or not os.path.exists(global_path):
+        return {}
+    conn = index_db.open_existing(db_path)
+    try:
+        hashes = dict(_select_in(conn, "SELECT path, sha256 FROM blob_catalog WHERE path IN ({q})", paths))
+    finally:
+        conn.close()
+    conn = sqlite3.connect("file:{0}?mode=ro".format(pathname2url(os.path.abspath(global_path))), uri=True, timeout=60)
+    projects = {}
+    try:
+        for sha256, other in _select_in(conn, "SELECT sha256, project FROM blob_projects WHERE sha256 IN ({q})",
+                                        set(hashes.values())):
+            if other != project:
+                projects.setdefault(sha256, []).append(other)
+    finally:
+        conn.close()
+    return {path: (sha256, sorted(projects.get(sha256, []))) for path, sha256 in hashes.items()}
@@ -4,16 +4,18 @@ import os
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '../..',)))
 from extract import extraction
 from addresses import get_address
+from databse import index_db
 
 
 def create_database():
   #make dir for database
   project_address = get_address("project_dir")
+  index_db.connect().close()
 
   
-def extract_and_save(whole, app_name):
+def extract_and_save(whole, app_name, mode=None):
     project_address = get_address("project_dir")
-    extraction.extract_data(project_address, whole, app_name)
+    return extraction.extract_data(project_address, whole, app_name, mode)
 
 
 ###################################################################################################################
@@ -0,0 +1,151 @@
+"""
+Per-project store of face embeddings, keyed by the SHA-256 of the face crop.
+
+processed_data/face_embeddings.f32  raw float32 rows of EMBEDDING_DIM values (read through np.memmap)
+processed_data/index.db             face_embeddings maps sha256 -> row
+
+Rows are only ever appended, so an embedding is computed once per distinct crop
+and reruns, regrouping and other projects' lookups only read the matrix.
+
+    python databse/face_embeddings.py <face crops dir> [batch sizes]   time per crop vs batched embedding
+"""
+import os
+import sys
+import time
+import tempfile
+import numpy as np
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..',)))
+from addresses import get_address
+from databse import index_db
+from databse.blob_store import hash_file
+
+EMBEDDING_DIM = 512
+MODEL_NAME = "ArcFace"
+ROW_BYTES = EMBEDDING_DIM * 4
+
+
+def store_path():
+    return get_address("project_face_embeddings")
+
+
+def open_matrix(path=None):
+    """The whole embedding file as a read only (rows, EMBEDDING_DIM) memmap."""
+    path = path or store_path()
+    rows = os.path.getsize(path) // ROW_BYTES if os.path.exists(path) else 0
+    if rows == 0:
+        return np.zeros((0, EMBEDDING_DIM), dtype=np.float32)
+    return np.memmap(path, dtype=np.float32, mode="r", shape=(rows, EMBEDDING_DIM))
+
+
+def load_rows(conn):
+    return dict(conn.execute("SELECT sha256, row FROM face_embeddings WHERE model = ?", (MODEL_NAME,)))
+
+
+def get_embeddings(paths, embed, conn=None, path=None, batch_size=256, hashes=None):
+    """
+    L2-normalised embeddings of the face crops in paths, one row per path.
+    embed(paths) returns one embedding per path and is called with batches of
+    up to batch_size crops whose content hash is not stored yet. hashes may
+    pass the crops' SHA-256 when the caller already has them.
+    """
+    own_conn = conn is None
+    if own_conn:
+        conn = index_db.connect()
+    path = path or store_path()
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    rows = load_rows(conn)
+    if hashes is None:
+        hashes = [hash_file(p) for p in paths]
+
+    new = {}
+    with open(path, "ab") as out:
+        # rows are counted from the file itself so a crash between write and commit only leaves unused rows
+        next_row = out.tell() // ROW_BYTES
+        out.seek(next_row * ROW_BYTES)
+        out.truncate()
+        missing = {}
+        for p, sha in zip(paths, hashes):
+            if sha not in rows and sha not in missing:
+                missing[sha] = p
+        missing = list(missing.items())
+        for first in range(0, len(missing), batch_size):
+            batch = missing[first:first + batch_size]
+            vectors = np.asarray(embed([p for _, p in batch]), dtype=np.float32).reshape(len(batch), EMBEDDING_DIM)
+            out.write(vectors.tobytes())
+            out.flush()
+            pending = []
+            for sha, _ in batch:
+                new[sha] = next_row
+                pending.append((sha, next_row, MODEL_NAME))
+                next_row += 1
+            conn.executemany("INSERT OR REPLACE INTO face_embeddings (sha256, row, model) VALUES (?, ?, ?)", pending)
+            conn.commit()
+    if new:
+        print("face embeddings: {n} computed, {c} reused".format(n=len(new), c=len(paths) - len(new)))
+    rows.update(new)
+    if own_conn:
+        conn.close()
+
+    matrix = open_matrix(path)
+    vectors = np.array(matrix[[rows[sha] for sha in hashes]], dtype=np.float32) if paths else np.zeros((0, EMBEDDING_DIM), dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    norms[norms == 0] = 1
+    return vectors / norms
+
+
+def save_centroids(conn, rows):
+    """Replace the identity centroids with rows of (identity, size, sample_path, centroid vector)."""
+    conn.execute("DELETE FROM identity_centroids")
+    conn.executemany("INSERT INTO identity_centroids (identity, size, sample_path, centroid) VALUES (?, ?, ?, ?)",
+                     [(identity, size, sample, np.asarray(centroid, dtype=np.float32).tobytes())
+                      for identity, size, sample, centroid in rows])
+    conn.commit()
+
+
+def load_centroids(conn):
+    """(identities, sizes, sample paths, (n, EMBEDDING_DIM) matrix of unit centroids) of a project."""
+    rows = conn.execute("SELECT identity, size, sample_path, centroid FROM identity_centroids ORDER BY identity").fetchall()
+    if not rows:
+        return [], [], [], np.zeros((0, EMBEDDING_DIM), dtype=np.float32)
+    matrix = np.vstack([np.frombuffer(row[3], dtype=np.float32) for row in rows])
+    return [row[0] for row in rows], [row[1] for row in rows], [row[2] for row in rows], matrix
+
+
+def benchmark(crops_dir, batch_sizes=(1, 8, 32, 64), limit=1024):
+    """
+    Embed up to limit face crops of crops_dir (processed_data/faces) into a
+    scratch store with the in-process model: once one DeepFace.represent call
+    per crop as before, then with each image_utils.embed_batch_size. Prints
+    crops/s and the largest difference to the per-crop embeddings.
+    """
+    from deepface import DeepFace
+    from util import image_utils
+    image_utils.use_service = False
+    paths = sorted(os.path.join(crops_dir, name) for name in os.listdir(crops_dir)
+                   if name.lower().endswith((".jpg", ".png")))[:limit]
+    hashes = [hash_file(p) for p in paths]
+
+    def per_crop(batch):
+        return [DeepFace.represent(img_path=p, model_name="ArcFace", detector_backend="skip",
+                                   enforce_detection=False)[0]["embedding"] for p in batch]
+
+    # load the model outside the timings
+    per_crop(paths[:1])
+    reference = None
+    for label, embed, batch_size in [("per crop", per_crop, None)] + [
+            ("batch " + str(b), image_utils.represent_faces, b) for b in batch_sizes]:
+        image_utils.embed_batch_size = batch_size
+        with tempfile.TemporaryDirectory() as scratch:
+            conn = index_db.connect(os.path.join(scratch, "index.db"))
+            start = time.time()
+            vectors = get_embeddings(paths, embed, conn=conn, path=os.path.join(scratch, "face_embeddings.f32"), hashes=hashes)
+            elapsed = max(time.time() - start, 1e-9)
+            conn.close()
+        if reference is None:
+            reference = vectors
+        print("{label}: {n} crops in {sec:.2f}s ({cps:.1f} crops/s), max difference {d:.1e}".format(
+            label=label, n=len(paths), sec=elapsed, cps=len(paths) / elapsed, d=float(np.abs(vectors - reference).max(initial=0))))
+
+
+if __name__ == '__main__':
+    benchmark(sys.argv[1], [int(b) for b in sys.argv[2].split(",")] if len(sys.argv) > 2 else (1, 8, 32, 64))
@@ -0,0 +1,337 @@
+"""
+Approximate nearest neighbour index over the face embeddings of every project.
+
+projects/.face_index/centroids-<g>.npy  coarse centroids (IVF) once enough faces are indexed
+projects/.face_index/lists/<g>-<k>.f16  float16 embeddings assigned to centroid k, append only
+projects/.face_index/index.db           faces: (project, sha256) -> face name, identity, list, row
+
+<g> is the generation in meta, bumped by every retraining (generation 0, before
+the first one, uses centroids.npy and lists/<k>.f16).
+
+Projects are added incrementally with add_project when their face stage
+finishes. Until train_size faces are indexed everything lives in list 0 and a
+search is exact; then spherical k-means picks the coarse centroids, the lists
+are rebuilt, and a search only scans the nprobe closest lists. Faces whose
+crop or project was deleted are dropped by add_project.
+"""
+import os
+import sys
+import time
+import fcntl
+import sqlite3
+import numpy as np
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..',)))
+from addresses import get_address, get_current_project_name
+from databse import face_embeddings
+
+DIM = face_embeddings.EMBEDDING_DIM
+ROW_BYTES = DIM * 2
+train_size = 20000
+# retrain when the index has grown this many times since the last training
+retrain_growth = 8
+nprobe = 16
+
+SCHEMA = [
+    "CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)",
+    """
+    CREATE TABLE IF NOT EXISTS faces (
+        id INTEGER PRIMARY KEY,
+        project TEXT NOT NULL,
+        sha256 TEXT NOT NULL,
+        name TEXT NOT NULL,
+        identity INTEGER,
+        list INTEGER NOT NULL,
+        row INTEGER NOT NULL,
+        UNIQUE (project, sha256)
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS faces_list_row ON faces(list, row)",
+]
+
+
+def index_dir():
+    return get_address("face_index")
+
+
+def connect():
+    os.makedirs(os.path.join(index_dir(), "lists"), exist_ok=True)
+    conn = sqlite3.connect(os.path.join(index_dir(), "index.db"), timeout=60, check_same_thread=False)
+    conn.execute("PRAGMA journal_mode=WAL")
+    for statement in SCHEMA:
+        conn.execute(statement)
+    conn.commit()
+    return conn
+
+
+class _Lock:
+    """
+    Lock on the index directory: exclusive while inserting or retraining,
+    shared while searching, so a search never reads lists being rebuilt.
+    """
+
+    def __init__(self, shared=False):
+        self.mode = fcntl.LOCK_SH if shared else fcntl.LOCK_EX
+
+    def __enter__(self):
+        os.makedirs(index_dir(), exist_ok=True)
+        self.f = open(os.path.join(index_dir(), "lock"), "a")
+        fcntl.flock(self.f, self.mode)
+        return self
+
+    def __exit__(self, *exc):
+        fcntl.flock(self.f, fcntl.LOCK_UN)
+        self.f.close()
+
+
+def _generation(conn):
+    """Generation of the lists and centroids the faces rows point into; _retrain starts a new one."""
+    row = conn.execute("SELECT value FROM meta WHERE key = 'generation'").fetchone()
+    return int(row[0]) if row else 0
+
+
+def _generation_of(name):
+    """Generation of a lists/ file name."""
+    return int(name.split("-")[0]) if "-" in name else 0
+
+
+def _list_path(k, generation=0):
+    name = "{k}.f16" if generation == 0 else "{g}-{k}.f16"
+    return os.path.join(index_dir(), "lists", name.format(g=generation, k=k))
+
+
+def _list_matrix(k, generation=0):
+    path = _list_path(k, generation)
+    rows = os.path.getsize(path) // ROW_BYTES if os.path.exists(path) else 0
+    if rows == 0:
+        return np.zeros((0, DIM), dtype=np.float16)
+    return np.memmap(path, dtype=np.float16, mode="r", shape=(rows, DIM))
+
+
+def _centroids_path(generation=0):
+    name = "centroids.npy" if generation == 0 else "centroids-{g}.npy".format(g=generation)
+    return os.path.join(index_dir(), name)
+
+
+def load_centroids(generation=0):
+    path = _centroids_path(generation)
+    if not os.path.exists(path):
+        return None
+    return np.load(path)
+
+
+def _assign(vectors, centroids, block=65536):
+    if centroids is None:
+        return np.zeros(len(vectors), dtype=np.int64)
+    return np.concatenate([np.argmax(vectors[i:i + block] @ centroids.T, axis=1)
+                           for i in range(0, len(vectors), block)] or [np.zeros(0, dtype=np.int64)])
+
+
+def _append(conn, vectors, meta, centroids, generation=0):
+    """Append unit vectors with their (project, sha256, name, identity) to the lists they fall in."""
+    lists = _assign(vectors, centroids)
+    rows = []
+    for k in np.unique(lists):
+        members = np.flatnonzero(lists == k)
+        with open(_list_path(k, generation), "ab") as out:
+            out.seek(0, os.SEEK_END)
+            start = out.tell() // ROW_BYTES
+            out.write(vectors[members].astype(np.float16).tobytes())
+        for offset, i in enumerate(members):
+            rows.append(meta[i] + (int(k), start + offset))
+    conn.executemany("INSERT OR REPLACE INTO faces (project, sha256, name, identity, list, row) VALUES (?, ?, ?, ?, ?, ?)", rows)
+
+
+def _kmeans(vectors, k, iterations=10, seed=0):
+    """Spherical k-means: unit centroids maximising cosine similarity."""
+    rng = np.random.default_rng(seed)
+    centroids = vectors[rng.choice(len(vectors), k, replace=False)].copy()
+    for _ in range(iterations):
+        labels = _assign(vectors, centroids)
+        order = np.argsort(labels, kind="stable")
+        present, starts = np.unique(labels[order], return_index=True)
+        sums = np.zeros_like(centroids)
+        sums[present] = np.add.reduceat(vectors[order], starts, axis=0)
+        empty = np.linalg.norm(sums, axis=1) == 0
+        sums[empty] = vectors[rng.choice(len(vectors), int(empty.sum()), replace=False)]
+        centroids = sums / np.linalg.norm(sums, axis=1, keepdims=True)
+    return centroids.astype(np.float32)
+
+
+def _vectors(rows, generation, block=16384):
+    """Yield (vectors, rows) blocks of at most block indexed faces, rows being faces rows ordered by list, row."""
+    for first in range(0, len(rows), block):
+        chunk = rows[first:first + block]
+        lists = np.array([row[4] for row in chunk], dtype=np.int64)
+        positions = np.array([row[5] for row in chunk], dtype=np.int64)
+        vectors = np.empty((len(chunk), DIM), dtype=np.float32)
+        for k in np.unique(lists):
+            members = np.flatnonzero(lists == k)
+            vectors[members] = _list_matrix(int(k), generation)[positions[members]]
+        yield vectors, chunk
+
+
+def _retrain(conn):
+    """
+    Train new coarse centroids on a sample of the indexed faces and rebuild
+    the lists block by block as a new generation. The old lists are only
+    deleted once the rows pointing into the new ones are committed.
+    """
+    start = time.time()
+    old = _generation(conn)
+    new = old + 1
+    lists_dir = os.path.join(index_dir(), "lists")
+    # lists of a retraining that died before its commit
+    for name in os.listdir(lists_dir):
+        if _generation_of(name) == new:
+            os.remove(os.path.join(lists_dir, name))
+    rows = conn.execute("SELECT project, sha256, name, identity, list, row FROM faces ORDER BY list, row").fetchall()
+    n_lists = int(min(4096, max(16, np.sqrt(len(rows)))))
+    picked = np.sort(np.random.default_rng(0).choice(len(rows), min(len(rows), 32 * n_lists), replace=False))
+    sample = np.concatenate([vectors for vectors, _ in _vectors([rows[i] for i in picked], old)])
+    centroids = _kmeans(sample, n_lists)
+    del sample
+
+    np.save(_centroids_path(new), centroids)
+    conn.execute("DELETE FROM faces")
+    for vectors, chunk in _vectors(rows, old):
+        _append(conn, vectors, [row[:4] for row in chunk], centroids, new)
+    conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('generation', ?)", (str(new),))
+    conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('trained_size', ?)", (str(len(rows)),))
+    conn.commit()
+
+    for name in os.listdir(lists_dir):
+        if _generation_of(name) == old:
+            os.remove(os.path.join(lists_dir, name))
+    if os.path.exists(_centroids_path(old)):
+        os.remove(_centroids_path(old))
+    print("face index: trained {k} lists on {n} of {t} faces in {sec:.1f}s".format(
+        k=n_lists, n=len(picked), t=len(rows), sec=time.time() - start))
+
+
+def _prune_projects(conn):
+    """Drop the faces of projects whose directory was deleted. Returns those projects."""
+    projects = [project for (project,) in conn.execute("SELECT DISTINCT project FROM faces")]
+    gone = [project for project in projects if not os.path.isdir(os.path.join(get_address("projects_dir"), project))]
+    conn.executemany("DELETE FROM faces WHERE project = ?", [(project,) for project in gone])
+    return gone
+
+
+def add_project(project_db=None, embeddings_path=None):
+    """
+    Bring the current project's faces in the index in line with its latest
+    clustering: insert the faces not indexed yet, refresh the identity of
+    those that are, and drop those whose crop is gone. Faces of deleted
+    projects are dropped too. Returns the number of faces added.
+    """
+    project_name = get_current_project_name()
+    project_db = project_db or get_address("project_index_db")
+    embeddings_path = embeddings_path or get_address("project_face_embeddings")
+    source = sqlite3.connect(project_db)
+    rows = source.execute(
+        "SELECT c.path, c.sha256, c.identity, e.row FROM face_clusters c "
+        "JOIN face_embeddings e ON e.sha256 = c.sha256 AND e.model = ?", (face_embeddings.MODEL_NAME,)).fetchall()
+    source.close()
+    rows = [row for row in rows if os.path.exists(row[0])]
+    current = {row[1] for row in rows}
+
+    with _Lock():
+        conn = connect()
+        _prune_projects(conn)
+        known = {sha for (sha,) in conn.execute("SELECT sha256 FROM faces WHERE project = ?", (project_name,))}
+        # their vectors stay in the lists, unreachable, until the next retraining
+        conn.executemany("DELETE FROM faces WHERE project = ? AND sha256 = ?",
+                         [(project_name, sha) for sha in known - current])
+        # faces indexed before only follow the project's latest clustering
+        conn.executemany("UPDATE faces SET identity = ? WHERE project = ? AND sha256 = ?",
+                         [(identity, project_name, sha) for _, sha, identity, _ in rows if sha in known])
+        rows = [row for row in rows if row[1] not in known]
+        if rows:
+            matrix = face_embeddings.open_matrix(embeddings_path)
+            vectors = np.array(matrix[[row[3] for row in rows]], dtype=np.float32)
+            vectors /= np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+            meta = [(project_name, sha, os.path.basename(path), identity) for path, sha, identity, _ in rows]
+            generation = _generation(conn)
+            _append(conn, vectors, meta, load_centroids(generation), generation)
+        conn.commit()
+        total = conn.execute("SELECT count(*) FROM faces").fetchone()[0]
+        trained = conn.execute("SELECT value FROM meta WHERE key = 'trained_size'").fetchone()
+        if total >= train_size and (trained is None or total >= retrain_growth * int(trained[0])):
+            _retrain(conn)
+        conn.close()
+    print("face index: {n} faces of {p} added, {t} indexed".format(n=len(rows), p=project_name, t=total))
+    return len(rows)
+
+
+def search(vector, k=20, probes=None, conn=None):
+    """
+    The k indexed faces closest to vector by cosine distance, as dicts with
+    project, name, identity, sha256 and distance, best first.
+    """
+    probes = probes or nprobe
+    own_conn = conn is None
+    if own_conn:
+        conn = connect()
+    query = np.asarray(vector, dtype=np.float32).reshape(DIM)
+    # a new array: the caller's vector is not normalised in place
+    query = query / (np.linalg.norm(query) or 1)
+    results = []
+    with _Lock(shared=True):
+        generation = _generation(conn)
+        centroids = load_centroids(generation)
+        if centroids is None:
+            lists = [0]
+        else:
+            lists = np.argsort(-(centroids @ query))[:probes].tolist()
+
+        candidates = []
+        for lst in lists:
+            matrix = _list_matrix(lst, generation)
+            if len(matrix) == 0:
+                continue
+            distances = 1 - np.asarray(matrix, dtype=np.float32) @ query
+            top = np.argsort(distances)[:k]
+            candidates.extend((float(distances[row]), lst, int(row)) for row in top)
+        candidates.sort()
+        for distance, lst, row in candidates[:k]:
+            found = conn.execute("SELECT project, name, identity, sha256 FROM faces WHERE list = ? AND row = ?", (lst, row)).fetchone()
+            if found is None:
+                continue
+            results.append({"project": found[0], "name": found[1], "identity": found[2], "sha256": found[3], "distance": distance})
+    if own_conn:
+        conn.close()
+    return results
+
+
+def benchmark(n=1000000, identities=50000, queries=20, seed=0):
+    """
+    Index n synthetic faces of the given number of identities (run it from a
+    scratch directory) and time insertion, training and search, with recall@1
+    for noisy copies of indexed faces.
+    """
+    rng = np.random.default_rng(seed)
+    centers = rng.standard_normal((identities, DIM)).astype(np.float32)
+    conn = connect()
+    start = time.time()
+    for first in range(0, n, 100000):
+        count = min(100000, n - first)
+        vectors = centers[rng.integers(0, identities, count)] + 0.4 * rng.standard_normal((count, DIM)).astype(np.float32)
+        vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+        meta = [("bench", "sha{i}".format(i=first + i), "face-{i}.jpg".format(i=first + i), 0) for i in range(count)]
+        generation = _generation(conn)
+        _append(conn, vectors, meta, load_centroids(generation), generation)
+        conn.commit()
+    probe_vectors = vectors[:queries] + 0.01 * rng.standard_normal((queries, DIM)).astype(np.float32)
+    _retrain(conn)
+    print("insert + train: {sec:.1f}s".format(sec=time.time() - start))
+    start = time.time()
+    hits = 0
+    for i in range(queries):
+        found = search(probe_vectors[i], k=1, conn=conn)
+        hits += bool(found) and found[0]["sha256"] == "sha{i}".format(i=first + i)
+    print("search: {ms:.1f} ms/query over {n} faces, recall@1 {r:.2f}".format(
+        ms=(time.time() - start) / queries * 1000, n=n, r=hits / queries))
+    conn.close()
+
+
+if __name__ == '__main__':
+    benchmark(int(sys.argv[1]) if len(sys.argv) > 1 else 1000000)
@@ -0,0 +1,216 @@
+import os
+import sys
+import sqlite3
+from urllib.request import pathname2url
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..',)))
+from addresses import get_address
+
+# Spelling variants folded together in the full-text index (and in queries):
+# Arabic yeh, alef maksura and kaf to their Persian forms, hamzated alefs to
+# alef, harakat and tatweel dropped, zero-width non-joiner as a word break.
+SEARCH_FOLD = [("\u064a", "\u06cc"), ("\u0649", "\u06cc"), ("\u0643", "\u06a9"),
+               ("\u0623", "\u0627"), ("\u0625", "\u0627"), ("\u0622", "\u0627"),
+               ("\u0640", ""), ("\u200c", " ")] + [(chr(c), "") for c in range(0x064b, 0x0653)]
+
+
+def fold_search_text(text):
+    """text with SEARCH_FOLD applied, as stored in timeline_fts."""
+    for old, new in SEARCH_FOLD:
+        text = text.replace(old, new)
+    return text
+
+
+def _folded_sql(expr):
+    for old, new in SEARCH_FOLD:
+        expr = "replace({0}, '{1}', '{2}')".format(expr, old, new)
+    return expr
+
+
+# Tables of the per-project index database (processed_data/index.db).
+SCHEMA = [
+    """
+    CREATE TABLE IF NOT EXISTS blob_catalog (
+        path TEXT PRIMARY KEY,
+        sha256 TEXT NOT NULL,
+        size INTEGER NOT NULL,
+        mtime REAL
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS blob_catalog_sha256 ON blob_catalog(sha256)",
+    """
+    CREATE TABLE IF NOT EXISTS files (
+        path TEXT PRIMARY KEY,
+        size INTEGER NOT NULL,
+        mtime REAL NOT NULL,
+        ctime REAL,
+        type TEXT NOT NULL,
+        type_source TEXT NOT NULL,
+        sha256 TEXT,
+        exif_datetime TEXT,
+        capture_time INTEGER,
+        latitude REAL,
+        longitude REAL
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS files_type ON files(type)",
+    "CREATE INDEX IF NOT EXISTS files_sha256 ON files(sha256)",
+    "CREATE INDEX IF NOT EXISTS files_mtime ON files(mtime)",
+    """
+    CREATE TABLE IF NOT EXISTS stage_inputs (
+        stage TEXT NOT NULL,
+        path TEXT NOT NULL,
+        size INTEGER NOT NULL,
+        mtime REAL NOT NULL,
+        sha256 TEXT,
+        processed_at REAL NOT NULL,
+        PRIMARY KEY (stage, path)
+    ) WITHOUT ROWID
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS checkpoints (
+        stage TEXT PRIMARY KEY,
+        status TEXT NOT NULL,
+        fingerprint TEXT,
+        started_at REAL,
+        finished_at REAL,
+        processed INTEGER,
+        skipped INTEGER
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS face_embeddings (
+        sha256 TEXT PRIMARY KEY,
+        row INTEGER NOT NULL,
+        model TEXT NOT NULL
+    ) WITHOUT ROWID
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS face_clusters (
+        path TEXT PRIMARY KEY,
+        sha256 TEXT,
+        identity INTEGER NOT NULL,
+        distance REAL
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS face_clusters_identity ON face_clusters(identity)",
+    """
+    CREATE TABLE IF NOT EXISTS identity_centroids (
+        identity INTEGER PRIMARY KEY,
+        size INTEGER NOT NULL,
+        sample_path TEXT,
+        centroid BLOB NOT NULL
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS image_hashes (
+        path TEXT PRIMARY KEY,
+        size INTEGER NOT NULL,
+        mtime REAL NOT NULL,
+        dhash INTEGER,
+        pixels INTEGER
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS image_duplicates (
+        path TEXT PRIMARY KEY,
+        representative TEXT NOT NULL,
+        distance INTEGER
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS image_duplicates_representative ON image_duplicates(representative)",
+    """
+    CREATE TABLE IF NOT EXISTS video_faces (
+        crop TEXT PRIMARY KEY,
+        video TEXT NOT NULL,
+        timestamp_ms INTEGER NOT NULL,
+        frame INTEGER,
+        x INTEGER,
+        y INTEGER,
+        w INTEGER,
+        h INTEGER,
+        confidence REAL
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS video_faces_video ON video_faces(video)",
+    """
+    CREATE TABLE IF NOT EXISTS timeline (
+        id INTEGER PRIMARY KEY,
+        timestamp REAL,
+        type TEXT NOT NULL,
+        event TEXT,
+        details TEXT,
+        source TEXT NOT NULL,
+        provenance TEXT
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS timeline_timestamp ON timeline(timestamp)",
+    "CREATE INDEX IF NOT EXISTS timeline_type ON timeline(type, timestamp)",
+    "CREATE INDEX IF NOT EXISTS timeline_source ON timeline(source, timestamp)",
+    # full-text index of the timeline, rowid = timeline.id, kept up to date by the triggers below
+    """
+    CREATE VIRTUAL TABLE IF NOT EXISTS timeline_fts USING fts5(
+        event, details, tokenize = 'unicode61 remove_diacritics 2'
+    )
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS timeline_fts_insert AFTER INSERT ON timeline BEGIN
+        INSERT INTO timeline_fts (rowid, event, details) VALUES (new.id, {event}, {details});
+    END
+    """.format(event=_folded_sql("new.event"), details=_folded_sql("new.details")),
+    """
+    CREATE TRIGGER IF NOT EXISTS timeline_fts_delete AFTER DELETE ON timeline BEGIN
+        DELETE FROM timeline_fts WHERE rowid = old.id;
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS timeline_fts_update AFTER UPDATE OF event, details ON timeline BEGIN
+        UPDATE timeline_fts SET event = {event}, details = {details} WHERE rowid = new.id;
+    END
+    """.format(event=_folded_sql("new.event"), details=_folded_sql("new.details")),
+]
+
+
+def connect(db_path=None):
+    """Open (and create if needed) the project index database."""
+    if db_path is None:
+        db_path = get_address("project_index_db")
+    os.makedirs(os.path.dirname(db_path) or ".", exist_ok=True)
+    conn = sqlite3.connect(db_path, timeout=60, check_same_thread=False)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    for statement in SCHEMA:
+        conn.execute(statement)
+    conn.commit()
+    _migrate(conn)
+    return conn
+
+
+def open_existing(db_path=None):
+    """
+    Open a project index database that connect has already created and
+    migrated, without running the schema and migrations again (the GUI opens
+    one per request). Raises sqlite3.OperationalError when it does not exist.
+    """
+    if db_path is None:
+        db_path = get_address("project_index_db")
+    return sqlite3.connect("file:{0}?mode=rw".format(pathname2url(os.path.abspath(db_path))), uri=True,
+                           timeout=60, check_same_thread=False)
+
+
+def _migrate(conn):
+    """One-time data migrations, tracked by PRAGMA user_version."""
+    version = conn.execute("PRAGMA user_version").fetchone()[0]
+    if version < 1:
+        # timeline rows stored before timeline_fts and its triggers existed
+        conn.create_function("fold_search_text", 1, lambda text: None if text is None else fold_search_text(text),
+                             deterministic=True)
+        conn.execute("INSERT INTO timeline_fts (rowid, event, details) "
+                     "SELECT id, fold_search_text(event), fold_search_text(details) FROM timeline "
+                     "WHERE id NOT IN (SELECT rowid FROM timeline_fts)")
+        conn.execute("PRAGMA user_version = 1")
+        conn.commit()
+    if version < 2:
+        # duplicate_crops only repeated image_duplicates (a member's faces are its representative's crops)
+        conn.execute("DROP TABLE IF EXISTS duplicate_crops")
+        conn.execute("PRAGMA user_version = 2")
+        conn.commit()
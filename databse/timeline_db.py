@@ -0,0 +1,476 @@
+"""
+Timeline events of a project, stored in the timeline table of processed_data/index.db.
+
+Each row is one event: unix timestamp (NULL when unknown), type, event name,
+details, the timeline source that produced it (contacts, sms, media, apps,
+locations, ...) and the provenance of its time (EXIF, Filesystem). Indexes on
+timestamp, (type, timestamp) and (source, timestamp) let the GUI read a time
+range, a type or a source without scanning the whole timeline. Sources are
+replaced or appended independently, and export_csv writes the old
+combined/timeline.csv layout for external tools.
+
+process_timeline hands every source over as a generator of events in time
+order and replace_merged streams their k-way merge into a temporary table
+and swaps it in, so memory stays at one pending event per source whatever
+the size of the timeline.
+Sources that cannot read their events in order go through sorted_events,
+which sorts them in a temporary on-disk database.
+
+The details and event names are also in the timeline_fts full-text index,
+which the index_db triggers keep in step with the table (rows stored before
+the index existed are added once by index_db.connect), so search finds a
+keyword in SMS bodies, app messages and calendar descriptions alike.
+"""
+import os
+import re
+import sys
+import csv
+import time
+import heapq
+import sqlite3
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..',)))
+from databse import index_db
+
+COLUMNS = ["timestamp", "type", "event", "details", "source", "provenance"]
+INSERT = "INSERT INTO timeline (timestamp, type, event, details, source, provenance) VALUES (?, ?, ?, ?, ?, ?)"
+
+
+def _timestamp(value):
+    if value is None or value == "":
+        return None
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def _row(source, event):
+    return (_timestamp(event.get("timestamp")), event.get("type") or source, event.get("event"),
+            event.get("details"), source, event.get("source"))
+
+
+def _csv_row(event):
+    timestamp = event.get("timestamp")
+    return ["" if timestamp is None else timestamp, event.get("type"), event.get("event"), event.get("details")]
+
+
+def _insert(conn, rows, batch_size, insert=INSERT):
+    count = 0
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= batch_size:
+            conn.executemany(insert, batch)
+            count += len(batch)
+            batch = []
+    if batch:
+        conn.executemany(insert, batch)
+        count += len(batch)
+    conn.commit()
+    return count
+
+
+def append(conn, source, events, batch_size=10000):
+    """Append timeline event dicts (timestamp, type, event, details[, source]) under source. Returns the count."""
+    return _insert(conn, (_row(source, event) for event in events), batch_size)
+
+
+def replace_source(conn, source, events):
+    """Replace every event of source with events in one transaction. Returns the count."""
+    conn.execute("DELETE FROM timeline WHERE source = ?", (source,))
+    return append(conn, source, events)
+
+
+def sort_key(event):
+    """Merge order of an event: unknown times first, as in the timestamp index."""
+    timestamp = _timestamp(event.get("timestamp"))
+    return (timestamp is not None, timestamp or 0.0)
+
+
+def sorted_events(events, batch_size=10000):
+    """
+    Yield events in time order, sorted in a temporary on-disk SQLite database
+    rather than in memory. For sources whose files are not written in order.
+    If reading events raises, the events read before are still yielded and
+    the error is raised after them.
+    """
+    tmp = sqlite3.connect("")
+    error = None
+    try:
+        tmp.execute("CREATE TABLE events (key REAL, timestamp, type, event, details, source)")
+        rows = ((_timestamp(e.get("timestamp")), e.get("timestamp"), e.get("type"), e.get("event"),
+                 e.get("details"), e.get("source")) for e in events)
+        batch = []
+        try:
+            for row in rows:
+                batch.append(row)
+                if len(batch) >= batch_size:
+                    tmp.executemany("INSERT INTO events VALUES (?, ?, ?, ?, ?, ?)", batch)
+                    batch = []
+        except Exception as e:
+            error = e
+        tmp.executemany("INSERT INTO events VALUES (?, ?, ?, ?, ?, ?)", batch)
+        for timestamp, kind, event, details, source in tmp.execute(
+                "SELECT timestamp, type, event, details, source FROM events ORDER BY key, rowid"):
+            event = {"timestamp": timestamp, "type": kind, "event": event, "details": details}
+            if source is not None:
+                event["source"] = source
+            yield event
+        if error is not None:
+            raise error
+    finally:
+        tmp.close()
+
+
+def _tagged(source, events):
+    for event in events:
+        yield source, event
+
+
+def merge(sources):
+    """Merge {source: events in time order} into one time-ordered stream of (source, event)."""
+    return heapq.merge(*[_tagged(source, events) for source, events in sources.items()],
+                       key=lambda item: sort_key(item[1]))
+
+
+STAGE = "INSERT INTO temp.timeline_staging (timestamp, type, event, details, source, provenance) VALUES (?, ?, ?, ?, ?, ?)"
+
+
+def _swap(conn, sources, count, batch_size):
+    """Replace the events of sources with the staged rows, batch_size rows per transaction."""
+    names = list(sources)
+    while True:
+        deleted = conn.execute("DELETE FROM timeline WHERE id IN (SELECT id FROM timeline WHERE source IN ({0}) LIMIT ?)".format(
+            ",".join("?" * len(names))), names + [batch_size]).rowcount
+        conn.commit()
+        if deleted < batch_size:
+            break
+    for first in range(0, count, batch_size):
+        conn.execute("INSERT INTO timeline (timestamp, type, event, details, source, provenance) "
+                     "SELECT timestamp, type, event, details, source, provenance FROM temp.timeline_staging "
+                     "WHERE rowid > ? AND rowid <= ? ORDER BY rowid", (first, first + batch_size))
+        conn.commit()
+
+
+def replace_merged(conn, sources, csv_path=None, batch_size=10000):
+    """
+    Replace the events of every source in sources ({source: events in time
+    order}) with their k-way merge, also written to csv_path in the
+    combined/timeline.csv layout when given. Returns the number of events.
+
+    The merge is staged in a temporary table, which does not lock the project
+    database, so stages writing to index.db meanwhile are not held up for as
+    long as the sources take to read, and the old events stay in place if
+    the merge fails. The staged rows are then swapped in, in timestamp order
+    (the indexes are only appended to), in transactions of batch_size rows.
+    """
+    conn.commit()
+    conn.execute("DROP TABLE IF EXISTS temp.timeline_staging")
+    conn.execute("CREATE TEMP TABLE timeline_staging (timestamp REAL, type TEXT, event TEXT, details TEXT, source TEXT, provenance TEXT)")
+    try:
+        if csv_path is None:
+            count = _insert(conn, (_row(source, event) for source, event in merge(sources)), batch_size, STAGE)
+        else:
+            os.makedirs(os.path.dirname(csv_path) or ".", exist_ok=True)
+            with open(csv_path, "w", newline="", encoding="utf-8") as f:
+                writer = csv.writer(f)
+                writer.writerow(["timestamp", "type", "event", "details"])
+
+                def rows():
+                    for source, event in merge(sources):
+                        writer.writerow(_csv_row(event))
+                        yield _row(source, event)
+                count = _insert(conn, rows(), batch_size, STAGE)
+        _swap(conn, sources, count, batch_size)
+    finally:
+        conn.rollback()
+        conn.execute("DROP TABLE IF EXISTS temp.timeline_staging")
+    return count
+
+
+def _filters(start=None, end=None, types=None, sources=None, events=None, contains=None):
+    where = []
+    args = []
+    if start is not None:
+        where.append("timestamp >= ?")
+        args.append(start)
+    if end is not None:
+        where.append("timestamp < ?")
+        args.append(end)
+    for column, values in (("type", types), ("source", sources), ("event", events)):
+        if values:
+            where.append("{0} IN ({1})".format(column, ",".join("?" * len(values))))
+            args.extend(values)
+    if contains:
+        pattern = "%" + contains.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%"
+        where.append("(details LIKE ? ESCAPE '\\' OR event LIKE ? ESCAPE '\\')")
+        args.extend([pattern, pattern])
+    return where, args
+
+
+def _select(conn, where, args, order, limit=None, offset=0):
+    sql = "SELECT id, timestamp, type, event, details, source, provenance FROM timeline"
+    if where:
+        sql += " WHERE " + " AND ".join(where)
+    sql += " ORDER BY " + order
+    if limit is not None:
+        sql += " LIMIT ? OFFSET ?"
+        args = args + [limit, offset]
+    for row in conn.execute(sql, args):
+        yield dict(zip(["id"] + COLUMNS, row))
+
+
+def query(conn, start=None, end=None, types=None, sources=None, descending=True, limit=None, offset=0):
+    """
+    Yield event dicts with a timestamp in [start, end), of one of types and
+    sources when given, newest first unless descending is False. Events
+    without a timestamp sort as the oldest.
+    """
+    where, args = _filters(start, end, types, sources)
+    # (timestamp, id) is the order of the timestamp index, so no sort is needed
+    return _select(conn, where, args, "timestamp {0}, id {0}".format("DESC" if descending else "ASC"), limit, offset)
+
+
+def page(conn, limit=100, after=None, start=None, end=None, types=None, sources=None, events=None, contains=None):
+    """
+    One page of events, newest first, with keyset pagination: after is the
+    (timestamp, id) of the last event of the previous page. Returns (events,
+    the key of the next page or None). Each page is a range read on the
+    timestamp index from that key, so page N costs the same as page 1.
+    Events without a timestamp follow all the others, by id.
+    """
+    where, args = _filters(start, end, types, sources, events, contains)
+    found = []
+    if after is None or after[0] is not None:
+        dated = where + ["timestamp IS NOT NULL"]
+        dated_args = list(args)
+        if after is not None:
+            dated += ["timestamp <= ?", "(timestamp < ? OR id < ?)"]
+            dated_args += [after[0], after[0], after[1]]
+        found = list(_select(conn, dated, dated_args, "timestamp DESC, id DESC", limit + 1))
+    if len(found) <= limit and start is None and end is None:
+        undated = where + ["timestamp IS NULL"]
+        undated_args = list(args)
+        if after is not None and after[0] is None:
+            undated.append("id < ?")
+            undated_args.append(after[1])
+        found += list(_select(conn, undated, undated_args, "id DESC", limit + 1 - len(found)))
+    if len(found) <= limit:
+        return found, None
+    found = found[:limit]
+    return found, (found[-1]["timestamp"], found[-1]["id"])
+
+
+# markers put around matched terms; the GUI escapes the text and turns them into <mark>
+HIGHLIGHT = ("\x02", "\x03")
+
+
+def _highlight_original(original, highlighted):
+    """
+    original (as stored in timeline) with the HIGHLIGHT markers that
+    highlight() put in its folded copy, so the analyst sees the evidence
+    unaltered. SEARCH_FOLD maps single characters, which lets each folded
+    position be traced back to the character it came from; dropped marks
+    after a match stay inside it. Unmarked original if the two disagree.
+    """
+    if original is None or highlighted is None:
+        return original
+    original = str(original)
+    fold = dict(index_db.SEARCH_FOLD)
+    # origin[i] is the index in original of the i-th folded character
+    origin = []
+    for i, char in enumerate(original):
+        origin.extend([i] * len(fold.get(char, char)))
+    spans = []
+    folded = []
+    for char in highlighted:
+        if char == HIGHLIGHT[0]:
+            spans.append([len(folded), None])
+        elif char == HIGHLIGHT[1] and spans:
+            spans[-1][1] = len(folded)
+        else:
+            folded.append(char)
+    if len(folded) != len(origin) or any(end is None or end <= begin for begin, end in spans):
+        return original
+    parts = []
+    done = 0
+    for begin, end in spans:
+        begin, end = origin[begin], origin[end - 1] + 1
+        while end < len(original) and fold.get(original[end]) == "":
+            end += 1
+        parts += [original[done:begin], HIGHLIGHT[0], original[begin:end], HIGHLIGHT[1]]
+        done = end
+    parts.append(original[done:])
+    return "".join(parts)
+
+
+def match_query(text):
+    """
+    FTS5 query for search text: "quoted phrases" and words, all required,
+    and a word ending in * matches as a prefix. None if text has no terms.
+    """
+    parts = []
+    for phrase, word in re.findall(r'"([^"]*)"|(\S+)', index_db.fold_search_text(text)):
+        if phrase.strip():
+            parts.append('"{0}"'.format(phrase))
+        elif word:
+            term = word.rstrip("*").replace('"', "")
+            if term:
+                parts.append('"{0}"{1}'.format(term, "*" if word.endswith("*") else ""))
+    return " ".join(parts) or None
+
+
+def search(conn, text, limit=200):
+    """
+    The limit best (bm25) events matching text, grouped by timeline source:
+    a list of (source, events) with the source of the best hit first. Each
+    event dict also has event_highlight and details_highlight, its event and
+    details as stored with the matches between the HIGHLIGHT markers.
+    """
+    query = match_query(text)
+    if query is None:
+        return []
+    rows = conn.execute(
+        "SELECT t.id, t.timestamp, t.type, t.event, t.details, t.source, t.provenance, "
+        "highlight(timeline_fts, 0, ?, ?), highlight(timeline_fts, 1, ?, ?) "
+        "FROM timeline_fts JOIN timeline t ON t.id = timeline_fts.rowid "
+        "WHERE timeline_fts MATCH ? ORDER BY rank LIMIT ?", HIGHLIGHT + HIGHLIGHT + (query, limit))
+    groups = {}
+    for row in rows:
+        event = dict(zip(["id"] + COLUMNS, row[:7]))
+        event["event_highlight"] = _highlight_original(event["event"], row[7])
+        event["details_highlight"] = _highlight_original(event["details"], row[8])
+        groups.setdefault(event["source"], []).append(event)
+    return list(groups.items())
+
+
+def has_events(conn):
+    """Whether the timeline has any event, without counting them."""
+    return bool(conn.execute("SELECT EXISTS (SELECT 1 FROM timeline)").fetchone()[0])
+
+
+def count(conn, source=None):
+    if source is None:
+        return conn.execute("SELECT count(*) FROM timeline").fetchone()[0]
+    return conn.execute("SELECT count(*) FROM timeline WHERE source = ?", (source,)).fetchone()[0]
+
+
+def export_csv(conn, csv_path, sources=None):
+    """Write events (all, or of sources) oldest first as timestamp,type,event,details CSV."""
+    os.makedirs(os.path.dirname(csv_path) or ".", exist_ok=True)
+    with open(csv_path, "w", newline="", encoding="utf-8") as f:
+        writer = csv.writer(f)
+        writer.writerow(["timestamp", "type", "event", "details"])
+        for event in query(conn, sources=sources, descending=False):
+            writer.writerow(_csv_row(event))
+
+
+def import_csv(conn, csv_path, source="combined"):
+    """Load an old combined/timeline.csv into the store (projects processed before it existed)."""
+    with open(csv_path, newline="", encoding="utf-8", errors="replace") as f:
+        return replace_source(conn, source, csv.DictReader(f))
+
+
+def benchmark(db_path, events=5000000, seed=0):
+    """Fill a scratch database with synthetic events and time typical GUI queries."""
+    import random
+    rng = random.Random(seed)
+    types = ["sms", "call", "media", "contact", "calendar", "applications", "Location"]
+    conn = index_db.connect(db_path)
+    start = time.time()
+    now = time.time()
+    append(conn, "bench", ({"timestamp": now - rng.random() * 5 * 365 * 86400, "type": rng.choice(types),
+                            "event": "event", "details": "details {0}".format(i)} for i in range(events)))
+    print("insert {n} events: {sec:.1f}s".format(n=events, sec=time.time() - start))
+    checks = [
+        ("newest 100", dict(limit=100)),
+        ("one day", dict(start=now - 86400 * 30, end=now - 86400 * 29)),
+        ("type sms, newest 100", dict(types=["sms"], limit=100)),
+        ("one week of calls", dict(start=now - 86400 * 60, end=now - 86400 * 53, types=["call"])),
+    ]
+    for label, kwargs in checks:
+        start = time.time()
+        rows = list(query(conn, **kwargs))
+        print("{label}: {n} events in {ms:.1f} ms".format(label=label, n=len(rows), ms=(time.time() - start) * 1000))
+    conn.close()
+
+
+def _synthetic_source(name, events, seed):
+    import random
+    rng = random.Random(seed)
+    timestamp = time.time() - 5 * 365 * 86400
+    step = 2 * 5 * 365 * 86400 / max(events, 1)
+    for i in range(events):
+        timestamp += rng.random() * step
+        yield {"timestamp": timestamp, "type": name, "event": "event", "details": "{0} details {1}".format(name, i)}
+
+
+def benchmark_merge(db_path, events=10000000, sources=8, materialise=False):
+    """
+    Build the timeline of a synthetic project of events spread over sources,
+    either merged from generators (replace_merged) or the old way: every
+    source as a list, concatenated and sorted before inserting. Run each mode
+    in its own process, since the peak RSS reported is the process's.
+    """
+    import resource
+    names = ["source{0}".format(i) for i in range(sources)]
+    per_source = events // sources
+    conn = index_db.connect(db_path)
+    start = time.time()
+    if materialise:
+        timeline = []
+        for i, name in enumerate(names):
+            timeline.extend((name, event) for event in _synthetic_source(name, per_source, i))
+        timeline.sort(key=lambda item: sort_key(item[1]))
+        conn.execute("DELETE FROM timeline WHERE source IN ({0})".format(",".join("?" * len(names))), names)
+        count = _insert(conn, (_row(name, event) for name, event in timeline), 10000)
+    else:
+        count = replace_merged(conn, {name: _synthetic_source(name, per_source, i) for i, name in enumerate(names)})
+    conn.close()
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    print("{mode}: {n} events from {k} sources in {sec:.1f}s, peak RSS {mb:.0f} MB".format(
+        mode="list + sort" if materialise else "k-way merge", n=count, k=sources, sec=time.time() - start, mb=peak))
+
+
+def benchmark_search(db_path, events=1000000, seed=0):
+    """Index synthetic Latin and Persian messages and time phrase, prefix and keyword searches."""
+    import random
+    rng = random.Random(seed)
+    words = ["".join(rng.choice("abcdefghijklmnopqrstuvwxyz") for _ in range(rng.randint(3, 9))) for _ in range(20000)]
+    words += ["".join(rng.choice("ابپتثجچحخدذرزژسشصضطظعغفقکگلمنوهی") for _ in range(rng.randint(2, 7))) for _ in range(20000)]
+    sources = ["sms", "apps", "calendar", "calllogs"]
+    conn = index_db.connect(db_path)
+    start = time.time()
+    for source in sources:
+        append(conn, source, ({"timestamp": time.time() - rng.random() * 5 * 365 * 86400, "type": source, "event": "message",
+                               "details": " ".join(rng.choice(words) for _ in range(12))} for _ in range(events // len(sources))))
+    print("insert and index {n} events: {sec:.1f}s".format(n=events, sec=time.time() - start))
+    sample = conn.execute("SELECT details FROM timeline ORDER BY id DESC LIMIT 1").fetchone()[0].split()
+    checks = [
+        ("keyword", sample[0]),
+        ("phrase", '"{0} {1}"'.format(sample[1], sample[2])),
+        ("prefix", sample[3][:3] + "*"),
+        ("Persian keyword", words[-1]),
+        ("two keywords", "{0} {1}".format(words[5], words[-5])),
+    ]
+    for label, text in checks:
+        start = time.time()
+        hits = sum(len(group) for _, group in search(conn, text, limit=50))
+        print("{label} {text!r}: {n} hits in {ms:.1f} ms".format(label=label, text=text, n=hits, ms=(time.time() - start) * 1000))
+    conn.close()
+
+
+if __name__ == '__main__':
+    # python databse/timeline_db.py <db> [events]               query benchmark
+    # python databse/timeline_db.py merge <db> [events] [list]  timeline build benchmark
+    # python databse/timeline_db.py search <db> [events]        full-text search benchmark
+    if len(sys.argv) > 1 and sys.argv[1] == "search":
+        benchmark_search(sys.argv[2] if len(sys.argv) > 2 else "timeline_bench.db",
+                         int(sys.argv[3]) if len(sys.argv) > 3 else 1000000)
+    elif len(sys.argv) > 1 and sys.argv[1] == "merge":
+        benchmark_merge(sys.argv[2] if len(sys.argv) > 2 else "timeline_bench.db",
+                        int(sys.argv[3]) if len(sys.argv) > 3 else 10000000,
+                        materialise=len(sys.argv) > 4 and sys.argv[4] == "list")
+    else:
+        benchmark(sys.argv[1] if len(sys.argv) > 1 else "timeline_bench.db",
+                  int(sys.argv[2]) if len(sys.argv) > 2 else 5000000)
@@ -3,34 +3,95 @@
 address=$1
 whole=$2
 app_name=$3
+# pull: copy on the device then adb pull (default)
+# stream: tar straight off the device over adb exec-out and unpack on the host
+mode=${4:-pull}
+# all: app data, system databases and media (default)
+# shared: system databases and media only, once per device session
+# app: app data only
+part=${5:-all}
+
+# the adb binary can be replaced (e.g. by a fake that emits tar streams)
+ADB=${ADB:-adb}
+# streamed archives are unpacked by integrity.py, which hashes files while writing them
+UNTAR="${PYTHON:-python3} $(dirname $0)/integrity.py untar $address"
+
+
+# print size and MB/s of what landed in a directory since a start time
+report_rate() {
+    label=$1
+    dir=$2
+    start=$3
+    end=$(date +%s.%N)
+    bytes=$(du -sb $dir 2>/dev/null | cut -f 1)
+    awk -v l="$label" -v m="$mode" -v b="${bytes:-0}" -v s="$start" -v e="$end" 'BEGIN {
+        t = e - s; if (t <= 0) t = 0.000001;
+        printf "%s (%s): %.1f MB in %.1fs (%.1f MB/s)\n", l, m, b / 1048576, t, b / 1048576 / t
+    }'
+}
+
+# stream_tar <device dir> <host dir> [root] [strip components] [members...]
+stream_tar() {
+    src=$1
+    dest=$2
+    as_root=$3
+    strip=$4
+    shift 4
+    members=${*:-.}
+    mkdir -p $dest
+    if [ "$as_root" == "root" ]
+    then
+        $ADB exec-out "su -c 'tar -cf - -C $src $members'" | $UNTAR $dest $strip
+    else
+        $ADB exec-out "tar -cf - -C $src $members" | $UNTAR $dest $strip
+    fi
+}
 
 
 echo starting to dump...
 
 
-adb_state=$(adb get-state 2>/dev/null)
+adb_state=$($ADB get-state 2>/dev/null)
 if [ ! $adb_state ]
 then
     echo no devices connected!
     exit 1
 fi
 
-b=$(adb shell command -v su)
+b=$($ADB shell command -v su)
 echo b: $b
 
-adb shell rmdir /sdcard/data_tmp
-adb shell mkdir /sdcard/data_tmp
+# pull mode stages app data in a directory of its own (app parts of a session
+# run side by side) and system databases under /sdcard/data_tmp; both are
+# removed from the device once pulled
+app_tmp=/sdcard/data_tmp_$app_name
 
 if [ -z $b ]
 then
     echo su not found, dumping in non root mode
+    if [ $part == "app" ]
+    then
+        echo app data needs root, nothing to do
+        exit 0
+    fi
     mkdir -p $address/extract/media
-    adb pull -a /sdcard $address/extract/media
-    list=$(adb shell pm list packages)
+    start=$(date +%s.%N)
+    if [ $mode == "stream" ]
+    then
+        stream_tar /sdcard $address/extract/media/sdcard user 0
+    else
+        $ADB pull -a /sdcard $address/extract/media
+    fi
+    report_rate media $address/extract/media $start
+    if [ $part == "shared" ]
+    then
+        exit 0
+    fi
+    list=$($ADB shell pm list packages)
     for package in $list; do
-        if [ $app_name != "" ]
+        if [ "$app_name" != "" ]
         then
-        if [ $app_name == $package ]
+        if [ "$app_name" == $package ]
         then
             echo app found!
         fi
@@ -41,37 +102,78 @@ else
     echo su found
     echo dumping in root mode
     mkdir -p $address/extract/apps_data $address/extract/media $address/extract/other
-    ok=false
-    list=$(adb shell pm list packages | cut -d  ':' -f 2)
-    for package in $list; do
-        if [ $app_name == $package ]
+    # in a device session the caller has already checked the package list once
+    if [ $part == "all" ]
+    then
+        ok=false
+        list=$($ADB shell pm list packages | cut -d  ':' -f 2)
+        for package in $list; do
+            if [ "$app_name" == $package ]
+            then
+                echo app found!
+                ok=true
+            fi
+        done
+
+        if [ $ok == "false" ]
         then
-            echo app found!
-            ok=true
+          echo app not found !!
+          exit 1
         fi
-    done
+    fi
 
-    if [ $ok == "false" ]
+    if [ $mode == "stream" ] && [ $part != "shared" ]
     then
-      echo app not found !!
-      exit 1
+        start=$(date +%s.%N)
+        stream_tar /data/data $address/extract/apps_data root 0 $app_name
+        report_rate $app_name $address/extract/apps_data/$app_name $start
     fi
 
-    adb shell su -c cp -pr /data/data/$app_name /sdcard/data_tmp
-    adb pull -a /sdcard/data_tmp/$app_name $address/extract/apps_data
-    adb shell su -c rm -rf  /sdcard/data_tmp/$app_name
+    if [ $mode == "stream" ] && [ $part != "app" ]
+    then
+        start=$(date +%s.%N)
+        stream_tar /data/data $address/extract/other/important_databases root 2 \
+            com.android.providers.contacts/databases \
+            com.android.providers.telephony/databases \
+            com.android.providers.calendar/databases
+        report_rate important_databases $address/extract/other/important_databases $start
+
+        if [ -d $address/extract/media/sdcard ]
+        then
+            start=$(date +%s.%N)
+            stream_tar /sdcard $address/extract/media/sdcard user 0
+            report_rate media $address/extract/media/sdcard $start
+        fi
+    fi
 
-    adb shell mkdir /sdcard/data_tmp/important_databases
-    adb shell su -c cp -rp /data/data/com.android.providers.contacts/databases/* /sdcard/data_tmp/important_databases
-    adb shell su -c cp -rp  /data/data/com.android.providers.telephony/databases/* /sdcard/data_tmp/important_databases
-    adb shell su -c cp -rp  /data/data/com.android.providers.calendar/databases/* /sdcard/data_tmp/important_databases
-    adb pull -a /sdcard/data_tmp/important_databases $address/extract/other
-    adb shell su -c rm -rf  /sdcard/data_tmp
+    if [ $mode == "pull" ] && [ $part != "shared" ]
+    then
+        start=$(date +%s.%N)
+        $ADB shell mkdir -p $app_tmp
+        $ADB shell su -c cp -pr /data/data/$app_name $app_tmp
+        $ADB pull -a $app_tmp/$app_name $address/extract/apps_data
+        $ADB shell su -c rm -rf $app_tmp
+        report_rate $app_name $address/extract/apps_data/$app_name $start
+    fi
 
-    if [ -d $address/extract/media/sdcard ]
+    if [ $mode == "pull" ] && [ $part != "app" ]
     then
-        adb pull -a /sdcard $address/extract/media
+        start=$(date +%s.%N)
+        $ADB shell mkdir -p /sdcard/data_tmp/important_databases
+        $ADB shell su -c cp -rp /data/data/com.android.providers.contacts/databases/* /sdcard/data_tmp/important_databases
+        $ADB shell su -c cp -rp  /data/data/com.android.providers.telephony/databases/* /sdcard/data_tmp/important_databases
+        $ADB shell su -c cp -rp  /data/data/com.android.providers.calendar/databases/* /sdcard/data_tmp/important_databases
+        $ADB pull -a /sdcard/data_tmp/important_databases $address/extract/other
+        $ADB shell su -c rm -rf  /sdcard/data_tmp
+        report_rate important_databases $address/extract/other/important_databases $start
+
+        if [ -d $address/extract/media/sdcard ]
+        then
+            start=$(date +%s.%N)
+            $ADB pull -a /sdcard $address/extract/media
+            report_rate media $address/extract/media/sdcard $start
+        fi
     fi
 fi
 
-        
+
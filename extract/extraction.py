@@ -1,13 +1,65 @@
 import customtkinter
-from subprocess import call, Popen
+import os
+from subprocess import call, Popen, check_output, CalledProcessError
+from concurrent.futures import ThreadPoolExecutor
+from extract import integrity
 
 
-def extract_data(address, whole_storage, app_name=None):
+# "pull" copies on the device then adb pulls, "stream" tars straight off the device over adb exec-out
+acquisition_mode = "pull"
+# number of app data directories acquired at the same time
+app_parallelism = 3
+
+
+def list_packages():
+    """Package names installed on the connected device."""
+    try:
+        output = check_output([os.environ.get("ADB", "adb"), "shell", "pm", "list", "packages"], text=True)
+    except (CalledProcessError, OSError) as e:
+        print(f"Error listing packages: {e}")
+        return set()
+    return {line.strip().split(":", 1)[-1] for line in output.splitlines() if line.strip()}
+
+
+def extract_data(address, whole_storage, app_name=None, mode=None, parallel=None):
+    """
+    Acquire the device in one session: the package list, system databases and
+    media are fetched once, then the selected apps' data directories are
+    pulled concurrently, at most parallel at a time. A signed hash manifest of
+    everything acquired is written at the end (see integrity.py).
+    Returns False when the shared part fails (no device, nothing acquired),
+    in which case no app is pulled; failed apps are only reported.
+    """
+    if mode is None:
+        mode = acquisition_mode
+    if parallel is None:
+        parallel = app_parallelism
     wh="false"
     if (whole_storage):
         wh = "true"
     if app_name is not None:
+            installed = list_packages()
+            apps = []
             for app in app_name:
+                if app in installed:
+                    apps.append(app)
+                else:
+                    print("app not found: ", app)
+
+            print("extracting shared data")
+            rc = call(["extract/extract.sh", address, wh, "", mode, "shared"])
+            if rc != 0:
+                print("extracting shared data failed with code {rc}, stopping the acquisition".format(rc=rc))
+                return False
+
+            def extract_app(app):
                 print("extracting ", app)
-                rc = call(["extract/extract.sh", address, wh, app])
+                return call(["extract/extract.sh", address, wh, app, mode, "app"])
+
+            with ThreadPoolExecutor(max_workers=max(1, parallel)) as pool:
+                for app, rc in zip(apps, pool.map(extract_app, apps)):
+                    if rc != 0:
+                        print("extracting {app} failed with code {rc}".format(app=app, rc=rc))
 
+            integrity.finalize_manifest(address)
+    return True
@@ -0,0 +1,359 @@
+"""
+Integrity hashing of acquired artifacts.
+
+Streamed acquisitions (extract.sh stream mode) are unpacked by `untar`, which
+hashes every file while writing it, so nothing is read twice. Files that
+arrive by adb pull are hashed afterwards on a thread pool. finalize_manifest
+merges both into projects/<name>/manifest.json and signs it with HMAC-SHA256
+(manifest.json.sig). Files larger than CHUNK_SIZE also get per-chunk SHA-256
+digests, so `verify` can spread one big file across cores and spot-check
+random chunks when sampling. Symbolic and hard links in a stream are recreated
+and recorded too (symlinks by their target, hard links by the hashes of the
+file they link to).
+
+    python3 extract/integrity.py untar <project dir> <dest dir> <strip components>  < archive.tar
+    python3 extract/integrity.py verify <project dir> [--sample N] [--workers N]
+"""
+import os
+import sys
+import hmac
+import json
+import time
+import random
+import hashlib
+import secrets
+import shutil
+import tarfile
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..',)))
+from util.file_utils import scan_files
+
+CHUNK_SIZE = 64 * 1024 * 1024
+READ_SIZE = 1024 * 1024
+PARTS_DIR = "manifest.parts"
+MANIFEST = "manifest.json"
+# also record MD5 next to SHA-256
+with_md5 = False
+
+
+class _Hasher:
+    """SHA-256 (and optionally MD5) of a byte stream plus SHA-256 of each CHUNK_SIZE piece."""
+
+    def __init__(self, md5=False):
+        self.sha256 = hashlib.sha256()
+        self.md5 = hashlib.md5() if md5 else None
+        self.chunks = []
+        self._chunk = hashlib.sha256()
+        self._chunk_fill = 0
+        self.size = 0
+
+    def update(self, data):
+        self.sha256.update(data)
+        if self.md5 is not None:
+            self.md5.update(data)
+        self.size += len(data)
+        view = memoryview(data)
+        while view:
+            piece = view[:CHUNK_SIZE - self._chunk_fill]
+            self._chunk.update(piece)
+            self._chunk_fill += len(piece)
+            view = view[len(piece):]
+            if self._chunk_fill == CHUNK_SIZE:
+                self.chunks.append(self._chunk.hexdigest())
+                self._chunk = hashlib.sha256()
+                self._chunk_fill = 0
+
+    def record(self, path, mtime):
+        entry = {"path": path, "size": self.size, "mtime": mtime, "sha256": self.sha256.hexdigest()}
+        if self.md5 is not None:
+            entry["md5"] = self.md5.hexdigest()
+        if self.size > CHUNK_SIZE:
+            chunks = list(self.chunks)
+            if self._chunk_fill:
+                chunks.append(self._chunk.hexdigest())
+            entry["chunk_size"] = CHUNK_SIZE
+            entry["chunks"] = chunks
+        return entry
+
+
+def hash_file(path, rel_path, md5=False):
+    hasher = _Hasher(md5)
+    with open(path, "rb") as f:
+        for data in iter(lambda: f.read(READ_SIZE), b""):
+            hasher.update(data)
+    return hasher.record(rel_path, os.stat(path).st_mtime)
+
+
+def _member_path(name, strip):
+    parts = [p for p in name.split("/") if p not in ("", ".")]
+    if ".." in parts:
+        return None
+    parts = parts[strip:]
+    return "/".join(parts) if parts else None
+
+
+def _write_record(fd, entry):
+    # one write per line on an O_APPEND descriptor, so a record is never split
+    os.write(fd, (json.dumps(entry) + "\n").encode("utf-8"))
+
+
+def _replace(target):
+    if os.path.islink(target) or (os.path.lexists(target) and not os.path.isdir(target)):
+        os.remove(target)
+
+
+def _inside(path, root):
+    """True if path, with every symlink in it resolved, is root or under it (root already resolved)."""
+    path = os.path.realpath(path)
+    return path == root or path.startswith(root + os.sep)
+
+
+def untar(project_dir, dest, strip=0, stream=None):
+    """
+    Unpack a tar stream into dest, hashing every regular file as it is
+    written. Symbolic and hard links are recreated; other special members
+    (devices, fifos) are only recorded. A member whose parent directory
+    resolves outside dest (through a symlink of the stream) is skipped, so
+    links can point anywhere but nothing is written through them. Records go
+    to a parts file of this process, so concurrent unpacks into the same dest
+    never share one.
+    """
+    stream = stream or sys.stdin.buffer
+    os.makedirs(dest, exist_ok=True)
+    root = os.path.realpath(dest)
+    parts_dir = os.path.join(project_dir, PARTS_DIR)
+    os.makedirs(parts_dir, exist_ok=True)
+    part = os.path.join(parts_dir, "{dest}.{pid}.jsonl".format(
+        dest=os.path.relpath(dest, project_dir).replace("/", "_"), pid=os.getpid()))
+    fd = os.open(part, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+    records = {}
+    count = 0
+    try:
+        with tarfile.open(fileobj=stream, mode="r|") as tar:
+            for member in tar:
+                rel = _member_path(member.name, strip)
+                if rel is None:
+                    continue
+                target = os.path.join(dest, rel)
+                rel_target = os.path.relpath(target, project_dir)
+                if not _inside(os.path.dirname(target), root) or (member.isdir() and not _inside(target, root)):
+                    print("skipping a member that leads outside the destination: " + member.name)
+                    continue
+                if member.isdir():
+                    os.makedirs(target, exist_ok=True)
+                    continue
+                os.makedirs(os.path.dirname(target), exist_ok=True)
+                if member.issym():
+                    _replace(target)
+                    os.symlink(member.linkname, target)
+                    entry = {"path": rel_target, "type": "symlink", "target": member.linkname, "mtime": member.mtime}
+                elif member.islnk():
+                    link_rel = _member_path(member.linkname, strip)
+                    linked = records.get(link_rel)
+                    if link_rel is None or linked is None or not _inside(os.path.join(dest, link_rel), root):
+                        print("hard link to a file outside the stream: " + member.name)
+                        continue
+                    _replace(target)
+                    try:
+                        os.link(os.path.join(dest, link_rel), target)
+                    except OSError:
+                        shutil.copy2(os.path.join(dest, link_rel), target)
+                    entry = dict(linked, path=rel_target, link=linked["path"])
+                elif member.isfile():
+                    hasher = _Hasher(with_md5)
+                    source = tar.extractfile(member)
+                    _replace(target)
+                    with open(target, "wb") as f:
+                        for data in iter(lambda: source.read(READ_SIZE), b""):
+                            f.write(data)
+                            hasher.update(data)
+                    os.chmod(target, member.mode & 0o777)
+                    os.utime(target, (member.mtime, member.mtime))
+                    entry = hasher.record(rel_target, member.mtime)
+                    records[rel] = entry
+                else:
+                    entry = {"path": rel_target, "type": "special", "mode": member.mode, "mtime": member.mtime}
+                _write_record(fd, entry)
+                count += 1
+    finally:
+        os.close(fd)
+    return count
+
+
+def manifest_key():
+    """HMAC key from $AFF_MANIFEST_KEY, or projects/.manifest_key (created on first use)."""
+    key = os.environ.get("AFF_MANIFEST_KEY")
+    if key:
+        return key.encode("utf-8")
+    path = os.path.join("projects", ".manifest_key")
+    if not os.path.exists(path):
+        os.makedirs("projects", exist_ok=True)
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+        with os.fdopen(fd, "w") as f:
+            f.write(secrets.token_hex(32))
+    with open(path) as f:
+        return f.read().strip().encode("utf-8")
+
+
+def sign(data):
+    return hmac.new(manifest_key(), data, hashlib.sha256).hexdigest()
+
+
+def finalize_manifest(project_dir, root="extract", workers=None):
+    """
+    Merge the streamed hash records with hashes of every other file under
+    project_dir/root (hashed in parallel), then write and sign the manifest.
+    Entries of an earlier manifest are kept while size and mtime still match.
+    """
+    workers = workers or os.cpu_count() or 1
+    entries = {}
+    path = os.path.join(project_dir, MANIFEST)
+    if os.path.exists(path):
+        with open(path) as f:
+            entries = {entry["path"]: entry for entry in json.load(f)["files"]}
+    parts_dir = os.path.join(project_dir, PARTS_DIR)
+    if os.path.isdir(parts_dir):
+        for name in sorted(os.listdir(parts_dir)):
+            with open(os.path.join(parts_dir, name)) as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # the tail of an unpack that was killed; that file is hashed below
+                        print("skipping a truncated record in " + name)
+                        continue
+                    entries[entry["path"]] = entry
+
+    missing = []
+    present = set()
+    for entry in scan_files(os.path.join(project_dir, root)):
+        rel = os.path.relpath(entry.path, project_dir)
+        present.add(rel)
+        known = entries.get(rel)
+        st = entry.stat(follow_symlinks=False)
+        if known is None or known["size"] != st.st_size or known["mtime"] != st.st_mtime:
+            missing.append((entry.path, rel))
+    # symlinks are not regular files, so keep theirs while they still exist; special files
+    # (devices, fifos) are never recreated and only recorded
+    entries = {p: e for p, e in entries.items()
+               if p in present or e.get("type") == "special"
+               or (e.get("type") == "symlink" and os.path.lexists(os.path.join(project_dir, p)))}
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for entry in pool.map(lambda item: hash_file(item[0], item[1], with_md5), missing):
+            entries[entry["path"]] = entry
+
+    manifest = {"created": time.time(), "files": [entries[p] for p in sorted(entries)]}
+    data = json.dumps(manifest, indent=1).encode("utf-8")
+    with open(path, "wb") as f:
+        f.write(data)
+    with open(path + ".sig", "w") as f:
+        f.write(sign(data))
+    if os.path.isdir(parts_dir):
+        for name in os.listdir(parts_dir):
+            os.remove(os.path.join(parts_dir, name))
+        os.rmdir(parts_dir)
+    print("manifest: {n} files ({h} hashed after acquisition) -> {p}".format(
+        n=len(entries), h=len(missing), p=path))
+    return path
+
+
+def _verify_chunk(path, index, chunk_size, expected):
+    with open(path, "rb") as f:
+        f.seek(index * chunk_size)
+        h = hashlib.sha256()
+        remaining = chunk_size
+        while remaining:
+            data = f.read(min(READ_SIZE, remaining))
+            if not data:
+                break
+            h.update(data)
+            remaining -= len(data)
+    return h.hexdigest() == expected
+
+
+def _verify_whole(path, entry):
+    return hash_file(path, entry["path"])["sha256"] == entry["sha256"]
+
+
+def verify(project_dir, sample=None, workers=None, seed=None):
+    """
+    Check the manifest signature, then re-hash the files (all, or a random
+    sample of `sample` files) in parallel. Large files are checked chunk by
+    chunk, and only one random chunk of each when sampling.
+    Returns {"signature": bool, "ok": n, "mismatch": [...], "missing": [...]}.
+    """
+    workers = workers or os.cpu_count() or 1
+    path = os.path.join(project_dir, MANIFEST)
+    with open(path, "rb") as f:
+        data = f.read()
+    with open(path + ".sig") as f:
+        signature_ok = hmac.compare_digest(f.read().strip(), sign(data))
+    if not signature_ok:
+        print("manifest signature does NOT match")
+    files = json.loads(data)["files"]
+    rng = random.Random(seed)
+    if sample is not None and sample < len(files):
+        files = rng.sample(files, sample)
+
+    result = {"signature": signature_ok, "ok": 0, "mismatch": [], "missing": []}
+    jobs = []
+    for entry in files:
+        full = os.path.join(project_dir, entry["path"])
+        if entry.get("type") == "special":
+            continue
+        if entry.get("type") == "symlink":
+            if not os.path.lexists(full):
+                result["missing"].append(entry["path"])
+            elif (not os.path.islink(full) or os.readlink(full) != entry["target"]):
+                result["mismatch"].append(entry["path"])
+            else:
+                result["ok"] += 1
+            continue
+        if not os.path.exists(full) or os.path.getsize(full) != entry["size"]:
+            result["missing" if not os.path.exists(full) else "mismatch"].append(entry["path"])
+            continue
+        if "chunks" in entry:
+            indexes = range(len(entry["chunks"]))
+            if sample is not None:
+                indexes = [rng.randrange(len(entry["chunks"]))]
+            for i in indexes:
+                jobs.append((entry["path"], _verify_chunk, (full, i, entry["chunk_size"], entry["chunks"][i])))
+        else:
+            jobs.append((entry["path"], _verify_whole, (full, entry)))
+
+    bad = set()
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = [(rel, pool.submit(func, *args)) for rel, func, args in jobs]
+        for rel, future in futures:
+            if not future.result():
+                bad.add(rel)
+    checked = {rel for rel, _, _ in jobs}
+    result["mismatch"].extend(sorted(bad))
+    result["ok"] += len(checked - bad)
+    print("verify: signature {sig}, {ok} ok, {bad} mismatched, {miss} missing".format(
+        sig="ok" if signature_ok else "BAD", ok=result["ok"], bad=len(result["mismatch"]), miss=len(result["missing"])))
+    return result
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="acquisition integrity hashing")
+    sub = parser.add_subparsers(dest="command", required=True)
+    p = sub.add_parser("untar")
+    p.add_argument("project_dir")
+    p.add_argument("dest")
+    p.add_argument("strip", type=int, nargs="?", default=0)
+    p = sub.add_parser("finalize")
+    p.add_argument("project_dir")
+    p = sub.add_parser("verify")
+    p.add_argument("project_dir")
+    p.add_argument("--sample", type=int, default=None)
+    p.add_argument("--workers", type=int, default=None)
+    args = parser.parse_args()
+    if args.command == "untar":
+        untar(args.project_dir, args.dest, args.strip)
+    elif args.command == "finalize":
+        finalize_manifest(args.project_dir)
+    else:
+        res = verify(args.project_dir, args.sample, args.workers)
+        sys.exit(0 if res["signature"] and not res["mismatch"] and not res["missing"] else 1)
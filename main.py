@@ -15,7 +15,9 @@ def start_project(name, whole, app_name):
   print("start extraction")
 
   # extract data
-  evidence_database.extract_and_save(whole, app_name)
+  if not evidence_database.extract_and_save(whole, app_name):
+    print("extraction failed, nothing to process")
+    return
 
   print("start processing")
   # process data
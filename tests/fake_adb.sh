@@ -0,0 +1,63 @@
+#!/bin/bash
+# Stand-in for adb that serves a device from a directory tree, so extract.sh
+# can run without a phone:
+#
+#     FAKE_DEVICE=<tree with data/data/... and sdcard/...> [FAKE_ROOT=1] ADB=tests/fake_adb.sh extract/extract.sh ...
+#
+# exec-out runs the requested tar inside $FAKE_DEVICE and writes the archive
+# to stdout, as adb exec-out does. pull copies out of it, and the mkdir, rmdir,
+# cp and rm shell commands of pull mode run on it, with "su -c" dropped. Other
+# shell commands only answer what extract.sh asks (su, package list).
+
+device=${FAKE_DEVICE:?FAKE_DEVICE must point at the fake device tree}
+
+case $1 in
+    get-state)
+        echo device
+        ;;
+    exec-out)
+        # "su -c 'tar -cf - -C <dir> <members>'" or "tar -cf - -C <dir> <members>"
+        cmd=$2
+        cmd=${cmd#su -c \'}
+        cmd=${cmd%\'}
+        set -- $cmd
+        [ "$1 $2 $3 $4" == "tar -cf - -C" ] || { echo "fake adb: unsupported exec-out: $2" >&2; exit 1; }
+        src=$5
+        shift 5
+        tar -cf - -C "$device$src" "${@:-.}"
+        ;;
+    pull)
+        # pull -a <device path> <host dir>
+        [ -e "$device$3" ] || { echo "fake adb: $3 does not exist" >&2; exit 1; }
+        mkdir -p "$4"
+        cp -a "$device$3" "$4/"
+        ;;
+    shell)
+        shift
+        [ "$1 $2" == "su -c" ] && shift 2
+        case "$1" in
+            mkdir|rmdir|cp|rm)
+                args=()
+                for arg in "$@"; do
+                    [ "${arg:0:1}" == "/" ] && arg=$device$arg
+                    args+=($arg)
+                done
+                "${args[@]}" 2>/dev/null
+                exit $?
+                ;;
+        esac
+        case "$*" in
+            "command -v su")
+                [ -n "$FAKE_ROOT" ] && echo /system/bin/su
+                ;;
+            "pm list packages")
+                for package in $(ls "$device/data/data"); do echo package:$package; done
+                ;;
+        esac
+        ;;
+    *)
+        echo "fake adb: unsupported command: $*" >&2
+        exit 1
+        ;;
+esac
+exit 0
@@ -0,0 +1,121 @@
+import glob
+import json
+import os
+import subprocess
+import sys
+
+REPO = os.path.abspath(os.path.join(os.path.dirname(__file__), '..',))
+FAKE_ADB = os.path.join(REPO, "tests", "fake_adb.sh")
+EXTRACT = os.path.join(REPO, "extract", "extract.sh")
+
+DEVICE_FILES = {
+    "data/data/com.example.app/databases/app.db": b"app database",
+    "data/data/com.example.app/shared_prefs/prefs.xml": b"<map/>",
+    "data/data/com.example.other/files/state.bin": b"\x00\x01other",
+    "data/data/com.android.providers.contacts/databases/contacts2.db": b"contacts",
+    "data/data/com.android.providers.telephony/databases/mmssms.db": b"sms",
+    "data/data/com.android.providers.calendar/databases/calendar.db": b"calendar",
+    "sdcard/DCIM/Camera/IMG_0001.jpg": b"\xff\xd8\xff" + b"\0" * 5000,
+    "sdcard/Download/notes.txt": b"notes",
+}
+
+
+def make_device(root):
+    for rel, data in DEVICE_FILES.items():
+        path = os.path.join(root, rel)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "wb") as f:
+            f.write(data)
+
+
+def extract_env(device, rooted):
+    env = dict(os.environ, ADB=FAKE_ADB, FAKE_DEVICE=str(device), PYTHON=sys.executable)
+    if rooted:
+        env["FAKE_ROOT"] = "1"
+    return env
+
+
+def run_extract(tmp_path, rooted, part="all"):
+    device = tmp_path / "device"
+    make_device(device)
+    project = tmp_path / "project"
+    result = subprocess.run(["bash", EXTRACT, str(project), "1", "com.example.app", "stream", part],
+                            env=extract_env(device, rooted), capture_output=True, text=True, timeout=120)
+    assert result.returncode == 0, result.stdout + result.stderr
+    return project
+
+
+def read_parts(project):
+    records = {}
+    for part in glob.glob(os.path.join(project, "manifest.parts", "*.jsonl")):
+        with open(part) as f:
+            for line in f:
+                record = json.loads(line)
+                records[record["path"]] = record
+    return records
+
+
+def assert_unpacked(project, expected):
+    records = read_parts(project)
+    for rel, source in expected.items():
+        path = os.path.join(project, rel)
+        with open(path, "rb") as f:
+            assert f.read() == DEVICE_FILES[source]
+        assert rel in records
+        assert records[rel]["size"] == len(DEVICE_FILES[source])
+    assert set(records) == set(expected)
+
+
+def test_stream_rooted(tmp_path):
+    project = run_extract(tmp_path, rooted=True)
+    assert_unpacked(project, {
+        "extract/apps_data/com.example.app/databases/app.db": "data/data/com.example.app/databases/app.db",
+        "extract/apps_data/com.example.app/shared_prefs/prefs.xml": "data/data/com.example.app/shared_prefs/prefs.xml",
+        "extract/other/important_databases/contacts2.db": "data/data/com.android.providers.contacts/databases/contacts2.db",
+        "extract/other/important_databases/mmssms.db": "data/data/com.android.providers.telephony/databases/mmssms.db",
+        "extract/other/important_databases/calendar.db": "data/data/com.android.providers.calendar/databases/calendar.db",
+    })
+    # each untar process writes its own parts file
+    assert len(glob.glob(os.path.join(project, "manifest.parts", "*.jsonl"))) == 2
+
+
+def test_stream_app_part_only(tmp_path):
+    project = run_extract(tmp_path, rooted=True, part="app")
+    assert_unpacked(project, {
+        "extract/apps_data/com.example.app/databases/app.db": "data/data/com.example.app/databases/app.db",
+        "extract/apps_data/com.example.app/shared_prefs/prefs.xml": "data/data/com.example.app/shared_prefs/prefs.xml",
+    })
+
+
+def test_stream_unrooted_media(tmp_path):
+    project = run_extract(tmp_path, rooted=False)
+    assert_unpacked(project, {
+        "extract/media/sdcard/DCIM/Camera/IMG_0001.jpg": "sdcard/DCIM/Camera/IMG_0001.jpg",
+        "extract/media/sdcard/Download/notes.txt": "sdcard/Download/notes.txt",
+    })
+
+
+def test_pull_session_leaves_no_staging_on_the_device(tmp_path):
+    device = tmp_path / "device"
+    make_device(device)
+    project = tmp_path / "project"
+    env = extract_env(device, rooted=True)
+    shared = subprocess.run(["bash", EXTRACT, str(project), "1", "", "pull", "shared"],
+                            env=env, capture_output=True, text=True, timeout=120)
+    assert shared.returncode == 0, shared.stdout + shared.stderr
+    # app parts of a session run side by side
+    apps = [subprocess.Popen(["bash", EXTRACT, str(project), "1", app, "pull", "app"], env=env,
+                             stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
+            for app in ["com.example.app", "com.example.other"]]
+    for proc in apps:
+        output, _ = proc.communicate(timeout=120)
+        assert proc.returncode == 0, output
+
+    for rel, target in [
+            ("data/data/com.example.app/databases/app.db", "extract/apps_data/com.example.app/databases/app.db"),
+            ("data/data/com.example.other/files/state.bin", "extract/apps_data/com.example.other/files/state.bin"),
+            ("data/data/com.android.providers.contacts/databases/contacts2.db", "extract/other/important_databases/contacts2.db"),
+            ("data/data/com.android.providers.calendar/databases/calendar.db", "extract/other/important_databases/calendar.db")]:
+        with open(os.path.join(project, target), "rb") as f:
+            assert f.read() == DEVICE_FILES[rel]
+    assert [name for name in os.listdir(device / "sdcard") if name.startswith("data_tmp")] == []
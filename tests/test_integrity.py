@@ -0,0 +1,53 @@
+import io
+import os
+import sys
+import tarfile
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..',)))
+from extract import integrity
+
+
+def tar_stream(members):
+    """A tar archive of (name, bytes) files, (name, "->", target) symlinks and (name, None) directories."""
+    buf = io.BytesIO()
+    with tarfile.open(fileobj=buf, mode="w") as tar:
+        for member in members:
+            info = tarfile.TarInfo(member[0])
+            if len(member) == 3:
+                info.type = tarfile.SYMTYPE
+                info.linkname = member[2]
+                tar.addfile(info)
+            elif member[1] is None:
+                info.type = tarfile.DIRTYPE
+                tar.addfile(info)
+            else:
+                info.size = len(member[1])
+                tar.addfile(info, io.BytesIO(member[1]))
+    buf.seek(0)
+    return buf
+
+
+def test_untar_does_not_write_through_symlinks(tmp_path):
+    outside = tmp_path / "outside"
+    outside.mkdir()
+    project = tmp_path / "project"
+    dest = project / "extract"
+    stream = tar_stream([
+        ("app/lib", "->", str(outside)),
+        ("app/lib/evil.txt", b"evil"),
+        ("app/lib/sub", None),
+        ("app/up", "->", "../.."),
+        ("app/up/evil.txt", b"evil"),
+        ("app/ok.txt", b"ok"),
+        # a later file member replaces the link itself, not its target
+        ("app/lib", b"now a file"),
+    ])
+    integrity.untar(str(project), str(dest), 0, stream)
+
+    assert os.listdir(outside) == []
+    assert not (project / "evil.txt").exists()
+    assert (dest / "app" / "ok.txt").read_bytes() == b"ok"
+    assert not (dest / "app" / "lib").is_symlink()
+    assert (dest / "app" / "lib").read_bytes() == b"now a file"
+    # links inside the stream are still recreated
+    assert os.readlink(dest / "app" / "up") == "../.."
@@ -0,0 +1,138 @@
+import csv
+import itertools
+import os
+import random
+import sqlite3
+import sys
+
+import pytest
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..',)))
+from databse import index_db, timeline_db
+
+
+@pytest.fixture
+def conn(tmp_path):
+    conn = index_db.connect(str(tmp_path / "index.db"))
+    yield conn
+    conn.close()
+
+
+def event(timestamp, name="e", details=""):
+    return {"timestamp": timestamp, "type": "test", "event": name, "details": details}
+
+
+def ordered(events):
+    """Reference order of the timeline: unknown times first, then by time, stable."""
+    return sorted(events, key=timeline_db.sort_key)
+
+
+def test_sort_key_puts_unknown_times_first():
+    events = [event(5), event(None), event("3.5"), event(""), event("not a time"), event(-1), event(0)]
+    keys = [timeline_db.sort_key(e) for e in events]
+    assert [e["timestamp"] for e in ordered(events)] == [None, "", "not a time", -1, 0, "3.5", 5]
+    # unknown times compare equal to each other and below every real time, 0 included
+    assert keys[1] == keys[3] == keys[4] < keys[6]
+
+
+def test_sorted_events_orders_mixed_timestamps():
+    rng = random.Random(1)
+    events = [event(rng.choice([None, rng.randrange(1000)]), name=str(i)) for i in range(500)]
+    events[7]["source"] = "EXIF"
+    result = list(timeline_db.sorted_events(iter(events), batch_size=64))
+    assert [(e["timestamp"], e["event"]) for e in result] == [(e["timestamp"], e["event"]) for e in ordered(events)]
+    assert [e for e in result if e["event"] == "7"][0]["source"] == "EXIF"
+
+
+def test_sorted_events_yields_read_events_then_raises():
+    def broken():
+        yield event(3, "c")
+        yield event(1, "a")
+        raise ValueError("corrupt source")
+
+    result = []
+    with pytest.raises(ValueError):
+        for e in timeline_db.sorted_events(broken()):
+            result.append(e["event"])
+    assert result == ["a", "c"]
+
+
+def test_merge_interleaves_sources_in_time_order():
+    sources = {
+        "sms": [event(None, "sms-undated"), event(1, "sms-1"), event(4, "sms-4")],
+        "calls": [event(2, "calls-2"), event(4, "calls-4"), event(9, "calls-9")],
+        "media": [event(None, "media-undated"), event(3, "media-3")],
+    }
+    merged = list(timeline_db.merge({name: iter(events) for name, events in sources.items()}))
+    assert [e["event"] for _, e in merged] == [
+        "sms-undated", "media-undated", "sms-1", "calls-2", "media-3", "sms-4", "calls-4", "calls-9"]
+    assert all(e["event"].startswith(source) for source, e in merged)
+
+
+def test_merge_is_lazy():
+    def endless(step):
+        for i in itertools.count():
+            yield event(i * step)
+
+    first = list(itertools.islice(timeline_db.merge({"a": endless(2), "b": endless(3)}), 6))
+    assert [e["timestamp"] for _, e in first] == [0, 0, 2, 3, 4, 6]
+
+
+def test_replace_merged_replaces_sources_and_writes_csv(conn, tmp_path):
+    timeline_db.append(conn, "sms", [event(100, "stale")])
+    timeline_db.append(conn, "apps", [event(50, "kept")])
+    csv_path = str(tmp_path / "combined" / "timeline.csv")
+    sources = {
+        "sms": iter([event(None, "sms-undated", "hello"), event(20, "sms-20")]),
+        "calls": iter([event(10, "calls-10", "a, \"quoted\" detail"), event(30, "calls-30")]),
+    }
+    assert timeline_db.replace_merged(conn, sources, csv_path, batch_size=2) == 4
+
+    rows = conn.execute("SELECT timestamp, event, source FROM timeline ORDER BY id").fetchall()
+    assert rows == [(50.0, "kept", "apps"), (None, "sms-undated", "sms"), (10.0, "calls-10", "calls"),
+                    (20.0, "sms-20", "sms"), (30.0, "calls-30", "calls")]
+    with open(csv_path, newline="", encoding="utf-8") as f:
+        assert list(csv.reader(f)) == [
+            ["timestamp", "type", "event", "details"],
+            ["", "test", "sms-undated", "hello"],
+            ["10", "test", "calls-10", "a, \"quoted\" detail"],
+            ["20", "test", "sms-20", ""],
+            ["30", "test", "calls-30", ""],
+        ]
+
+
+def test_replace_merged_does_not_lock_the_database_while_reading(conn, tmp_path):
+    other = sqlite3.connect(str(tmp_path / "index.db"), timeout=0.1)
+    timeline_db.append(conn, "sms", [event(1, "old")])
+
+    def slow_source():
+        for i in range(25):
+            if i == 20:
+                # another stage writing meanwhile, as the faces stage marks its checkpoints
+                other.execute("CREATE TABLE IF NOT EXISTS probe (x)")
+                other.execute("INSERT INTO probe VALUES (1)")
+                other.commit()
+                # the old events are still there until the merge is complete
+                assert other.execute("SELECT event FROM timeline WHERE source = 'sms'").fetchall() == [("old",)]
+            yield event(i, str(i))
+
+    assert timeline_db.replace_merged(conn, {"sms": slow_source()}, batch_size=7) == 25
+    assert [row[0] for row in conn.execute("SELECT event FROM timeline ORDER BY id")] == [str(i) for i in range(25)]
+    other.close()
+
+
+def test_replace_merged_keeps_old_events_when_the_merge_fails(conn):
+    timeline_db.append(conn, "sms", [event(1, "old")])
+
+    def failing():
+        yield event(2, "new")
+        raise ValueError("merge failed")
+
+    with pytest.raises(ValueError):
+        timeline_db.replace_merged(conn, {"sms": failing()})
+    assert conn.execute("SELECT event FROM timeline").fetchall() == [("old",)]
+
+
+def test_replace_merged_without_csv(conn):
+    assert timeline_db.replace_merged(conn, {"sms": iter([event(1), event(2)])}) == 2
+    assert timeline_db.count(conn, "sms") == 2
@@ -0,0 +1,74 @@
+import os
+import random
+import sqlite3
+import sys
+
+import pytest
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..',)))
+from databse import index_db, timeline_db
+
+
+@pytest.fixture
+def conn(tmp_path):
+    conn = index_db.connect(str(tmp_path / "index.db"))
+    yield conn
+    conn.close()
+
+
+def event(timestamp, name="e", details=""):
+    return {"timestamp": timestamp, "type": "test", "event": name, "details": details}
+
+
+def test_page_walks_dated_then_undated_events(conn):
+    rng = random.Random(2)
+    events = [event(rng.choice([None, None, rng.randrange(10)]), name=str(i)) for i in range(60)]
+    timeline_db.append(conn, "sms", events)
+    expected = [(row["timestamp"], row["id"]) for row in
+                timeline_db._select(conn, ["timestamp IS NOT NULL"], [], "timestamp DESC, id DESC")]
+    expected += [(row["timestamp"], row["id"]) for row in
+                 timeline_db._select(conn, ["timestamp IS NULL"], [], "id DESC")]
+
+    seen = []
+    after = None
+    for pages in range(100):
+        found, after = timeline_db.page(conn, limit=7, after=after)
+        assert len(found) <= 7
+        seen += [(row["timestamp"], row["id"]) for row in found]
+        if after is None:
+            break
+    assert seen == expected
+    assert len(seen) == 60
+
+
+def test_page_keyset_at_a_page_boundary_of_undated_events(conn):
+    timeline_db.append(conn, "sms", [event(5, "dated")] + [event(None, str(i)) for i in range(4)])
+    first, after = timeline_db.page(conn, limit=2)
+    assert [row["event"] for row in first] == ["dated", "3"]
+    assert after == (None, first[-1]["id"])
+    second, after = timeline_db.page(conn, limit=2, after=after)
+    assert [row["event"] for row in second] == ["2", "1"]
+    third, after = timeline_db.page(conn, limit=2, after=after)
+    assert [row["event"] for row in third] == ["0"]
+    assert after is None
+
+
+def test_page_with_a_time_range_skips_undated_events(conn):
+    timeline_db.append(conn, "sms", [event(None, "undated"), event(1, "old"), event(5, "in"), event(9, "new")])
+    found, after = timeline_db.page(conn, limit=10, start=2, end=9)
+    assert [row["event"] for row in found] == ["in"]
+    assert after is None
+
+
+def test_open_existing_runs_no_schema(tmp_path):
+    db_path = str(tmp_path / "index.db")
+    with pytest.raises(sqlite3.OperationalError):
+        index_db.open_existing(db_path)
+    assert not os.path.exists(db_path)
+
+    index_db.connect(db_path).close()
+    conn = index_db.open_existing(db_path)
+    assert not timeline_db.has_events(conn)
+    timeline_db.append(conn, "sms", [event(None)])
+    assert timeline_db.has_events(conn)
+    conn.close()
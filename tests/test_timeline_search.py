@@ -0,0 +1,66 @@
+import os
+import sys
+
+import pytest
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..',)))
+from databse import index_db, timeline_db
+
+
+@pytest.fixture
+def conn(tmp_path):
+    conn = index_db.connect(str(tmp_path / "index.db"))
+    yield conn
+    conn.close()
+
+
+def event(timestamp, name="e", details=""):
+    return {"timestamp": timestamp, "type": "test", "event": name, "details": details}
+
+
+@pytest.mark.parametrize("text, query", [
+    ("hello world", '"hello" "world"'),
+    ('"exact phrase" pre*', '"exact phrase" "pre"*'),
+    ('say "hi', '"say" "hi"'),
+    ("*", None),
+    ("   ", None),
+    ("", None),
+])
+def test_match_query(text, query):
+    assert timeline_db.match_query(text) == query
+
+
+def test_fold_search_text_persian():
+    # Arabic yeh and kaf become Persian, alef variants become alef, tatweel and harakat go, ZWNJ splits words
+    assert index_db.fold_search_text("علي") == "علی"
+    assert index_db.fold_search_text("كتاب") == "کتاب"
+    assert index_db.fold_search_text("أحمد آب") == "احمد اب"
+    assert index_db.fold_search_text("مــنَ") == "من"
+    assert index_db.fold_search_text("می‌خواهم") == "می خواهم"
+
+
+def test_search_matches_across_arabic_and_persian_forms(conn):
+    # stored with Arabic kaf and yeh and a ZWNJ, searched with Persian letters
+    timeline_db.append(conn, "sms", [
+        event(1, "sms", "كتاب مي‌خواهم"),
+        event(2, "call", "unrelated"),
+    ])
+    for text in ["کتاب", "خواهم", "کت*"]:
+        groups = timeline_db.search(conn, text)
+        assert [source for source, _ in groups] == ["sms"], text
+        (found,) = groups[0][1]
+        assert timeline_db.HIGHLIGHT[0] in found["details_highlight"]
+    assert timeline_db.search(conn, "ماشین") == []
+
+
+def test_search_highlights_the_stored_text(conn):
+    start, end = timeline_db.HIGHLIGHT
+    timeline_db.append(conn, "sms", [event(1, "sms", "كتاب مي‌خواهم، عَلي")])
+    (_, (found,)), = timeline_db.search(conn, "خواهم")
+    assert found["details_highlight"] == "كتاب مي‌" + start + "خواهم" + end + "، عَلي"
+    (_, (found,)), = timeline_db.search(conn, "علی")
+    # harakat inside the word are part of the match
+    assert found["details_highlight"] == "كتاب مي‌خواهم، " + start + "عَلي" + end
+    (_, (found,)), = timeline_db.search(conn, "کت*")
+    assert found["details_highlight"].replace(start, "").replace(end, "") == "كتاب مي‌خواهم، عَلي"
+    assert found["details_highlight"].startswith(start + "كتاب" + end)
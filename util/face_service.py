@@ -0,0 +1,243 @@
+"""
+Long-lived face inference service.
+
+One process loads the yolov8 detector and the ArcFace recogniser once and
+answers requests over a Unix socket (projects/.face_service.sock) with
+multiprocessing.connection, so the pipeline and the GUI share the loaded
+weights instead of each paying the load time and memory. Requests:
+
+    ("ping",)                      -> "pong"
+    ("detect", [images], backend)  -> one list of faces per image (image_utils.detect_faces_batch)
+    ("embed", [paths])             -> one ArcFace embedding per face crop, in one forward pass per batch
+    ("embed_query", path)          -> [embedding of the largest face in an image], or [] without a face
+    ("shutdown",)                  -> "bye", and the service exits once its open connections close
+
+request() returns None when the service is not running or the connection
+fails, and callers then run the models in their own process. face_analyze
+starts the service and waits for it; the GUI starts it in the background when
+the server starts and never waits for it in a request. A lock file keeps a
+second service from starting next to it, and the service exits by itself
+after idle_timeout seconds without requests.
+
+    python util/face_service.py          run the service in the foreground
+    python util/face_service.py stop     ask a running service to exit
+"""
+import os
+import sys
+import time
+import fcntl
+import secrets
+import threading
+import subprocess
+from multiprocessing import AuthenticationError
+from multiprocessing.connection import Listener, Client
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..',)))
+from addresses import get_address
+
+# start the service from face_analyze and the GUI face search when it is not running
+autostart = True
+# seconds to wait for a freshly started service to listen
+start_timeout = 120
+# seconds without requests after which the service exits (None: never)
+idle_timeout = 30 * 60
+
+
+def _authkey():
+    path = get_address("face_service") + ".key"
+    if not os.path.exists(path):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        try:
+            fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+            with os.fdopen(fd, "w") as f:
+                f.write(secrets.token_hex(32))
+        except FileExistsError:
+            pass
+    with open(path) as f:
+        return f.read().strip().encode("utf-8")
+
+
+def request(*message):
+    """Send one request to the service. Returns its answer, or None if the service is not reachable."""
+    address = get_address("face_service")
+    if not os.path.exists(address):
+        return None
+    try:
+        with Client(address, family="AF_UNIX", authkey=_authkey()) as conn:
+            conn.send(message)
+            status, answer = conn.recv()
+    except (OSError, EOFError, AuthenticationError) as e:
+        # a stale socket, a service that died mid-request or a changed key
+        print("face service unreachable, running the models in process: ", e)
+        return None
+    if status == "error":
+        raise RuntimeError("face service: " + answer)
+    return answer
+
+
+def is_running():
+    return request("ping") == "pong"
+
+
+def start():
+    """Start the service in the background unless it answers already, without waiting for it."""
+    if is_running():
+        return
+    address = get_address("face_service")
+    os.makedirs(os.path.dirname(address) or ".", exist_ok=True)
+    log = open(address + ".log", "a")
+    subprocess.Popen([sys.executable, os.path.abspath(__file__)], stdout=log, stderr=subprocess.STDOUT,
+                     stdin=subprocess.DEVNULL, start_new_session=True)
+    log.close()
+
+
+def stop():
+    """Ask a running service to exit. Returns whether one answered."""
+    return request("shutdown") == "bye"
+
+
+def ensure_running():
+    """Start the service in the background unless it answers already. Returns True once it answers."""
+    if is_running():
+        return True
+    start()
+    deadline = time.time() + start_timeout
+    while time.time() < deadline:
+        if is_running():
+            return True
+        time.sleep(0.5)
+    print("face service did not start, running the models in process")
+    return False
+
+
+class _State:
+    """Open connections and last request time of the service, to know when it may exit."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.connections = 0
+        self.last_request = time.time()
+        self.stopping = False
+
+    def idle_for(self):
+        with self.lock:
+            return 0 if self.connections else time.time() - self.last_request
+
+
+def _wake(address):
+    """Unblock the accept loop of serve so it sees state.stopping."""
+    try:
+        Client(address, family="AF_UNIX", authkey=_authkey()).close()
+    except (OSError, EOFError, AuthenticationError):
+        pass
+
+
+def _watch_idle(state, address):
+    while not state.stopping:
+        time.sleep(min(10, idle_timeout))
+        if state.idle_for() >= idle_timeout:
+            print("face service: idle for {sec}s, exiting".format(sec=idle_timeout))
+            state.stopping = True
+            _wake(address)
+
+
+def _handle(conn, lock, state, address):
+    try:
+        _answer(conn, lock, state, address)
+    finally:
+        with state.lock:
+            state.connections -= 1
+            state.last_request = time.time()
+
+
+def _answer(conn, lock, state, address):
+    from util import image_utils
+    with conn:
+        while True:
+            try:
+                message = conn.recv()
+            except EOFError:
+                return
+            with state.lock:
+                state.last_request = time.time()
+            kind = None
+            try:
+                kind = message[0]
+                if kind == "ping":
+                    answer = "pong"
+                elif kind == "shutdown":
+                    state.stopping = True
+                    answer = "bye"
+                else:
+                    # the models are not safe to call from several threads at once
+                    with lock:
+                        if kind == "detect":
+                            answer = image_utils.detect_faces_batch(message[1], message[2])
+                        elif kind == "embed":
+                            answer = image_utils.represent_faces(message[1])
+                        elif kind == "embed_query":
+                            embedding = image_utils.embed_query(message[1])
+                            answer = [] if embedding is None else [embedding]
+                        else:
+                            raise ValueError("unknown request " + str(kind))
+                conn.send(("ok", answer))
+            except Exception as e:
+                conn.send(("error", repr(e)))
+            if kind == "shutdown":
+                # after the answer, so the caller gets it before the service exits
+                _wake(address)
+
+
+def serve():
+    address = get_address("face_service")
+    os.makedirs(os.path.dirname(address) or ".", exist_ok=True)
+    # held for the life of the service, so services started side by side do not replace each other's socket
+    lock = open(address + ".lock", "a")
+    try:
+        fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        print("face service already starting or running at", address)
+        return
+    from util import image_utils
+    from deepface import DeepFace
+    # this process is the service, so its own calls must not go back to the socket
+    image_utils.use_service = False
+    if os.path.exists(address):
+        # left by a service that did not shut down cleanly
+        os.remove(address)
+    start = time.time()
+    image_utils.load_detector("yolov8")
+    DeepFace.build_model(model_name="ArcFace")
+    print("face service: models loaded in {sec:.1f}s".format(sec=time.time() - start))
+
+    model_lock = threading.Lock()
+    state = _State()
+    listener = Listener(address, family="AF_UNIX", authkey=_authkey())
+    os.chmod(address, 0o600)
+    print("face service listening on", address)
+    if idle_timeout is not None:
+        threading.Thread(target=_watch_idle, args=(state, address), daemon=True).start()
+    try:
+        while not state.stopping:
+            try:
+                conn = listener.accept()
+            except Exception as e:
+                # failed handshakes (wrong key, client gone) must not stop the service
+                print("rejected connection: ", e)
+                continue
+            if state.stopping:
+                conn.close()
+                break
+            with state.lock:
+                state.connections += 1
+            threading.Thread(target=_handle, args=(conn, model_lock, state, address), daemon=True).start()
+    finally:
+        # also removes the socket, so clients run the models in process from now on
+        listener.close()
+    print("face service stopped")
+
+
+if __name__ == '__main__':
+    if sys.argv[1:] == ["stop"]:
+        print("face service stopped" if stop() else "face service is not running")
+    else:
+        serve()
@@ -0,0 +1,49 @@
+import os
+from concurrent.futures import wait, FIRST_COMPLETED
+
+
+def scan_files(address):
+    """Stream os.DirEntry objects of every regular file under address, depth first."""
+    stack = [address]
+    while stack:
+        current = stack.pop()
+        try:
+            with os.scandir(current) as it:
+                for entry in it:
+                    try:
+                        if entry.is_dir(follow_symlinks=False):
+                            stack.append(entry.path)
+                        elif entry.is_file(follow_symlinks=False):
+                            yield entry
+                    except OSError as e:
+                        print(f"Error reading entry {entry.path}: {e}")
+        except OSError as e:
+            print(f"Error scanning directory {current}: {e}")
+
+
+def bounded_map(pool, fn, items, queue_depth):
+    """
+    Submit fn(item) to pool for every item while keeping at most queue_depth calls
+    in flight. Yields the finished futures in completion order.
+    """
+    pending = set()
+    for item in items:
+        if len(pending) >= queue_depth:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            yield from done
+        pending.add(pool.submit(fn, item))
+    while pending:
+        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+        yield from done
+
+
+def batched(items, size):
+    """Group an iterable into lists of at most size items."""
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
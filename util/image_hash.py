@@ -0,0 +1,143 @@
+"""
+Perceptual hashing of images to find near-duplicates (thumbnails, previews
+and copies of the same photo) before face detection.
+
+dhash compares neighbouring pixels of a 9x8 grayscale thumbnail, so resized and
+recompressed copies end up within a few bits of each other. Hashes are cached
+in the image_hashes table and groups are found with a BK-tree over Hamming
+distance. near_duplicates walks the images from the highest resolution down:
+an image within the distance of an existing representative joins the closest
+one, otherwise it becomes a representative itself. Every member is therefore
+within the distance of its own representative (chains of small differences
+across a burst of shots do not merge far-apart photos), and the members are
+recorded in image_duplicates. Only representatives go through face detection;
+the faces of a member are the crops of its representative.
+"""
+import os
+import sys
+import numpy as np
+import cv2
+from concurrent.futures import ThreadPoolExecutor
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..',)))
+from util.image_utils import read_image_size
+
+hash_workers = min(8, os.cpu_count() or 1)
+# largest Hamming distance between the dHashes of two copies of one image
+max_distance = 6
+
+
+def dhash(path):
+    """64-bit difference hash of an image, or None if it cannot be decoded."""
+    img = cv2.imread(path, cv2.IMREAD_REDUCED_GRAYSCALE_4)
+    if img is None:
+        return None
+    small = cv2.resize(img, (9, 8), interpolation=cv2.INTER_AREA)
+    bits = small[:, 1:] > small[:, :-1]
+    return int.from_bytes(np.packbits(bits.flatten()).tobytes(), "big")
+
+
+class BKTree:
+    """Burkhard-Keller tree of 64-bit hashes under Hamming distance."""
+
+    def __init__(self):
+        self.root = None
+
+    def add(self, key, item):
+        if self.root is None:
+            self.root = (key, item, {})
+            return
+        node = self.root
+        while True:
+            distance = (key ^ node[0]).bit_count()
+            child = node[2].get(distance)
+            if child is None:
+                node[2][distance] = (key, item, {})
+                return
+            node = child
+
+    def search(self, key, radius):
+        """Yield (distance, item) for every stored hash within radius of key."""
+        stack = [self.root] if self.root is not None else []
+        while stack:
+            node = stack.pop()
+            distance = (key ^ node[0]).bit_count()
+            if distance <= radius:
+                yield distance, node[1]
+            for d, child in node[2].items():
+                if distance - radius <= d <= distance + radius:
+                    stack.append(child)
+
+
+def _signed(h):
+    return h - (1 << 64) if h >= (1 << 63) else h
+
+
+def _unsigned(h):
+    return h + (1 << 64) if h < 0 else h
+
+
+def _hash_entry(path):
+    st = os.stat(path)
+    size = read_image_size(path) or (0, 0)
+    return path, st.st_size, st.st_mtime, dhash(path), size[0] * size[1]
+
+
+def load_hashes(conn, paths, workers=None):
+    """{path: (dhash, pixels, file size)} for paths, hashing only new or changed files."""
+    workers = workers or hash_workers
+    cached = {}
+    for path, size, mtime, h, pixels in conn.execute("SELECT path, size, mtime, dhash, pixels FROM image_hashes"):
+        cached[path] = (size, mtime, h, pixels)
+    result = {}
+    todo = []
+    for path in paths:
+        st = os.stat(path)
+        known = cached.get(path)
+        if known is not None and known[0] == st.st_size and known[1] == st.st_mtime:
+            if known[2] is not None:
+                result[path] = (_unsigned(known[2]), known[3], st.st_size)
+        else:
+            todo.append(path)
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        rows = list(pool.map(_hash_entry, todo))
+    conn.executemany("INSERT OR REPLACE INTO image_hashes (path, size, mtime, dhash, pixels) VALUES (?, ?, ?, ?, ?)",
+                     [(path, size, mtime, None if h is None else _signed(h), pixels) for path, size, mtime, h, pixels in rows])
+    conn.commit()
+    for path, size, _, h, pixels in rows:
+        if h is not None:
+            result[path] = (h, pixels, size)
+    return result
+
+
+def near_duplicates(conn, paths, distance=None):
+    """
+    Group paths into near-duplicates. Returns {path: representative path}.
+    Representatives are picked best first (most pixels, then the biggest
+    file) and map to themselves; every other image maps to the closest
+    representative within distance of it. Images that cannot be hashed are
+    their own representative.
+    """
+    distance = max_distance if distance is None else distance
+    hashes = load_hashes(conn, paths)
+    order = sorted(paths, key=lambda p: (hashes.get(p, (0, 0, 0))[1], hashes.get(p, (0, 0, 0))[2], p), reverse=True)
+    tree = BKTree()
+    representative = {}
+    rows = []
+    for path in order:
+        if path not in hashes:
+            representative[path] = path
+            continue
+        h = hashes[path][0]
+        closest = min(tree.search(h, distance), default=None)
+        if closest is None:
+            tree.add(h, path)
+            representative[path] = path
+        else:
+            representative[path] = closest[1]
+            rows.append((path, closest[1], closest[0]))
+    conn.executemany("DELETE FROM image_duplicates WHERE path = ?", [(path,) for path in paths])
+    conn.executemany("INSERT INTO image_duplicates (path, representative, distance) VALUES (?, ?, ?)", rows)
+    conn.commit()
+    print("near duplicates: {n} images in {g} groups, {d} duplicates skipped".format(
+        n=len(paths), g=len(paths) - len(rows), d=len(rows)))
+    return representative
@@ -4,10 +4,42 @@ import cv2
 import time
 import os
 import operator
+import re
 import pickle
 import shutil
-from sklearn.cluster import DBSCAN
+import sys
+import struct
+import threading
+import tracemalloc
+import tempfile
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait, as_completed, FIRST_COMPLETED
+from sklearn.cluster import DBSCAN, AgglomerativeClustering
+from threadpoolctl import threadpool_limits
 import json
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..',)))
+from util.file_utils import bounded_map, batched
+from databse import face_embeddings, index_db
+from databse.blob_store import hash_file
+from util import face_service
+
+# face detection engine
+detect_batch_size = 16
+decode_workers = min(8, os.cpu_count() or 1)
+# decoded images waiting for the detector
+prefetch_depth = 64
+write_workers = 2
+min_confidence = 0.7
+# detection runs on a decode reduced (by 2, 4 or 8) until its longer side would drop below this
+detect_max_side = 1280
+# images whose header says they are smaller than this on either side are skipped without decoding
+min_image_side = 64
+# send detect/embed calls to the face service when it runs (see face_service.py)
+use_service = True
+# face crops per ArcFace forward pass (activations take about 22 MB per crop)
+embed_batch_size = 32
+# worker processes for face extraction, 1 runs everything in this process
+face_workers = 1
 
 def find_faces(face, db, model, backend):
     dfs = DeepFace.find(
@@ -34,10 +66,102 @@ def extract_faces(img, backend):
 
 
 # main method
-def face_extract(img_address, face_address):
+def face_extract(img_address, face_address, files=None, on_done=None, workers=None):
     print("img address: ", img_address)
     # for _, _, files in os.walk(img_address):
-    crop_face_and_save(img_address, face_address, limit_size=5000)
+    workers = face_workers if workers is None else workers
+    if workers > 1:
+        return crop_face_and_save_parallel(img_address, face_address, limit_size=5000, files=files, on_done=on_done, workers=workers)
+    return crop_face_and_save(img_address, face_address, limit_size=5000, files=files, on_done=on_done)
+
+
+def _init_face_worker(threads, backend):
+    """
+    Process pool initializer: cap the thread pools of the native runtimes and
+    load the detector once. Spawned workers import numpy and TF before this
+    runs, so the pools are resized here rather than through environment
+    variables, which would have to be set in the parent for all its threads.
+    """
+    global use_service, decode_workers, write_workers
+    cv2.setNumThreads(threads)
+    # OpenMP and BLAS pools already loaded by numpy, sklearn and torch
+    threadpool_limits(limits=threads)
+    try:
+        import torch
+        torch.set_num_threads(threads)
+        torch.set_num_interop_threads(1)
+    except (ImportError, RuntimeError):
+        pass
+    try:
+        import tensorflow as tf
+        tf.config.threading.set_intra_op_parallelism_threads(threads)
+        tf.config.threading.set_inter_op_parallelism_threads(1)
+    except (ImportError, RuntimeError):
+        # RuntimeError: TF already ran an op and sized its pools
+        pass
+    # every worker runs its own model, the shared service would serialise them again
+    use_service = False
+    decode_workers = threads
+    write_workers = 1
+    load_detector(backend)
+
+
+def _extract_shard(db, save_address, limit_size, names, backend, results_dir):
+    results_path = os.path.join(results_dir, "worker-{pid}.jsonl".format(pid=os.getpid()))
+    report = crop_face_and_save(db, save_address, limit_size, files=names, backend=backend, results_path=results_path)
+    return names, report
+
+
+def crop_face_and_save_parallel(db, save_address, limit_size, files=None, on_done=None, workers=None,
+                                backend="yolov8", shard_size=64, threads=None):
+    """
+    crop_face_and_save over a pool of worker processes. Each worker caps its
+    runtimes at threads (default: cores / workers), loads the detector once and
+    processes shards of shard_size images, appending per image results to
+    save_address/.results/worker-<pid>.jsonl. on_done runs in this process as
+    shards finish.
+    """
+    workers = workers or os.cpu_count() or 1
+    threads = threads or max(1, (os.cpu_count() or 1) // workers)
+    if files is None:
+        files = os.listdir(db)
+    names = [l for l in files if os.path.isfile(os.path.join(db, l))]
+    results_dir = os.path.join(save_address, ".results")
+    os.makedirs(results_dir, exist_ok=True)
+
+    start = time.time()
+    images = 0
+    faces_found = 0
+    context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=workers, mp_context=context,
+                             initargs=(threads, backend), initializer=_init_face_worker) as pool:
+        futures = [pool.submit(_extract_shard, db, save_address, limit_size, shard, backend, results_dir)
+                   for shard in batched(names, shard_size)]
+        for future in as_completed(futures):
+            shard, report = future.result()
+            images += report["images"]
+            faces_found += report["faces"]
+            if on_done is not None:
+                for name in shard:
+                    on_done(name)
+
+    elapsed = max(time.time() - start, 1e-9)
+    print("face extraction: {n} images, {f} faces in {sec:.1f}s ({ips:.1f} images/s, {w} workers x {t} threads)".format(
+        n=images, f=faces_found, sec=elapsed, ips=images / elapsed, w=workers, t=threads))
+    return {"images": images, "faces": faces_found, "seconds": elapsed, "images_per_sec": images / elapsed, "workers": workers}
+
+
+def benchmark_workers(img_dir, counts=None, limit=None):
+    """images/s of face extraction over img_dir at 1, 2, 4, 8 and all-core worker counts."""
+    counts = counts or sorted({1, 2, 4, 8, os.cpu_count() or 1})
+    files = sorted(os.listdir(img_dir))[:limit]
+    for workers in counts:
+        with tempfile.TemporaryDirectory() as out:
+            if workers == 1:
+                report = crop_face_and_save(img_dir, out, limit_size=5000, files=files)
+            else:
+                report = crop_face_and_save_parallel(img_dir, out, limit_size=5000, files=files, workers=workers)
+        print("{w:>3} workers: {ips:.1f} images/s".format(w=workers, ips=report["images_per_sec"]))
 
 
 
@@ -74,90 +198,509 @@ def draw_rect_and_save(db, save_address):
             cv2.imwrite(address, img)
 
 
-def crop_face_and_save(db, save_address, limit_size):
-    backends = [
-      'yolov8',
-    ]
-    for i in range(len(backends)):
-        print("\nbackend: ", backends[i])
-        for l in os.listdir(db):
-            if (not os.path.isfile(os.path.join(db, l))):
-                continue
-            if (os.path.getsize(os.path.join(db, l)) < limit_size):
-                continue
-            img = cv2.imread(os.path.join(db, l))
-            if (img is None):
-                print("this image is none: " +  os.path.join(db, l))
-                continue
-            faces = extract_faces(img, backend=backends[i])
-            if (faces is None):
-                print(l, "  no face found")
+_detectors = {}
+_detectors_lock = threading.Lock()
+
+
+def load_detector(backend):
+    """
+    The underlying ultralytics model of a DeepFace detector, loaded once per
+    process, or None when the backend cannot take a batch of images.
+    """
+    with _detectors_lock:
+        if backend not in _detectors:
+            model = None
+            if backend == "yolov8":
+                try:
+                    model = DeepFace.build_model(task="face_detector", model_name=backend).model
+                except Exception as e:
+                    print("batched detector unavailable, falling back to per image detection: ", e)
+            _detectors[backend] = model
+        return _detectors[backend]
+
+
+def detect_faces_batch(images, backend="yolov8"):
+    """
+    Detect faces on a list of decoded images with one forward pass. Returns
+    one list of {"facial_area": {x, y, w, h}, "confidence"} per image.
+    """
+    if use_service:
+        detections = face_service.request("detect", images, backend)
+        if detections is not None:
+            return detections
+    model = load_detector(backend)
+    if model is None:
+        return [extract_faces(img, backend=backend) or [] for img in images]
+    results = model.predict(images, verbose=False, show=False, conf=0.25)
+    detections = []
+    for result in results:
+        faces = []
+        for (cx, cy, w, h), conf in zip(result.boxes.xywh.tolist(), result.boxes.conf.tolist()):
+            faces.append({
+                "facial_area": {"x": max(0, int(cx - w / 2)), "y": max(0, int(cy - h / 2)), "w": int(w), "h": int(h)},
+                "confidence": float(conf),
+            })
+        detections.append(faces)
+    return detections
+
+
+def read_image_size(path):
+    """(width, height) from a JPEG, PNG or WebP header without decoding, or None."""
+    with open(path, "rb") as f:
+        head = f.read(32)
+        if head.startswith(b"\x89PNG\r\n\x1a\n") and head[12:16] == b"IHDR":
+            return struct.unpack(">II", head[16:24])
+        if head[:4] == b"RIFF" and head[8:12] == b"WEBP" and len(head) >= 30:
+            chunk = head[12:16]
+            if chunk == b"VP8 ":
+                w, h = struct.unpack("<HH", head[26:30])
+                return w & 0x3fff, h & 0x3fff
+            if chunk == b"VP8L":
+                bits = int.from_bytes(head[21:25], "little")
+                return (bits & 0x3fff) + 1, ((bits >> 14) & 0x3fff) + 1
+            if chunk == b"VP8X":
+                return int.from_bytes(head[24:27], "little") + 1, int.from_bytes(head[27:30], "little") + 1
+            return None
+        if head[:2] != b"\xff\xd8":
+            return None
+        f.seek(2)
+        while True:
+            marker = f.read(2)
+            if len(marker) < 2 or marker[0] != 0xFF:
+                return None
+            while marker[1] == 0xFF:
+                marker = marker[:1] + f.read(1)
+                if len(marker) < 2:
+                    return None
+            code = marker[1]
+            if code == 0x01 or 0xD0 <= code <= 0xD8:
                 continue
-            j=0
-            for face in faces:
-                conf = face['confidence']
-                print("confidence: ", conf)
-                if (conf < 0.7):
-                    continue
-                j+=1
-                area = face['facial_area']
-                x = area['x']
-                y = area['y']
-                w = area['w']
-                h = area['h']      
-                crop_img = img[y:y+h, x:x+w]
-                name = "face-{j}-{im}-{backend}.jpg".format(j=j, backend=backends[i], im=l)
-                print(name)
-                address = os.path.join(save_address, name)
-                cv2.imwrite(address, crop_img)
+            length = f.read(2)
+            if len(length) < 2:
+                return None
+            # start of frame markers, except DHT (C4), JPG (C8) and DAC (CC)
+            if 0xC0 <= code <= 0xCF and code not in (0xC4, 0xC8, 0xCC):
+                data = f.read(5)
+                if len(data) < 5:
+                    return None
+                h, w = struct.unpack(">xHH", data)
+                return w, h
+            f.seek(struct.unpack(">H", length)[0] - 2, 1)
+
+
+_reduced_flags = {2: cv2.IMREAD_REDUCED_COLOR_2, 4: cv2.IMREAD_REDUCED_COLOR_4, 8: cv2.IMREAD_REDUCED_COLOR_8}
+
+
+def _reduction(size):
+    if size is None:
+        return 1
+    for factor in (8, 4, 2):
+        if max(size) / factor >= detect_max_side:
+            return factor
+    return 1
+
+
+def _decode(path, limit_size):
+    """The image to run detection on, reduced when it is large, and the reduction factor."""
+    if (os.path.getsize(path) < limit_size):
+        return None, 1
+    size = read_image_size(path)
+    if size is not None and min(size) < min_image_side:
+        return None, 1
+    factor = _reduction(size)
+    img = cv2.imread(path, _reduced_flags[factor]) if factor > 1 else cv2.imread(path)
+    if (img is None):
+        print("this image is none: " + path)
+    return img, factor
+
+
+def _write_crops(save_address, path, img, factor, faces, backend):
+    name = os.path.basename(path)
+    faces = [face for face in faces if face['confidence'] >= min_confidence]
+    sx = sy = 1.0
+    if faces and factor > 1:
+        # boxes were found on the reduced decode, crops come from full resolution
+        full = cv2.imread(path)
+        if full is not None:
+            sy = full.shape[0] / img.shape[0]
+            sx = full.shape[1] / img.shape[1]
+            img = full
+    j = 0
+    crops = []
+    for face in faces:
+        j += 1
+        area = face['facial_area']
+        x = int(area['x'] * sx)
+        y = int(area['y'] * sy)
+        w = int(area['w'] * sx)
+        h = int(area['h'] * sy)
+        crop_img = img[y:y+h, x:x+w]
+        face_name = "face-{j}-{im}-{backend}.jpg".format(j=j, backend=backend, im=name)
+        cv2.imwrite(os.path.join(save_address, face_name), crop_img)
+        crops.append({"crop": face_name, "x": x, "y": y, "w": w, "h": h, "confidence": face['confidence']})
+    return name, crops
+
+
+# face-<j>-<image>-<backend>.jpg
+_crop_name = re.compile(r"face-\d+-(.+)-[^-]+\.jpg")
+
+
+def remove_crops(save_address, names):
+    """Delete the face crops of the images names from save_address. Returns how many were removed."""
+    names = set(names)
+    removed = 0
+    for crop in os.listdir(save_address) if os.path.isdir(save_address) else []:
+        match = _crop_name.fullmatch(crop)
+        if match and match.group(1) in names:
+            os.remove(os.path.join(save_address, crop))
+            removed += 1
+    return removed
+
+
+def benchmark_decode(img_dir, limit=200):
+    """
+    Throughput and memory of full decoding versus header filtering plus
+    reduced decoding on up to limit images of img_dir.
+    """
+    paths = [os.path.join(img_dir, f) for f in sorted(os.listdir(img_dir))[:limit]
+             if os.path.isfile(os.path.join(img_dir, f))]
+    for label in ("full", "reduced"):
+        tracemalloc.start()
+        start = time.time()
+        decoded = 0
+        pixels = 0
+        for path in paths:
+            if label == "full":
+                img = cv2.imread(path) if os.path.getsize(path) >= 5000 else None
+            else:
+                img, _ = _decode(path, 5000)
+            if img is not None:
+                decoded += 1
+                pixels += img.shape[0] * img.shape[1]
+            del img
+        elapsed = max(time.time() - start, 1e-9)
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        print("{label:>8}: {n} images ({d} decoded) in {sec:.2f}s, {ips:.1f} images/s, {mp:.1f} MP decoded, peak {mb:.1f} MB".format(
+            label=label, n=len(paths), d=decoded, sec=elapsed, ips=len(paths) / elapsed,
+            mp=pixels / 1e6, mb=peak / (1024 * 1024)))
+
+
+def crop_face_and_save(db, save_address, limit_size, files=None, on_done=None, backend="yolov8", results_path=None):
+    """
+    Crop faces of the images in db into save_address. files limits the run to
+    those names (default: everything in db) and on_done(name) is called after
+    each image is handled so callers can checkpoint progress. With
+    results_path, one JSON line per image with its crops and boxes is appended
+    there.
+
+    Images are decoded on a thread pool into a bounded prefetch queue, the
+    detector runs on batches of detect_batch_size images and crops are written
+    on their own threads, so decoding, inference and writing overlap. Images
+    too small by their header are never decoded, large ones are decoded at
+    reduced resolution for detection and read again at full resolution only
+    when a face is confirmed.
+    """
+    if files is None:
+        files = os.listdir(db)
+    paths = [os.path.join(db, l) for l in files if os.path.isfile(os.path.join(db, l))]
+    print("\nbackend: ", backend)
+
+    def decode(path):
+        return (path,) + _decode(path, limit_size)
+
+    start = time.time()
+    images = 0
+    faces_found = 0
+    writes = set()
+
+    results = open(results_path, "a") if results_path else None
+
+    def reap(futures):
+        for future in futures:
+            name, crops = future.result()
+            if results is not None:
+                results.write(json.dumps({"image": name, "faces": crops}) + "\n")
+            if on_done is not None:
+                on_done(name)
+
+    with ThreadPoolExecutor(max_workers=decode_workers) as decoder, ThreadPoolExecutor(max_workers=write_workers) as writer:
+        decoded = (future.result() for future in bounded_map(decoder, decode, paths, prefetch_depth))
+        for batch in batched(decoded, detect_batch_size):
+            ready = []
+            for path, img, factor in batch:
+                if img is None:
+                    if on_done is not None:
+                        on_done(os.path.basename(path))
+                else:
+                    ready.append((path, img, factor))
+            if ready:
+                detections = detect_faces_batch([img for _, img, _ in ready], backend)
+                for (path, img, factor), faces in zip(ready, detections):
+                    faces_found += sum(1 for face in faces if face['confidence'] >= min_confidence)
+                    writes.add(writer.submit(_write_crops, save_address, path, img, factor, faces, backend))
+            images += len(batch)
+            # keep decoded images from piling up behind a slow disk
+            if len(writes) > prefetch_depth:
+                done, writes = wait(writes, return_when=FIRST_COMPLETED)
+                reap(done)
+        done, writes = wait(writes)
+        reap(done)
+    if results is not None:
+        results.close()
+
+    elapsed = max(time.time() - start, 1e-9)
+    print("face extraction: {n} images, {f} faces in {sec:.1f}s ({ips:.1f} images/s, batch={b}, decoders={d})".format(
+        n=images, f=faces_found, sec=elapsed, ips=images / elapsed, b=detect_batch_size, d=decode_workers))
+    return {"images": images, "faces": faces_found, "seconds": elapsed, "images_per_sec": images / elapsed}
 
 ##############################3##############################3##############################3##############################3####################
 
 
-def find_same_identities(face_address, save_path, thresh, same_num):
-    id=1
-    all_related=[]
+def _arcface_batch(paths):
+    """
+    One ArcFace forward pass over face crops, each prepared the way
+    DeepFace.represent prepares an image with detector_backend="skip".
+    """
+    from deepface.commons import image_utils as deepface_images
+    from deepface.modules import preprocessing
+    client = DeepFace.build_model(model_name="ArcFace")
+    height, width = client.input_shape
+    crops = []
+    for path in paths:
+        img, _ = deepface_images.load_image(path)
+        crops.append(preprocessing.resize_image(img=img[:, :, ::-1], target_size=(width, height)))
+    return client.model(np.concatenate(crops), training=False).numpy().tolist()
+
+
+_batched_arcface = True
+
+
+def represent_faces(paths):
+    """ArcFace embeddings of already cropped faces (no second detection pass), one per path."""
+    global _batched_arcface
+    if use_service:
+        embeddings = face_service.request("embed", list(paths))
+        if embeddings is not None:
+            return embeddings
+    if _batched_arcface and paths:
+        try:
+            embeddings = []
+            for first in range(0, len(paths), embed_batch_size):
+                embeddings += _arcface_batch(paths[first:first + embed_batch_size])
+            return embeddings
+        except (ImportError, AttributeError) as e:
+            print("batched ArcFace unavailable, embedding one crop at a time: ", e)
+            _batched_arcface = False
+    return [DeepFace.represent(img_path=path, model_name="ArcFace", detector_backend="skip", enforce_detection=False)[0]["embedding"]
+            for path in paths]
+
+
+def greedy_labels(embeddings, thresh, same_num):
+    """
+    The original grouping: walk the faces in order, each ungrouped face takes
+    every ungrouped face closer than thresh. Groups smaller than same_num are
+    labelled -1. Kept for comparison with cluster_labels.
+    """
+    labels = np.full(len(embeddings), -1, dtype=np.int64)
+    grouped = np.zeros(len(embeddings), dtype=bool)
+    id = 0
+    for i in range(len(embeddings)):
+        if grouped[i]:
+            continue
+        distances = 1 - embeddings @ embeddings[i]
+        related = np.flatnonzero((distances < float(thresh)) & ~grouped)
+        grouped[related] = True
+        grouped[i] = True
+        if len(related) >= same_num:
+            labels[related] = id
+            id += 1
+    return labels
+
+
+def cluster_labels(embeddings, thresh, same_num, algorithm="dbscan"):
+    """
+    Cluster L2-normalised embeddings by cosine distance. Clusters smaller than
+    same_num are labelled -1, the rest are numbered from 0 by decreasing size.
+    """
+    if len(embeddings) == 0:
+        return np.zeros(0, dtype=np.int64)
+    if algorithm == "dbscan":
+        labels = DBSCAN(eps=float(thresh), min_samples=same_num, metric="cosine").fit_predict(embeddings)
+    elif algorithm == "agglomerative":
+        if len(embeddings) == 1:
+            labels = np.zeros(1, dtype=np.int64)
+        else:
+            labels = AgglomerativeClustering(n_clusters=None, distance_threshold=float(thresh),
+                                             metric="cosine", linkage="average").fit_predict(embeddings)
+    elif algorithm == "greedy":
+        labels = greedy_labels(embeddings, thresh, same_num)
+    else:
+        raise ValueError("unknown clustering algorithm: " + algorithm)
+    ids, counts = np.unique(labels[labels >= 0], return_counts=True)
+    renumber = np.full(labels.max() + 2 if len(labels) else 1, -1, dtype=np.int64)
+    order = [ids[k] for k in np.argsort(-counts, kind="stable") if counts[k] >= same_num]
+    for new_id, old_id in enumerate(order):
+        renumber[old_id] = new_id
+    return np.where(labels >= 0, renumber[labels], -1)
+
+
+def cluster_identities(face_address, thresh, same_num, conn=None, algorithm="dbscan"):
+    """
+    Cluster the face crops in face_address and store the result in the
+    face_clusters table: identity (1, 2, ... by decreasing size, 0 for faces in
+    no identity) and cosine distance to the identity centroid. The centroids,
+    with the face closest to each, go to identity_centroids for
+    cross-project matching.
+    Returns {"faces", "identities", "seconds"}.
+    """
     size_limit = 10000
-    os.makedirs(save_path, exist_ok=True)
-    os.makedirs((save_path + "/others"), exist_ok=True)
-    for file in os.listdir(face_address):
+    own_conn = conn is None
+    if own_conn:
+        conn = index_db.connect()
+    start = time.time()
+    pics = []
+    for file in sorted(os.listdir(face_address)):
         pic = os.path.join(face_address, file)
         ext = os.path.splitext(pic)[-1].lower()
-        if (ext == ".jpg" or ext == ".png"):
-            if pic in all_related:
-                continue
-            if (os.path.getsize(pic) < size_limit):
-                shutil.copy2(pic, save_path + "/others")
-                continue
-            same=0
-            related=[]
-            results = DeepFace.find(img_path=pic, db_path=face_address, detector_backend="yolov8", model_name="ArcFace", enforce_detection="False")
-            for df in results:
-                for index, row in df.iterrows():
-                    if (float(row['distance']) < float(thresh)):
-                        # print("row['identiry']", row['identity'])
-                        if (os.path.getsize(row['identity']) < size_limit):
-                            continue
-                        if (row['identity'] in all_related):
-                            continue
-                        related.append(row['identity'])
-                        all_related.append(row['identity'])
-                        same +=1
-            print("same: ", same)
-            if same >= same_num:
-                address = save_path + "/identity" + str(id)
-                os.makedirs(address, exist_ok=True)
-                for file in related:
-                    shutil.copy2(file, address)
-                shutil.copy2(pic, address)
-                id +=1
-            else:
-                shutil.copy2(pic, save_path + "/others")
+        if (ext == ".jpg" or ext == ".png") and os.path.isfile(pic):
+            pics.append(pic)
+    candidates = [pic for pic in pics if os.path.getsize(pic) >= size_limit]
+    hashes = [hash_file(pic) for pic in candidates]
+    embeddings = face_embeddings.get_embeddings(candidates, represent_faces, conn=conn, hashes=hashes)
+    labels = cluster_labels(embeddings, thresh, same_num, algorithm) + 1
+
+    distances = np.full(len(candidates), np.nan)
+    centroids = []
+    for identity in np.unique(labels[labels > 0]):
+        members = labels == identity
+        centroid = embeddings[members].mean(axis=0)
+        centroid /= np.linalg.norm(centroid) or 1
+        distances[members] = 1 - embeddings[members] @ centroid
+        indexes = np.flatnonzero(members)
+        sample = candidates[indexes[np.argmin(distances[indexes])]]
+        centroids.append((int(identity), int(members.sum()), sample, centroid))
+    rows = [(pic, None, 0, None) for pic in pics if os.path.getsize(pic) < size_limit]
+    rows += [(pic, sha, int(label), None if np.isnan(d) else float(d))
+             for pic, sha, label, d in zip(candidates, hashes, labels, distances)]
+    conn.execute("DELETE FROM face_clusters")
+    conn.executemany("INSERT INTO face_clusters (path, sha256, identity, distance) VALUES (?, ?, ?, ?)", rows)
+    conn.commit()
+    face_embeddings.save_centroids(conn, centroids)
+    if own_conn:
+        conn.close()
+    report = {"faces": len(pics), "identities": int(labels.max()) if len(labels) else 0, "seconds": time.time() - start}
+    print("cluster_identities ({alg}): {faces} faces, {identities} identities in {seconds:.1f}s".format(alg=algorithm, **report))
+    return report
+
+
+def _link_or_copy(src, dest_dir):
+    dest = os.path.join(dest_dir, os.path.basename(src))
+    try:
+        os.link(src, dest)
+    except OSError:
+        shutil.copy2(src, dest)
+
+
+def write_identity_views(save_path, conn=None):
+    """Regenerate identityN/ and others/ folders of hard links from the face_clusters table."""
+    own_conn = conn is None
+    if own_conn:
+        conn = index_db.connect()
+    shutil.rmtree(save_path, ignore_errors=True)
+    os.makedirs(save_path + "/others", exist_ok=True)
+    for path, identity in conn.execute("SELECT path, identity FROM face_clusters ORDER BY identity, distance"):
+        address = save_path + ("/identity" + str(identity) if identity > 0 else "/others")
+        os.makedirs(address, exist_ok=True)
+        _link_or_copy(path, address)
+    if own_conn:
+        conn.close()
+
+
+def embed_query(path):
+    """ArcFace embedding of the largest face in an uploaded image, or None when no face is found."""
+    if use_service:
+        found = face_service.request("embed_query", path)
+        if found is not None:
+            return found[0] if found else None
+    try:
+        results = DeepFace.represent(img_path=path, model_name="ArcFace", detector_backend="yolov8", enforce_detection=True)
+    except ValueError:
+        return None
+    largest = max(results, key=lambda r: r["facial_area"]["w"] * r["facial_area"]["h"])
+    return largest["embedding"]
+
+
+def find_same_identities(face_address, save_path, thresh, same_num, conn=None, views=True, algorithm="dbscan"):
+    """Cluster the faces into identities and, if views is set, write the identity folders."""
+    report = cluster_identities(face_address, thresh, same_num, conn=conn, algorithm=algorithm)
+    if views:
+        write_identity_views(save_path, conn=conn)
+    return report
+
+
+def benchmark_identities(n=20000, identities=400, noise=0.35, thresh=0.5, same_num=2, seed=0):
+    """Compare the greedy loop with DBSCAN and agglomerative clustering on synthetic embeddings."""
+    rng = np.random.default_rng(seed)
+    centers = rng.standard_normal((identities, face_embeddings.EMBEDDING_DIM))
+    truth = rng.integers(0, identities, n)
+    embeddings = centers[truth] + noise * rng.standard_normal((n, face_embeddings.EMBEDDING_DIM))
+    embeddings = (embeddings / np.linalg.norm(embeddings, axis=1, keepdims=True)).astype(np.float32)
+    for algorithm in ("greedy", "dbscan", "agglomerative"):
+        if algorithm == "agglomerative" and n > 20000:
+            continue
+        start = time.time()
+        labels = cluster_labels(embeddings, thresh, same_num, algorithm)
+        elapsed = time.time() - start
+        # share of faces whose cluster is dominated by their own true identity
+        correct = 0
+        for label in np.unique(labels[labels >= 0]):
+            correct += np.bincount(truth[labels == label]).max()
+        print("{alg:>13}: {sec:6.2f}s  {ids} identities  purity {p:.3f}".format(
+            alg=algorithm, sec=elapsed, ids=len(np.unique(labels[labels >= 0])), p=correct / n))
 
 
 ##############################3##############################3##############################3##############################3####################
 
 
+def match_project_identities(db_path1, db_path2, thresh=0.5):
+    """
+    Match the identities of two projects by the cosine distance between their
+    stored centroids. Returns pairs closer than thresh, best first, as dicts
+    with identity1, identity2, distance, size1, size2, sample1 and sample2.
+    Returns [] when a project was clustered into no identities, and None
+    when either project was never clustered or was clustered before
+    centroids were stored.
+    """
+    projects = []
+    for db_path in (db_path1, db_path2):
+        if not os.path.exists(db_path):
+            return None
+        # called from GUI requests; the schema is set up by the pipeline and at server start
+        conn = index_db.open_existing(db_path)
+        centroids = face_embeddings.load_centroids(conn)
+        if len(centroids[0]) == 0:
+            with_identity = conn.execute("SELECT EXISTS (SELECT 1 FROM face_clusters WHERE identity > 0)").fetchone()[0]
+            clustered = conn.execute("SELECT EXISTS (SELECT 1 FROM face_clusters)").fetchone()[0] or \
+                conn.execute("SELECT EXISTS (SELECT 1 FROM checkpoints WHERE stage = 'identities' AND status = 'done')").fetchone()[0]
+            if with_identity or not clustered:
+                centroids = None
+        conn.close()
+        projects.append(centroids)
+    if projects[0] is None or projects[1] is None:
+        return None
+    (ids1, sizes1, samples1, c1), (ids2, sizes2, samples2, c2) = projects
+    if len(ids1) == 0 or len(ids2) == 0:
+        return []
+    distances = 1 - c1 @ c2.T
+    rows, cols = np.nonzero(distances < float(thresh))
+    order = np.argsort(distances[rows, cols], kind="stable")
+    return [{
+        "identity1": ids1[i], "identity2": ids2[j], "distance": float(distances[i, j]),
+        "size1": sizes1[i], "size2": sizes2[j], "sample1": samples1[i], "sample2": samples2[j],
+    } for i, j in zip(rows[order], cols[order])]
+
+
 def compare_projects_identities(face_address1, face_address2, thresh):
     """
     Compare identities between two projects by checking if any of two images from an identity in project 1
@@ -231,5 +774,14 @@ def start_face_process(img_address, face_address):
     find_same_identities(face_address, identity_address, thresh=0.5, same_num=2)
     
 if __name__ == '__main__':
+    if len(sys.argv) > 2 and sys.argv[1] == "benchmark_workers":
+        benchmark_workers(sys.argv[2])
+        sys.exit(0)
+    if len(sys.argv) > 2 and sys.argv[1] == "benchmark_decode":
+        benchmark_decode(sys.argv[2])
+        sys.exit(0)
+    if len(sys.argv) > 1 and sys.argv[1] == "benchmark":
+        benchmark_identities(n=int(sys.argv[2]) if len(sys.argv) > 2 else 20000)
+        sys.exit(0)
     # face_extract("projects/proj2/processed_data/extension/image", "projects/proj2/processed_data/faces")
     find_same_identities("projects/proj2/processed_data/faces", "projects/proj2/processed_data/faces/identities", thresh="0.5", same_num=2)
@@ -0,0 +1,178 @@
+"""
+Face extraction from videos at a bounded cost per video.
+
+Frames are sampled by seeking (at most analysis_fps frames a second and at
+most max_samples per video, so a 2 hour recording is sampled as sparsely as it
+has to be), compared on 64x36 grayscale thumbnails, and only the frames that
+start a new scene (or follow max_keyframe_gap seconds without one) are sent to
+the face detector, max_keyframes per video. Every video also stops after
+max_seconds of wall time. Crops go to the same faces directory as the image
+crops, named face-<j>-<video>@<ms>ms-<backend>.jpg, so identity clustering
+picks them up, and the video_faces table keeps the frame timestamp of each.
+Reprocessing a video replaces its crops and rows.
+"""
+import os
+import re
+import sys
+import time
+import numpy as np
+import cv2
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..',)))
+from util import image_utils
+from util.file_utils import batched
+
+analysis_fps = 2
+max_samples = 600
+# mean absolute difference (0-1) of two sampled thumbnails that counts as a scene change
+scene_threshold = 0.12
+min_keyframe_gap = 1.0
+max_keyframe_gap = 30.0
+max_keyframes = 60
+max_seconds = 60.0
+
+
+def _thumbnail(frame):
+    gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+    return cv2.resize(gray, (64, 36), interpolation=cv2.INTER_AREA).astype(np.float32) / 255
+
+
+def sampled_frames(cap, deadline):
+    """Yield (timestamp ms, frame index, frame) of the sampled frames until the video ends or the deadline passes."""
+    fps = cap.get(cv2.CAP_PROP_FPS) or 0
+    count = cap.get(cv2.CAP_PROP_FRAME_COUNT) or 0
+    if fps > 0 and count > 0:
+        duration = count / fps
+        step = max(1.0 / analysis_fps, duration / max_samples)
+        for t in np.arange(0, duration, step):
+            if time.time() > deadline:
+                return
+            cap.set(cv2.CAP_PROP_POS_MSEC, t * 1000)
+            ok, frame = cap.read()
+            if not ok:
+                return
+            yield int(cap.get(cv2.CAP_PROP_POS_MSEC)), int(cap.get(cv2.CAP_PROP_POS_FRAMES)) - 1, frame
+        return
+    # no usable duration (streams, broken headers): read sequentially, decoding only sampled frames
+    every = max(1, int(round((fps or 30) / analysis_fps)))
+    index = 0
+    samples = 0
+    while samples < max_samples and time.time() <= deadline:
+        if not cap.grab():
+            return
+        if index % every == 0:
+            ok, frame = cap.retrieve()
+            if ok:
+                samples += 1
+                yield int(cap.get(cv2.CAP_PROP_POS_MSEC)), index, frame
+        index += 1
+
+
+def keyframes(path, deadline):
+    """Yield (timestamp ms, frame index, frame) of the frames worth running face detection on."""
+    cap = cv2.VideoCapture(path)
+    if not cap.isOpened():
+        print("cannot open video: " + path)
+        return
+    previous = None
+    last_key = None
+    kept = 0
+    try:
+        for ms, index, frame in sampled_frames(cap, deadline):
+            thumb = _thumbnail(frame)
+            seconds = ms / 1000
+            change = 1.0 if previous is None else float(np.mean(np.abs(thumb - previous)))
+            previous = thumb
+            since = None if last_key is None else seconds - last_key
+            if since is None or (change >= scene_threshold and since >= min_keyframe_gap) or since >= max_keyframe_gap:
+                last_key = seconds
+                kept += 1
+                yield ms, index, frame
+                if kept >= max_keyframes:
+                    return
+    finally:
+        cap.release()
+
+
+def _detection_input(frame):
+    side = max(frame.shape[:2])
+    if side <= image_utils.detect_max_side:
+        return frame, 1.0
+    scale = side / image_utils.detect_max_side
+    small = cv2.resize(frame, (int(frame.shape[1] / scale), int(frame.shape[0] / scale)), interpolation=cv2.INTER_AREA)
+    return small, scale
+
+
+# face-<j>-<video>@<ms>ms-<backend>.jpg
+_CROP_NAME = re.compile(r"face-\d+-(.+)@\d+ms-[^.]+\.jpg")
+
+
+def earlier_crops(face_address):
+    """{video name: crop paths} of the video crops already in face_address."""
+    crops = {}
+    for crop in os.listdir(face_address):
+        match = _CROP_NAME.fullmatch(crop)
+        if match:
+            crops.setdefault(match.group(1), []).append(os.path.join(face_address, crop))
+    return crops
+
+
+def extract_video_faces(path, face_address, conn, backend="yolov8", earlier=()):
+    """
+    Crop the faces of one video's keyframes into face_address, replacing the
+    crops of an earlier run: its video_faces rows and the earlier paths (crops
+    an interrupted run wrote without rows). Returns {"keyframes", "faces", "seconds"}.
+    """
+    start = time.time()
+    name = os.path.basename(path)
+    old = {row[0] for row in conn.execute("SELECT crop FROM video_faces WHERE video = ?", (path,))}
+    old.update(earlier)
+    rows = []
+    frames = 0
+    for batch in batched(keyframes(path, start + max_seconds), image_utils.detect_batch_size):
+        inputs = [_detection_input(frame) for _, _, frame in batch]
+        detections = image_utils.detect_faces_batch([small for small, _ in inputs], backend)
+        frames += len(batch)
+        for (ms, index, frame), (_, scale), faces in zip(batch, inputs, detections):
+            j = 0
+            for face in faces:
+                if face['confidence'] < image_utils.min_confidence:
+                    continue
+                j += 1
+                area = face['facial_area']
+                x, y = int(area['x'] * scale), int(area['y'] * scale)
+                w, h = int(area['w'] * scale), int(area['h'] * scale)
+                crop = "face-{j}-{video}@{ms}ms-{backend}.jpg".format(j=j, video=name, ms=ms, backend=backend)
+                cv2.imwrite(os.path.join(face_address, crop), frame[y:y+h, x:x+w])
+                rows.append((os.path.join(face_address, crop), path, ms, index, x, y, w, h, face['confidence']))
+    with conn:
+        conn.execute("DELETE FROM video_faces WHERE video = ?", (path,))
+        conn.executemany("INSERT OR REPLACE INTO video_faces (crop, video, timestamp_ms, frame, x, y, w, h, confidence) "
+                         "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", rows)
+    for crop in old - {row[0] for row in rows}:
+        if os.path.exists(crop):
+            os.remove(crop)
+    return {"keyframes": frames, "faces": len(rows), "seconds": time.time() - start}
+
+
+def video_face_extract(video_address, face_address, conn, files=None, on_done=None):
+    """Run extract_video_faces over the videos in video_address, calling on_done(name) after each."""
+    if files is None:
+        files = os.listdir(video_address)
+    os.makedirs(face_address, exist_ok=True)
+    earlier = earlier_crops(face_address)
+    start = time.time()
+    totals = {"videos": 0, "keyframes": 0, "faces": 0}
+    for name in files:
+        path = os.path.join(video_address, name)
+        if not os.path.isfile(path):
+            continue
+        report = extract_video_faces(path, face_address, conn, earlier=earlier.get(name, ()))
+        print("video {name}: {keyframes} keyframes, {faces} faces in {seconds:.1f}s".format(name=name, **report))
+        totals["videos"] += 1
+        totals["keyframes"] += report["keyframes"]
+        totals["faces"] += report["faces"]
+        if on_done is not None:
+            on_done(name)
+    totals["seconds"] = time.time() - start
+    print("video faces: {videos} videos, {keyframes} keyframes, {faces} faces in {seconds:.1f}s".format(**totals))
+    return totals